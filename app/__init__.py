@@ -1,23 +1,84 @@
+import os
+import weakref
+
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 
 from pathlib import Path
 
+from app.application.database import SQLAlchemy
+
 
 module_path = Path(__file__).parent
 templates_path = module_path.joinpath("templates")
 
+# bound to an application in create_app, the engines are only created
+# the first time a request (or a command) needs a connection
+db = SQLAlchemy()
+
+
+def create_app(config='config'):
+    """
+    build the application from a config module (import path or object).
+    nothing here connects to the database, the schema is created with `flask init-db`.
+    every application gets its own extensions (user shards, user cache, email filter, group commit,
+    password hasher, admission control) in app.extensions, only the metrics are process wide
+    """
+    params = {"template_folder": templates_path}
+
+    app = Flask(__name__, **params)
+
+    app.config.from_object(config)
+
+    db.init_app(app)
+
+    with app.app_context():
+        from app.application.admission import AdmissionControl
+        from app.application.cache import UserCache
+        from app.application.email_filter import EmailFilter
+        from app.application.group_commit import GroupCommitter
+        from app.application.metrics import metrics
+        from app.application.passwords import PasswordHasher
+        from app.application.sharding import UserShards
+
+        UserShards().init_app(app)
+        UserCache().init_app(app)
+        EmailFilter().init_app(app)
+        GroupCommitter().init_app(app)
+        PasswordHasher().init_app(app)
+        metrics.init_app(app)
+        AdmissionControl().init_app(app)
+
+        from app.application.web import app_bp as application_bp
+
+        app.register_blueprint(application_bp)
+
+        from app.application.commands import init_db_command, replicate_command, rebalance_users_command
+
+        app.cli.add_command(init_db_command)
+        app.cli.add_command(replicate_command)
+        app.cli.add_command(rebalance_users_command)
+
+    # connections opened before a fork must not be shared with the child process
+    _apps.add(app)
 
-params = {"template_folder": templates_path}
+    return app
 
-app = Flask(__name__, **params)
 
-app.config.from_object('config')
+def dispose_engines(app):
+    """drop the pooled connections of every engine the application has created so far"""
+    state = app.extensions.get('sqlalchemy') if app is not None else None
+    if state is None:
+        return
+    for connector in state.connectors.values():
+        if connector._engine is not None:
+            connector._engine.dispose()
 
-db = SQLAlchemy(app)
 
-from app.application.web import app_bp as application_bp
+def _dispose_engines_after_fork():
+    for app in list(_apps):
+        dispose_engines(app)
 
-app.register_blueprint(application_bp)
 
-db.create_all()
+# the applications still alive, a single fork hook for all of them
+_apps = weakref.WeakSet()
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
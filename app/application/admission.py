@@ -0,0 +1,132 @@
+import threading
+import time
+
+from flask import g, request
+
+from .database import READ_METHODS
+from .metrics import metrics, Counter, Histogram
+from .utils import app_extension, json_response
+
+OVERLOADED_ERRORS = {'errors': ['The server is overloaded, retry later.']}
+
+# process wide like the other metrics, summed over the applications
+requests_shed = metrics.registry.register(Counter(
+    'http_requests_shed_total', 'Requests rejected by admission control.', ('endpoint', 'lane')))
+request_queue_time = metrics.registry.register(Histogram(
+    'http_request_queue_seconds', 'Time requests waited for admission.', ('endpoint', 'lane')))
+
+
+class Lane:
+    """
+    at most `concurrency` requests at a time, up to `queue` more wait for a slot
+    in arrival order and the others are turned away
+    """
+
+    def __init__(self, concurrency: int, queue: int):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.active = 0
+        self._waiting = []
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: float):
+        """
+        take a slot, waiting at most `timeout` seconds for one
+        :return: the time spent waiting, None when the request is rejected
+        """
+        start = time.perf_counter()
+        with self._condition:
+            if self.active < self.concurrency and not self._waiting:
+                self.active += 1
+                return 0.0
+            if len(self._waiting) >= self.queue:
+                return None
+            ticket = object()
+            self._waiting.append(ticket)
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self.active < self.concurrency and self._waiting[0] is ticket, timeout)
+            finally:
+                self._waiting.remove(ticket)
+                # the next in line may have been waiting behind this request
+                self._condition.notify_all()
+            if not admitted:
+                return None
+            self.active += 1
+            return time.perf_counter() - start
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+
+class AdmissionControl:
+    """
+    load shedding of the endpoints listed in ADMISSION_LIMITS: each gets a lane of
+    `concurrency` running and `queue` waiting requests, the requests beyond that, or waiting
+    longer than ADMISSION_QUEUE_TIMEOUT, are answered right away with a 503.
+    with ADMISSION_READ_LANE the read requests of an endpoint have a lane of their own,
+    so they are still served while the writes are saturated. the lanes are those of the application
+    in the process, every worker of the server has its own
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.read_lane = True
+        self.queue_timeout = 1.0
+        self.retry_after = 1
+        self._lanes = {}
+        self.shed = requests_shed
+        self.queue_time = request_queue_time
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_CONTROL_ENABLED', False)
+        app.config.setdefault('ADMISSION_LIMITS', {})
+        app.config.setdefault('ADMISSION_READ_LANE', True)
+        app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 1.0)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+        self.enabled = app.config['ADMISSION_CONTROL_ENABLED']
+        self.read_lane = app.config['ADMISSION_READ_LANE']
+        self.queue_timeout = app.config['ADMISSION_QUEUE_TIMEOUT']
+        self.retry_after = app.config['ADMISSION_RETRY_AFTER']
+        self._lanes = {}
+        for endpoint, (concurrency, queue) in app.config['ADMISSION_LIMITS'].items():
+            self._lanes[endpoint, 'write'] = Lane(concurrency, queue)
+            if self.read_lane:
+                self._lanes[endpoint, 'read'] = Lane(concurrency, queue)
+        app.extensions['admission_control'] = self
+
+    def lane_of(self, endpoint: str, method: str) -> tuple:
+        if self.read_lane and method in READ_METHODS:
+            return endpoint, 'read'
+        return endpoint, 'write'
+
+    def before_request(self):
+        if not self.enabled:
+            return None
+        key = self.lane_of(request.endpoint, request.method)
+        lane = self._lanes.get(key)
+        if lane is None:
+            return None
+        waited = lane.acquire(self.queue_timeout)
+        if waited is None:
+            self.shed.inc(*key)
+            return json_response(OVERLOADED_ERRORS, 503, headers={'Retry-After': self.retry_after})
+        self.queue_time.observe(waited, *key)
+        g.admission_lane = lane
+        return None
+
+    def teardown_request(self, exc):
+        lane = g.pop('admission_lane', None)
+        if lane is not None:
+            lane.release()
+
+
+def init_admission_control(blueprint):
+    # the blueprint is shared by the applications, the hooks find the lanes of the current one
+    blueprint.before_request(lambda: admission_control.before_request())
+    blueprint.teardown_request(lambda exc: admission_control.teardown_request(exc))
+
+
+admission_control = app_extension('admission_control')
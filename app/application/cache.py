@@ -0,0 +1,173 @@
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.utils import import_string
+
+from .utils import app_extension
+
+
+class CacheBackend:
+    """
+    interface of the storage behind UserCache, a shared cache (redis, memcached...)
+    can be plugged in by implementing it and pointing USER_CACHE_BACKEND to the class.
+    backends are created with the keyword arguments max_entries and ttl
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    """backend used while the cache is disabled, every lookup is a miss"""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LRUCache(CacheBackend):
+    """
+    bounded in-process cache, the least recently used entry is evicted when it is full
+    and entries older than `ttl` seconds are dropped on access
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+# invalidations are counted per stripe of uuids, a stripe shared by two users
+# only costs a skipped fill now and then
+GENERATION_STRIPES = 1024
+
+
+class UserCache:
+    """
+    read-through cache of the to_dict() payload of users keyed by uuid,
+    the backend is chosen from the application config in init_app.
+    a reader takes the generation of the uuid before it reads the database and hands it to set:
+    a user invalidated meanwhile is not cached, the row read may be older than the write
+    """
+
+    def __init__(self):
+        self.backend = NullCache()
+        self._generations = [0] * GENERATION_STRIPES
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_ENABLED', False)
+        app.config.setdefault('USER_CACHE_BACKEND', 'app.application.cache.LRUCache')
+        app.config.setdefault('USER_CACHE_MAX_ENTRIES', 1024)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        if app.config['USER_CACHE_ENABLED']:
+            backend_class = import_string(app.config['USER_CACHE_BACKEND'])
+            self.backend = backend_class(
+                max_entries=app.config['USER_CACHE_MAX_ENTRIES'],
+                ttl=app.config['USER_CACHE_TTL'],
+            )
+        else:
+            self.backend = NullCache()
+        app.extensions['user_cache'] = self
+
+    def get(self, uuid):
+        return self.backend.get(uuid)
+
+    def generation(self, uuid) -> int:
+        return self._generations[hash(uuid) % GENERATION_STRIPES]
+
+    def set(self, uuid, data, generation: int = None):
+        """cache data, unless the uuid was invalidated since `generation` was taken"""
+        with self._lock:
+            if generation is None or self.generation(uuid) == generation:
+                self.backend.set(uuid, data)
+
+    def invalidate(self, uuid):
+        with self._lock:
+            self._generations[hash(uuid) % GENERATION_STRIPES] += 1
+            self.backend.delete(uuid)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        return self.backend.stats()
+
+
+user_cache = app_extension('user_cache')
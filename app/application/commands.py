@@ -0,0 +1,50 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app import db
+from .database import create_missing_indexes
+from .replication import SQLiteReplicator
+from .search import create_search_index
+from .sharding import user_shards
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create the database tables, and the indexes missing on existing tables."""
+    db.create_all()
+    create_missing_indexes(db.engine, db.get_tables_for_bind())
+    create_search_index(db.engine)
+    user_shards.create_all()
+    click.echo('Initialized the database.')
+
+
+@click.command('replicate')
+@click.option('--interval', default=1.0, show_default=True, help='Seconds between two copies.')
+@click.option('--once', is_flag=True, help='Copy once and exit.')
+@with_appcontext
+def replicate_command(interval, once):
+    """Copy the sqlite database onto the DATABASE_REPLICA_URIS files."""
+    replicator = SQLiteReplicator.from_app(current_app)
+    if not replicator.replicas:
+        raise click.UsageError('DATABASE_REPLICA_URIS is empty.')
+    if once:
+        replicator.sync()
+    else:
+        click.echo('Replicating {} to {} every {}s.'.format(
+            replicator.primary, ', '.join(replicator.replicas), interval))
+        replicator.run(interval)
+
+
+@click.command('rebalance-users')
+@click.option('--from-primary', is_flag=True, help='Also move the users of the unsharded auth_user table.')
+@click.option('--batch-size', default=1000, show_default=True, help='Users read per query.')
+@with_appcontext
+def rebalance_users_command(from_primary, batch_size):
+    """Move the users to the shard of their uuid, after USER_SHARDS changed."""
+    if not user_shards.enabled:
+        raise click.UsageError('USER_SHARDS is empty.')
+    user_shards.create_all()
+    moved = user_shards.rebalance(from_primary=from_primary, batch_size=batch_size)
+    click.echo('Moved {} users.'.format(moved))
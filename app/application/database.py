@@ -0,0 +1,174 @@
+import random
+import time
+from functools import partial
+
+from flask import g, has_request_context, request, current_app
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession
+from sqlalchemy import event, inspect, orm
+from sqlalchemy.pool import QueuePool
+
+# engine option used to hand the pragmas from apply_driver_hacks to create_engine
+_PRAGMAS_OPTION = '_sqlite_pragmas'
+
+# requests with these methods only read and can be served by a replica
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# cookie holding the unix time until which a client that wrote reads from the primary
+READ_YOUR_WRITES_COOKIE = 'read_primary_until'
+
+
+def apply_pragmas(dbapi_connection, connection_record, pragmas: dict):
+    """run on every new sqlite connection, before the pool hands it out"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+    finally:
+        cursor.close()
+
+
+def create_missing_indexes(engine, tables) -> list:
+    """
+    create_all only creates the indexes of the tables it creates,
+    add the indexes declared since on the tables that already exist
+    :return: the names of the indexes created
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+    for table in tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    return created
+
+
+def replica_bind_key(index: int) -> str:
+    return 'replica_{}'.format(index)
+
+
+def read_bind():
+    """the bind key of the replica the current request reads from, None to use the primary"""
+    if not has_request_context():
+        return None
+    return g.get('database_read_bind')
+
+
+def reads_own_writes() -> bool:
+    """whether the current request comes from a client inside its read your writes window"""
+    return has_request_context() and g.get('database_read_your_writes', False)
+
+
+class RoutingSession(SignallingSession):
+    """
+    sends the statements of read only requests to their replica,
+    anything flushed (and everything outside a request) goes to the primary
+    """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = read_bind()
+        if bind is not None and not self._flushing:
+            return self.db.get_engine(self.app, bind=bind)
+        return super().get_bind(mapper, clause)
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    flask-sqlalchemy reading the connection settings of config.py:
+    DATABASE_CONNECT_OPTIONS are passed to the driver, file based sqlite databases
+    get a pool of DATABASE_POOL_SIZE connections (THREADS_PER_PAGE when None, no pool when 0)
+    and every new sqlite connection runs the SQLITE_PRAGMAS.
+    read only requests are routed to one of the DATABASE_REPLICA_URIS, except for clients
+    that wrote in the last DATABASE_READ_YOUR_WRITES_WINDOW seconds
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_REPLICA_URIS', [])
+        app.config.setdefault('DATABASE_READ_YOUR_WRITES_WINDOW', 5)
+        replicas = app.config['DATABASE_REPLICA_URIS']
+        if replicas:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.update((replica_bind_key(index), uri) for index, uri in enumerate(replicas))
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.before_request(self.route_request)
+            app.after_request(self.remember_write)
+        super().init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @staticmethod
+    def route_request():
+        replicas = current_app.config['DATABASE_REPLICA_URIS']
+        if not replicas or request.method not in READ_METHODS:
+            return
+        try:
+            primary_until = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0))
+        except ValueError:
+            primary_until = 0
+        if primary_until > time.time():
+            g.database_read_your_writes = True
+            return
+        g.database_read_bind = replica_bind_key(random.randrange(len(replicas)))
+
+    @staticmethod
+    def remember_write(response):
+        if request.method in READ_METHODS or response.status_code >= 400:
+            return response
+        window = current_app.config['DATABASE_READ_YOUR_WRITES_WINDOW']
+        response.set_cookie(READ_YOUR_WRITES_COOKIE, str(time.time() + window), max_age=window, httponly=True)
+        return response
+
+    def check_connections(self, app=None) -> dict:
+        """
+        run SELECT 1 on the primary and on every bind (replicas, shards)
+        :return: the error of each database that failed, keyed by bind ('primary' for the primary)
+        """
+        app = self.get_app(app)
+        errors = {}
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+            try:
+                with self.get_engine(app, bind=bind).connect() as connection:
+                    connection.execute('SELECT 1')
+            except Exception as exc:
+                errors[bind or 'primary'] = str(exc)
+        return errors
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        app.config.setdefault('DATABASE_CONNECT_OPTIONS', {})
+        app.config.setdefault('DATABASE_POOL_SIZE', None)
+        app.config.setdefault('DATABASE_POOL_MAX_OVERFLOW', 10)
+        app.config.setdefault('DATABASE_POOL_TIMEOUT', 30)
+        app.config.setdefault('SQLITE_PRAGMAS', {})
+        super().apply_driver_hacks(app, sa_url, options)
+        connect_args = options.setdefault('connect_args', {})
+        connect_args.update(app.config['DATABASE_CONNECT_OPTIONS'])
+        if not sa_url.drivername.startswith('sqlite'):
+            return
+        pool_size = app.config['DATABASE_POOL_SIZE']
+        if pool_size is None:
+            pool_size = app.config.get('THREADS_PER_PAGE', 5)
+        if pool_size and sa_url.database not in (None, '', ':memory:'):
+            options['poolclass'] = QueuePool
+            options['pool_size'] = pool_size
+            options['max_overflow'] = app.config['DATABASE_POOL_MAX_OVERFLOW']
+            options['pool_timeout'] = app.config['DATABASE_POOL_TIMEOUT']
+            # pooled connections move between the request threads
+            connect_args['check_same_thread'] = False
+        if app.config['SQLITE_PRAGMAS']:
+            options[_PRAGMAS_OPTION] = dict(app.config['SQLITE_PRAGMAS'])
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop(_PRAGMAS_OPTION, None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', partial(apply_pragmas, pragmas=pragmas))
+        return engine
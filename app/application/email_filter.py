@@ -0,0 +1,182 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from .utils import app_extension
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    probabilistic set of strings: `in` can answer a false positive but never a false negative.
+    sized for `capacity` items at `error_rate` false positives
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.size = max(int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # double hashing, k positions derived from two 64 bit halves of a single digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+    def estimated_false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class EmailFilter:
+    """
+    in-memory membership filter of auth_user.email used to skip the duplicate email lookups:
+    an email the filter has never seen cannot be in the table. it is built from the table in the
+    background at startup (every email goes to the database until it is ready), kept current by
+    the writes of this process and rebuilt every EMAIL_FILTER_REBUILD_INTERVAL seconds to pick up
+    writes of other processes and deletes
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.capacity = 100000
+        self.error_rate = 0.01
+        self.rebuild_interval = 300
+        self._filter = None
+        self._built_at = 0.0
+        self._pending = None
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        # one build at a time, they share the emails written meanwhile
+        self._build_lock = threading.Lock()
+        self.negatives = 0
+        self.positives = 0
+        self.false_positives = 0
+
+    def init_app(self, app):
+        app.config.setdefault('EMAIL_FILTER_ENABLED', False)
+        app.config.setdefault('EMAIL_FILTER_CAPACITY', 100000)
+        app.config.setdefault('EMAIL_FILTER_ERROR_RATE', 0.01)
+        app.config.setdefault('EMAIL_FILTER_REBUILD_INTERVAL', 300)
+        self.enabled = app.config['EMAIL_FILTER_ENABLED']
+        self.capacity = app.config['EMAIL_FILTER_CAPACITY']
+        self.error_rate = app.config['EMAIL_FILTER_ERROR_RATE']
+        self.rebuild_interval = app.config['EMAIL_FILTER_REBUILD_INTERVAL']
+        self.app = app
+        self.reset()
+        app.extensions['email_filter'] = self
+        if self.enabled:
+            self._rebuild_in_background()
+
+    def reset(self):
+        with self._lock:
+            self._filter = None
+            self._pending = None
+            self.negatives = self.positives = self.false_positives = 0
+
+    def build(self):
+        from app.application.models import User
+
+        with self._build_lock:
+            with self._lock:
+                # emails added while the table is read are replayed on the new filter
+                self._pending = []
+            count = User.query.count()
+            bloom = BloomFilter(max(self.capacity, count * 2), self.error_rate)
+            for email, in User.query.with_entities(User.email).yield_per(10000):
+                bloom.add(email)
+            with self._lock:
+                for email in self._pending:
+                    bloom.add(email)
+                self._pending = None
+                self._filter = bloom
+                self._built_at = time.monotonic()
+
+    def _rebuild_in_background(self):
+        def rebuild():
+            try:
+                with self.app.app_context():
+                    self.build()
+            except Exception:
+                logger.exception('Could not build the email filter')
+            finally:
+                self._rebuilding = False
+
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=rebuild, name='email-filter-rebuild', daemon=True).start()
+
+    def might_contain(self, email: str) -> bool:
+        if not self.enabled:
+            return True
+        bloom = self._filter
+        if bloom is None:
+            # not built yet, the database answers
+            self._rebuild_in_background()
+            return True
+        if time.monotonic() - self._built_at >= self.rebuild_interval:
+            self._rebuild_in_background()
+        if email in bloom:
+            self.positives += 1
+            return True
+        self.negatives += 1
+        return False
+
+    def record_false_positives(self, count: int):
+        """the database did not have `count` emails the filter answered positively for"""
+        self.false_positives += count
+
+    def add(self, email: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(email)
+            if self._filter is not None:
+                self._filter.add(email)
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {'enabled': False}
+        bloom = self._filter
+        lookups_of_new_emails = self.negatives + self.false_positives
+        return {
+            'enabled': True,
+            'built': bloom is not None,
+            'items': bloom.count if bloom else 0,
+            'capacity': bloom.capacity if bloom else self.capacity,
+            'bits': bloom.size if bloom else 0,
+            'hashes': bloom.hashes if bloom else 0,
+            'memory_bytes': bloom.memory_bytes if bloom else 0,
+            'configured_error_rate': self.error_rate,
+            'estimated_false_positive_rate': bloom.estimated_false_positive_rate() if bloom else 0.0,
+            'observed_false_positive_rate': (
+                self.false_positives / lookups_of_new_emails if lookups_of_new_emails else 0.0),
+            'negatives': self.negatives,
+            'positives': self.positives,
+            'false_positives': self.false_positives,
+        }
+
+
+email_filter = app_extension('email_filter')
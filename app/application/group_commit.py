@@ -0,0 +1,139 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from app import db
+from .sharding import user_shards
+from .utils import app_extension
+
+
+class GroupCommitter:
+    """
+    single writer thread committing the writes of concurrent requests together.
+    a write is a function of a session, the writer runs up to GROUP_COMMIT_MAX_BATCH
+    of them in one transaction, waiting at most GROUP_COMMIT_MAX_WAIT seconds for the batch
+    to fill, and hands each request its own result or exception. a write that fails is
+    rolled back alone: the transaction is restarted with the rest of the batch
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.max_batch = 64
+        self.max_wait = 0.002
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.retries = 0
+
+    def init_app(self, app):
+        app.config.setdefault('GROUP_COMMIT_ENABLED', False)
+        app.config.setdefault('GROUP_COMMIT_MAX_BATCH', 64)
+        app.config.setdefault('GROUP_COMMIT_MAX_WAIT', 0.002)
+        self.shutdown()
+        self.enabled = app.config['GROUP_COMMIT_ENABLED']
+        self.max_batch = app.config['GROUP_COMMIT_MAX_BATCH']
+        self.max_wait = app.config['GROUP_COMMIT_MAX_WAIT']
+        self.app = app
+        self.batches = self.writes = self.retries = 0
+        app.extensions['group_commit'] = self
+
+    def submit(self, write):
+        """run write(session) on the writer thread, return its result once committed or raise its error"""
+        future = Future()
+        self._start_writer()
+        self._queue.put((write, future))
+        return future.result()
+
+    def _start_writer(self):
+        # started on first use, and again in a forked child where the thread is gone
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+
+    def shutdown(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        with self.app.app_context():
+            # the results are handed to other threads, they must stay readable after the commit
+            create_session = user_shards.create_session if user_shards.enabled else db.create_session
+            session = create_session({'expire_on_commit': False})()
+            try:
+                while True:
+                    batch = self._next_batch()
+                    if batch is None:
+                        return
+                    self._commit(session, batch)
+            finally:
+                session.close()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # stop after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _commit(self, session, batch):
+        pending = list(batch)
+        while pending:
+            results = []
+            for write, future in pending:
+                try:
+                    results.append(write(session))
+                    session.flush()
+                except Exception as exc:
+                    session.rollback()
+                    future.set_exception(exc)
+                    pending.remove((write, future))
+                    self.retries += 1
+                    break
+            else:
+                try:
+                    session.commit()
+                except Exception as exc:
+                    session.rollback()
+                    for write, future in pending:
+                        future.set_exception(exc)
+                    return
+                session.expunge_all()
+                self.batches += 1
+                self.writes += len(pending)
+                for (write, future), result in zip(pending, results):
+                    future.set_result(result)
+                return
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'batches': self.batches,
+            'writes': self.writes,
+            'retries': self.retries,
+            'average_batch': self.writes / self.batches if self.batches else 0.0,
+        }
+
+
+group_committer = app_extension('group_commit')
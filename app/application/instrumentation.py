@@ -0,0 +1,145 @@
+import json
+import logging
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import g, has_request_context, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+class RequestStats:
+    """sql statements and time spent in each phase of one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.timings = Counter()
+        self.statements = Counter()
+
+    def add_query(self, statement: str, duration: float):
+        self.queries += 1
+        self.db_time += duration
+        self.statements[statement] += 1
+
+    def add_time(self, name: str, duration: float):
+        self.timings[name] += duration
+
+    def total_time(self) -> float:
+        return time.perf_counter() - self.start
+
+    def warnings(self, query_budget: int, n_plus_one_threshold: int) -> list:
+        """
+        possible N+1 patterns (the same statement issued at least n_plus_one_threshold times)
+        and requests issuing more than query_budget statements
+        """
+        warnings = [
+            'N+1: {} executions of {}'.format(count, statement)
+            for statement, count in self.statements.items()
+            if count >= n_plus_one_threshold
+        ]
+        if self.queries > query_budget:
+            warnings.append('Query budget exceeded: {} queries, budget {}'.format(self.queries, query_budget))
+        return warnings
+
+    def server_timing(self, total: float, streamed: bool = False) -> str:
+        """the timings as a Server-Timing header, those of a streamed response stop at its first byte"""
+        metrics = ['db;dur={:.2f};desc="{} queries"'.format(self.db_time * 1000, self.queries)]
+        metrics.extend('{};dur={:.2f}'.format(name, duration * 1000) for name, duration in sorted(self.timings.items()))
+        if streamed:
+            metrics.append('total;dur={:.2f};desc="until the first byte"'.format(total * 1000))
+        else:
+            metrics.append('total;dur={:.2f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+
+def current_stats():
+    """the stats of the request being handled, None when instrumentation is off or outside a request"""
+    if not has_request_context():
+        return None
+    return g.get('request_stats')
+
+
+def timed(name: str):
+    """add the time spent in the decorated function to the `name` timing of the current request"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = current_stats()
+            if stats is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is not None and conn.info.get('query_start_time'):
+        stats.add_query(statement, time.perf_counter() - conn.info['query_start_time'].pop())
+
+
+def start_request_stats():
+    if current_app.config['REQUEST_INSTRUMENTATION']:
+        g.request_stats = RequestStats()
+
+
+def finish_request_stats(response):
+    """
+    report the stats of the request in the Server-Timing header and a log line. the body of a streamed
+    response is produced after the headers are sent: its header stops at the first byte and
+    the line is logged once the response is closed, with the queries run while streaming
+    """
+    stats = current_stats()
+    if stats is None:
+        return response
+    response.headers['Server-Timing'] = stats.server_timing(stats.total_time(), response.is_streamed)
+    line = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+    }
+    debug = current_app.config['REQUEST_INSTRUMENTATION_DEBUG']
+    limits = current_app.config['REQUEST_QUERY_BUDGET'], current_app.config['REQUEST_N_PLUS_ONE_THRESHOLD']
+    if response.is_streamed:
+        line['streamed'] = True
+        response.call_on_close(lambda: log_request_stats(stats, line, debug, limits))
+    else:
+        log_request_stats(stats, line, debug, limits)
+    return response
+
+
+def log_request_stats(stats: RequestStats, line: dict, debug: bool, limits: tuple):
+    """may run after the request context is gone, everything it needs is passed in"""
+    line.update(
+        queries=stats.queries,
+        db_ms=round(stats.db_time * 1000, 2),
+        total_ms=round(stats.total_time() * 1000, 2),
+    )
+    line.update(('{}_ms'.format(name), round(duration * 1000, 2)) for name, duration in stats.timings.items())
+    if debug:
+        line['warnings'] = stats.warnings(*limits)
+        for warning in line['warnings']:
+            logger.warning('%s %s: %s', line['method'], line['path'], warning)
+    logger.info(json.dumps(line))
+
+
+def init_instrumentation(blueprint):
+    blueprint.before_request(start_request_stats)
+    blueprint.after_request(finish_request_stats)
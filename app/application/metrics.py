@@ -0,0 +1,306 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import current_app, g, request, Response
+
+from app import db
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """a named family of samples, one value per combination of label values"""
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self) -> list:
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+    @staticmethod
+    def merge_values(first, second):
+        return first + second
+
+    def render(self, samples: list) -> list:
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, labels), value) for labels, value in samples]
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    the value of each label combination is [count per bucket..., count above the last bucket, sum],
+    the counts are made cumulative when rendered
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def merge_values(first, second):
+        return [a + b for a, b in zip(first, second)]
+
+    def render(self, samples: list) -> list:
+        lines = []
+        for labels, counts in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(self.labelnames + ('le',), labels + [le]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labelnames, labels), counts[-1]))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+def format_labels(labelnames: tuple, labels: list) -> str:
+    if not labelnames:
+        return ''
+    pairs = (
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(labelnames, labels)
+    )
+    return '{' + ','.join(pairs) + '}'
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> dict:
+        return {name: metric.samples() for name, metric in self.metrics.items()}
+
+    def merge(self, snapshots: list) -> dict:
+        """sum the samples of several snapshots label by label"""
+        merged = {}
+        for snapshot in snapshots:
+            for name, samples in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                values = merged.setdefault(name, {})
+                for labels, value in samples:
+                    key = tuple(labels)
+                    values[key] = metric.merge_values(values[key], value) if key in values else value
+        return {name: [[list(labels), value] for labels, value in values.items()] for name, values in merged.items()}
+
+    def render(self, snapshot: dict) -> str:
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.type))
+            lines.extend(metric.render(sorted(snapshot.get(name, []))))
+        return '\n'.join(lines) + '\n'
+
+
+class FileStore:
+    """
+    aggregation for several worker processes: each process writes its own snapshot
+    to <directory>/metrics-<pid>.json and a scrape sums the files of all the processes.
+    gauges of processes that are gone are dropped, counters and histograms are kept
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, pid: int) -> str:
+        return os.path.join(self.directory, 'metrics-{}.json'.format(pid))
+
+    def write(self, snapshot: dict):
+        # every write gets its own temporary file, the threads of a process may flush together
+        descriptor, temporary = tempfile.mkstemp(prefix='.metrics-', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'w') as output:
+                json.dump(snapshot, output)
+            os.replace(temporary, self.path(os.getpid()))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def read_all(self, registry: Registry) -> list:
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as source:
+                    snapshot = json.load(source)
+            except (OSError, ValueError):
+                continue
+            if not process_alive(int(filename[len('metrics-'):-len('.json')])):
+                snapshot = {
+                    name: samples for name, samples in snapshot.items()
+                    if name in registry.metrics and registry.metrics[name].type != 'gauge'
+                }
+            snapshots.append(snapshot)
+        return snapshots
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Metrics:
+    """
+    request metrics of the application in the prometheus text format, served on /metrics.
+    with METRICS_MULTIPROC_DIR set the snapshot of each process is written there
+    at most every METRICS_FLUSH_INTERVAL seconds and merged when scraped
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.requests = self.registry.register(Counter(
+            'http_requests_total', 'Total HTTP requests.', ('endpoint', 'method', 'status')))
+        self.latency = self.registry.register(Histogram(
+            'http_request_duration_seconds', 'HTTP request latency in seconds.', ('endpoint',)))
+        self.in_flight = self.registry.register(Gauge(
+            'http_requests_in_flight', 'HTTP requests being handled.'))
+        self.pool_wait = self.registry.register(Histogram(
+            'db_pool_checkout_wait_seconds', 'Time spent waiting for a database connection from the pool.'))
+        self.store = None
+        self.flush_interval = 1.0
+        self._last_flush = 0.0
+        self._flush_lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_MULTIPROC_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 1.0)
+        app.extensions['metrics'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+        if app.config['METRICS_MULTIPROC_DIR']:
+            self.store = FileStore(app.config['METRICS_MULTIPROC_DIR'])
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    def before_request(self):
+        g.metrics_start = time.perf_counter()
+        self.in_flight.inc()
+        instrument_pool(db.engine, self.pool_wait)
+
+    def after_request(self, response):
+        start = g.get('metrics_start')
+        if start is not None:
+            endpoint = request.endpoint or '<unmatched>'
+            self.requests.inc(endpoint, request.method, str(response.status_code))
+            self.latency.observe(time.perf_counter() - start, endpoint)
+        return response
+
+    def teardown_request(self, exc):
+        if g.get('metrics_start') is None:
+            return
+        self.in_flight.dec()
+        if self.store is None:
+            return
+        try:
+            self.flush(self.flush_interval)
+        except OSError:
+            # the request is done, losing one flush is better than failing it
+            current_app.logger.exception('Could not write the metrics to %s', self.store.directory)
+
+    def flush(self, interval: float = 0):
+        """write the snapshot of this process unless it was written less than `interval` seconds ago"""
+        with self._flush_lock:
+            if time.monotonic() - self._last_flush < interval:
+                return
+            self._last_flush = time.monotonic()
+            self.store.write(self.registry.snapshot())
+
+    def collect(self) -> str:
+        if self.store is None:
+            return self.registry.render(self.registry.snapshot())
+        self.flush()
+        return self.registry.render(self.registry.merge(self.store.read_all(self.registry)))
+
+    def view(self):
+        return Response(self.collect(), status=200, headers={'Content-Type': CONTENT_TYPE})
+
+
+def instrument_pool(engine, histogram: Histogram):
+    """
+    time the checkouts of the engine's connection pool. the pool has no event fired before
+    a checkout starts, so Pool.connect is wrapped; it runs on every request because
+    the pool is replaced when the engine is disposed
+    """
+    pool = engine.pool
+    if getattr(pool, '_checkout_timed', False):
+        return
+    connect = pool.connect
+
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    pool.connect = timed_connect
+    pool._checkout_timed = True
+
+
+metrics = Metrics()
@@ -1,24 +1,194 @@
+import base64
+import heapq
+import itertools
+import json
+from datetime import datetime, timedelta
+from operator import attrgetter, itemgetter
+
+from sqlalchemy import and_, event, func, literal, or_, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.attributes import set_committed_value
+
 from app import db
 
+from .cache import user_cache
+from .email_filter import email_filter
+from .group_commit import group_committer
+from .passwords import password_hasher, check_password
+from .search import create_search_index, drop_search_index, prefix_criterion, substring_criterion
+from .sharding import user_shards, ShardedQueryProperty
 from .utils import get_md5
 
 
+class EmailAlreadyExists(Exception):
+    """raised when a write hits the unique constraint on auth_user.email"""
+
+
+class UserModified(Exception):
+    """raised when a conditional write finds the user changed since the version it expected"""
+
+
+def raise_for_duplicate_email(exc: IntegrityError):
+    message = str(exc.orig)
+    if 'auth_user.email' in message or 'auth_user_email' in message or 'auth_user_shard.email' in message:
+        raise EmailAlreadyExists(message) from exc
+
+
+def user_session():
+    """the session of the users, the sharded session when USER_SHARDS is set"""
+    return user_shards.session if user_shards.enabled else db.session
+
+
+def write_users(write):
+    """
+    run write(session) and commit it, translating a violation of the unique email constraint
+    into EmailAlreadyExists. the database is the source of truth for uniqueness, which keeps
+    concurrent writers correct without a SELECT before every write.
+    with group commit enabled the write is queued onto the writer thread and committed
+    together with the writes of concurrent requests
+    :return: what write returned
+    """
+    try:
+        if group_committer.enabled:
+            return group_committer.submit(write)
+        session = user_session()
+        result = write(session)
+        session.commit()
+        return result
+    except IntegrityError as exc:
+        user_session().rollback()
+        raise_for_duplicate_email(exc)
+        raise
+
+
 class Base(db.Model):
 
     __abstract__ = True
 
     id  = db.Column(db.Integer, primary_key=True)
-    date_created  = db.Column(db.DateTime,  default=db.func.current_timestamp())
-    date_modified = db.Column(db.DateTime,  default=db.func.current_timestamp(),
-                              onupdate=db.func.current_timestamp())
+    # set in python (utc, microseconds) rather than by sqlite's CURRENT_TIMESTAMP, which only
+    # has seconds: date_modified versions the rows for the ETags
+    date_created  = db.Column(db.DateTime,  default=datetime.utcnow, index=True)
+    # indexed for the change feed, in sqlite the index also holds the id (the rowid)
+    date_modified = db.Column(db.DateTime,  default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+
+# columns of the public representation of a user (to_dict), in order
+USER_FIELDS = ('first_name', 'email', 'uuid')
+
+# columns the users list can be sorted by
+SORT_COLUMNS = ('id', 'email', 'first_name', 'date_created', 'date_modified')
+
+# kinds of change in the feed, at the same date_modified the users come before the tombstones
+CHANGED = 0
+DELETED = 1
+
+# largest value of a sqlite INTEGER, bigger ids cannot even be compared
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def parse_id(value) -> int:
+    """:raise ValueError: when value is not an integer sqlite can store"""
+    id = int(value)
+    if not -MAX_INTEGER - 1 <= id <= MAX_INTEGER:
+        raise ValueError('Id out of range {!r}'.format(value))
+    return id
+
+
+def encode_change_token(key: tuple) -> str:
+    """opaque checkpoint of the change feed from the (date, kind, id) key of the last change"""
+    date, kind, id = key
+    return base64.urlsafe_b64encode('{}|{}|{}'.format(date.isoformat(), kind, id).encode()).decode()
+
+
+def decode_change_token(token: str) -> tuple:
+    """:raise ValueError: when the token was not made by encode_change_token"""
+    try:
+        date, kind, id = base64.urlsafe_b64decode(token.encode()).decode().split('|')
+        return datetime.fromisoformat(date), int(kind), parse_id(id)
+    except (TypeError, UnicodeError, ValueError) as exc:
+        raise ValueError('Invalid change token {!r}'.format(token)) from exc
+
+
+def encode_cursor(key: tuple) -> str:
+    """
+    opaque cursor of a users page sorted by another column than the id, or by descending id,
+    from the key of its last user
+    """
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    """:raise ValueError: when the cursor was not made by encode_cursor for this sort"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if sort.lstrip('-') == 'id':
+            id, = values
+            return (parse_id(id),)
+        value, id = values
+        if isinstance(getattr(User, sort.lstrip('-')).type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        elif not isinstance(value, str):
+            raise TypeError('Expected a string, got {!r}'.format(value))
+        return value, parse_id(id)
+    except (TypeError, UnicodeError, ValueError) as exc:
+        raise ValueError('Invalid cursor {!r}'.format(cursor)) from exc
+
+
+def after_key(date_column, id_column, kind: int, key: tuple):
+    """sql condition selecting the rows of `kind` that come after `key` in the change feed"""
+    date, key_kind, id = key
+    if kind == key_kind:
+        return or_(date_column > date, and_(date_column == date, id_column > id))
+    if kind > key_kind:
+        return date_column >= date
+    return date_column > date
+
+
+class UserRecord:
+    """
+    read only user row of the lightweight read path: a plain object with slots, no identity map,
+    instrumentation or session. holds the columns that were selected, to_dict and etag match User
+    """
+
+    __slots__ = ('id', 'date_created', 'date_modified', 'first_name', 'uuid', 'email', 'password')
+
+    def __init__(self, **columns):
+        for name, value in columns.items():
+            setattr(self, name, value)
+
+    @property
+    def etag(self) -> str:
+        return get_md5(data='{}:{}'.format(self.id, self.date_modified))
+
+    def to_dict(self, fields: tuple = USER_FIELDS):
+        return {name: getattr(self, name) for name in fields}
+
+
+def select_records(statement, key=None, reverse: bool = False, shard_ids=None):
+    """
+    run a core select of auth_user columns and map the rows to UserRecords. sharded users are
+    read from `shard_ids` (every shard by default) and merged in the order of `key`
+    """
+    session = user_session()
+    if not user_shards.enabled:
+        return (UserRecord(**row) for row in session.execute(statement))
+    shard_ids = range(user_shards.count) if shard_ids is None else shard_ids
+    records = [(UserRecord(**row) for row in session.execute(statement, shard_id=shard_id)) for shard_id in shard_ids]
+    return heapq.merge(*records, key=key, reverse=reverse)
 
 
 class User(Base):
 
     __tablename__ = 'auth_user'
 
+    # reads the shard(s) of the query when the users are sharded
+    query = ShardedQueryProperty()
+
     # User Name
-    first_name = db.Column(db.String(128),  nullable=False)
+    first_name = db.Column(db.String(128),  nullable=False, index=True)
 
     uuid = db.Column(db.String, unique=True)
     email = db.Column(db.String(128),  nullable=False, unique=True)
@@ -27,40 +197,291 @@ class User(Base):
     def __repr__(self):
         return self.email
 
-    def update_user(self, first_name, email, password):
+    @property
+    def etag(self) -> str:
+        """version of the user, changes with every write"""
+        return get_md5(data='{}:{}'.format(self.id, self.date_modified))
+
+    def update_user(self, first_name, email, password, if_modified_at: datetime = None):
+        """
+        :param if_modified_at: only update the user if its date_modified is still this one,
+            otherwise raise UserModified
+        """
+        changes = {}
         if first_name:
-            self.first_name = first_name
+            changes['first_name'] = first_name
         if email:
-            self.email = email
+            changes['email'] = email
         if password:
-            self.password = get_md5(password)
-        db.session.add(self)
-        db.session.commit()
+            changes['password'] = password_hasher.hash(password)
+        if changes:
+            uuid = self.uuid
+
+            def update(session):
+                query = session.query(User).filter_by(uuid=uuid)
+                if if_modified_at is not None:
+                    query = query.filter(User.date_modified == if_modified_at)
+                user = query.first()
+                if user is None:
+                    raise UserModified(uuid)
+                for name, value in changes.items():
+                    setattr(user, name, value)
+                session.flush()
+                return user.date_modified
+
+            changes['date_modified'] = write_users(update)
+            for name, value in changes.items():
+                set_committed_value(self, name, value)
+        user_cache.invalidate(self.uuid)
+        email_filter.add(self.email)
+
+    def check_password(self, password: str) -> bool:
+        """
+        verify a password against the stored hash, hashes made with an older algorithm
+        or cost (including the legacy md5 digests) are upgraded when the password matches
+        """
+        if not check_password(password, self.password):
+            return False
+        if password_hasher.needs_rehash(self.password):
+            uuid, encoded, rehashed = self.uuid, self.password, password_hasher.hash(password)
+
+            def rehash(session):
+                # unless the password was changed in the meantime
+                user = session.query(User).filter_by(uuid=uuid, password=encoded).first()
+                if user is None:
+                    return None
+                user.password = rehashed
+                session.flush()
+                return user.date_modified
+
+            date_modified = write_users(rehash)
+            if date_modified is not None:
+                set_committed_value(self, 'password', rehashed)
+                set_committed_value(self, 'date_modified', date_modified)
+                user_cache.invalidate(uuid)
+        return True
+
+    def to_dict(self, fields: tuple = USER_FIELDS):
+        return {name: getattr(self, name) for name in fields}
 
-    def to_dict(self):
-        return {
-            'first_name': self.first_name,
-            'email': self.email,
-            'uuid': self.uuid,
-        }
+    @staticmethod
+    def get_by_uuid(uuid: str, fields: tuple = USER_FIELDS):
+        """
+        the user with this uuid, None when there is none. only the `fields`
+        and what its etag needs are read, the password hash is left in the database
+        """
+        return User.query.options(load_only(*fields, 'date_modified')).filter_by(uuid=uuid).first()
 
     @staticmethod
     def create_user(first_name, email, password):
-        user = User(
-            first_name=first_name,
-            email=email,
-            password=get_md5(password),
-            uuid=get_md5(data='{}:{}'.format(first_name, email))
-        )
-        db.session.add(user)
-        db.session.commit()
+        password = password_hasher.hash(password)
+        uuid = get_md5(data='{}:{}'.format(first_name, email))
+
+        def insert(session):
+            user = User(first_name=first_name, email=email, password=password, uuid=uuid)
+            session.add(user)
+            return user
+
+        user = write_users(insert)
+        user_cache.invalidate(user.uuid)
+        email_filter.add(user.email)
         return user
 
+    @staticmethod
+    def bulk_create_users(users: list) -> list:
+        """
+        insert many users with one executemany in a single transaction,
+        the users are expected to be validated already
+        :param users: list of dicts with the keys first_name, email and password
+        :return: the to_dict() representation of the created users
+        """
+        if not users:
+            return []
+        passwords = password_hasher.hash_many([user['password'] for user in users])
+        rows = [
+            {
+                'first_name': user['first_name'],
+                'email': user['email'],
+                'password': password,
+                'uuid': get_md5(data='{}:{}'.format(user['first_name'], user['email'])),
+            }
+            for user, password in zip(users, passwords)
+        ]
+        write_users(lambda session: session.bulk_insert_mappings(User, rows))
+        for row in rows:
+            user_cache.invalidate(row['uuid'])
+            email_filter.add(row['email'])
+        return [{'first_name': row['first_name'], 'email': row['email'], 'uuid': row['uuid']} for row in rows]
+
+    @staticmethod
+    def get_record(uuid: str, fields: tuple = USER_FIELDS):
+        """get_by_uuid with a core select, the user is a UserRecord"""
+        columns = User.__table__.c
+        statement = select([columns.id, columns.date_modified] + [columns[name] for name in fields]) \
+            .where(columns.uuid == uuid).limit(1)
+        shard_ids = [user_shards.shard_of(uuid)] if user_shards.enabled else None
+        return next(iter(select_records(statement, shard_ids=shard_ids)), None)
+
+    @staticmethod
+    def search_criteria(email: str = None, first_name: str = None, text: str = None,
+                        created_after: datetime = None, created_before: datetime = None,
+                        modified_after: datetime = None, modified_before: datetime = None) -> list:
+        """
+        filters of the users list, each answered by an index: prefixes of the email and first name,
+        `text` contained in either of them (the fts index) and ranges of the creation and modification dates
+        """
+        criteria = []
+        if email:
+            criteria.append(prefix_criterion(User.email, email))
+        if first_name:
+            criteria.append(prefix_criterion(User.first_name, first_name))
+        if text:
+            criteria.append(substring_criterion(
+                User.id, (User.first_name, User.email), text, db.engine.dialect.name == 'sqlite'))
+        for column, after, before in ((User.date_created, created_after, created_before),
+                                      (User.date_modified, modified_after, modified_before)):
+            if after is not None:
+                criteria.append(column > after)
+            if before is not None:
+                criteria.append(column < before)
+        return criteria
+
+    @staticmethod
+    def search(criteria: list = (), sort: str = 'id', after: tuple = None, limit: int = 100,
+               fields: tuple = None, records: bool = False) -> (list, tuple):
+        """
+        keyset pagination of the users matching `criteria`, ordered by the `sort` column
+        ('-' first for descending) then by id
+        :param after: the key of the last user of the previous page, (value of the sort column, id)
+            or (id,) when sorting by id
+        :param fields: only read these columns (and the sort key), every column when None
+        :param records: run the query as a core select returning UserRecords instead of Users
+        :return: the users and the key of the next page (None when this is the last page)
+        """
+        name = sort.lstrip('-')
+        descending = sort != name
+        names = ('id',) if name == 'id' else (name, 'id')
+        columns = [getattr(User, column) for column in names]
+        query = User.query.filter(*criteria)
+        if fields is not None and not records:
+            query = query.options(load_only(*set(fields) | set(names)))
+        if after is not None:
+            key = tuple_(*columns) if len(columns) > 1 else columns[0]
+            bound = tuple_(*(literal(value, column.type) for value, column in zip(after, columns))) \
+                if len(columns) > 1 else after[0]
+            query = query.filter(key < bound if descending else key > bound)
+        query = query.order_by(*(column.desc() if descending else column for column in columns)).limit(limit + 1)
+        key = attrgetter(*names) if len(names) > 1 else (lambda user: (user.id,))
+        if records:
+            selected = names + tuple(name for name in fields or UserRecord.__slots__ if name not in names)
+            statement = query.with_entities(*(getattr(User, name) for name in selected)).statement
+            users = select_records(statement, key, descending)
+        else:
+            users = user_shards.merge(query, key=key, reverse=descending)
+        users = list(itertools.islice(users, limit + 1))
+        if len(users) > limit:
+            users = users[:limit]
+            return users, key(users[-1])
+        return users, None
+
+    @staticmethod
+    def list_version(after: int = 0) -> (str, datetime):
+        """
+        version of the users with id greater than `after`, read with one aggregate query
+        (per shard) and the date of the last deletion: it changes when one of them is created, updated or deleted
+        :return: the etag and the latest date_modified or date_deleted
+        """
+        query = User.query.filter(User.id > after).with_entities(
+            func.count(User.id), func.max(User.id), func.max(User.date_modified))
+        rows = query.all()
+        count = sum(row[0] for row in rows)
+        last_id = max((row[1] for row in rows if row[1] is not None), default=None)
+        last_deleted = select([func.max(user_tombstone.c.date_deleted)])
+        if after:
+            last_deleted = last_deleted.where(user_tombstone.c.user_id > after)
+        dates = [row[2] for row in rows] + [user_session().execute(last_deleted).scalar()]
+        last_modified = max((date for date in dates if date is not None), default=None)
+        return get_md5(data='{}:{}:{}:{}'.format(after, count, last_id, last_modified)), last_modified
+
+    @staticmethod
+    def iter_rows(columns: tuple, batch_size: int = 1000):
+        """
+        iterate over all the users ordered by id as tuples of the `columns` (names of User columns),
+        fetching `batch_size` rows at a time from the database cursor instead of loading the whole table.
+        sharded users are read from all the shards side by side. for the streamed list and the exports
+        """
+        query = User.query.with_entities(User.id, *(getattr(User, name) for name in columns))
+        rows = user_shards.merge(query.order_by(User.id).yield_per(batch_size), key=itemgetter(0))
+        return (tuple(row)[1:] for row in rows)
+
+    @staticmethod
+    def get_changes(since: tuple = None, limit: int = 100, settle_time: float = 0) -> (list, tuple):
+        """
+        the users created, updated (CHANGED) or deleted (DELETED) after the `since` key of the feed,
+        in the order of their date_modified or date_deleted. changes younger than `settle_time` seconds
+        are held back: a write takes its date before it waits for the database lock, so it can commit
+        after a write dated later
+        :return: up to `limit` (key, kind, data) tuples and whether more changes follow
+        """
+        until = datetime.utcnow() - timedelta(seconds=settle_time)
+        query = User.query.with_entities(User.date_modified, User.id, User.first_name, User.email, User.uuid) \
+            .filter(User.date_modified <= until)
+        if since is not None:
+            query = query.filter(after_key(User.date_modified, User.id, CHANGED, since))
+        query = query.order_by(User.date_modified, User.id).limit(limit + 1)
+        changed = (
+            ((date, CHANGED, id), CHANGED, {'first_name': first_name, 'email': email, 'uuid': uuid})
+            for date, id, first_name, email, uuid in user_shards.merge(query, key=itemgetter(0, 1))
+        )
+        tombstones = select([user_tombstone]).where(user_tombstone.c.date_deleted <= until) \
+            .order_by(user_tombstone.c.date_deleted, user_tombstone.c.id).limit(limit + 1)
+        if since is not None:
+            tombstones = tombstones.where(
+                after_key(user_tombstone.c.date_deleted, user_tombstone.c.id, DELETED, since))
+        deleted = (
+            ((row.date_deleted, DELETED, row.id), DELETED, {'email': row.email, 'uuid': row.uuid})
+            for row in user_session().execute(tombstones)
+        )
+        changes = list(itertools.islice(heapq.merge(changed, deleted, key=itemgetter(0)), limit + 1))
+        return changes[:limit], len(changes) > limit
+
     @staticmethod
     def delete_by_email(email: str) -> (bool, dict):
-        user = User.query.filter_by(email=email).first()
-        if not user:
+        def delete(session):
+            user = session.query(User).filter_by(email=email).first()
+            if not user:
+                return None
+            session.delete(user)
+            # leaves the deletion in the change feed
+            session.execute(user_tombstone.insert().values(user_id=user.id, email=user.email, uuid=user.uuid))
+            return user.to_dict()
+
+        data = write_users(delete)
+        if data is None:
             return False, {}
-        db.session.delete(user)
-        db.session.commit()
-        return True, user.to_dict()
+        user_cache.invalidate(data['uuid'])
+        return True, data
+
+
+# email -> shard lookup of the sharded users, kept on the primary database.
+# its id is the id of the user, unique across the shards
+user_shard = db.Table(
+    'auth_user_shard',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('email', db.String(128), nullable=False, unique=True),
+    db.Column('shard', db.Integer, nullable=False),
+)
+
+# the fts index of the users is created and dropped with their table (on every shard)
+event.listen(User.__table__, 'after_create', lambda target, connection, **kw: create_search_index(connection))
+event.listen(User.__table__, 'before_drop', lambda target, connection, **kw: drop_search_index(connection))
+
+# deleted users, for the change feed. kept on the primary database
+user_tombstone = db.Table(
+    'auth_user_tombstone',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('user_id', db.Integer, nullable=False),
+    db.Column('email', db.String(128), nullable=False),
+    db.Column('uuid', db.String),
+    db.Column('date_deleted', db.DateTime, default=datetime.utcnow, nullable=False, index=True),
+)
@@ -0,0 +1,148 @@
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils import app_extension
+
+PBKDF2_SHA256 = 'pbkdf2_sha256'
+SCRYPT = 'scrypt'
+ALGORITHMS = (PBKDF2_SHA256, SCRYPT)
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+
+def _pbkdf2_sha256(password: str, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations, KEY_SIZE)
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=2 * 128 * n * r * p, dklen=KEY_SIZE)
+
+
+def make_password(password: str, algorithm: str = PBKDF2_SHA256, params: tuple = (260000,), salt: bytes = None) -> str:
+    """
+    hash a password into a versioned string that records the algorithm and its cost:
+    pbkdf2_sha256$<iterations>$<salt>$<hash> or scrypt$<n>$<r>$<p>$<salt>$<hash>
+    """
+    salt = salt or os.urandom(SALT_SIZE)
+    if algorithm == PBKDF2_SHA256:
+        key = _pbkdf2_sha256(password, salt, *params)
+    elif algorithm == SCRYPT:
+        key = _scrypt(password, salt, *params)
+    else:
+        raise ValueError('Unknown password hashing algorithm {}'.format(algorithm))
+    return '$'.join([algorithm] + [str(param) for param in params] + [salt.hex(), key.hex()])
+
+
+def parse_password(encoded: str) -> (str, tuple):
+    """
+    :return: the algorithm and cost parameters of a hash made by make_password,
+    hashes without a version prefix are the legacy unsalted md5 digests
+    """
+    if '$' not in encoded:
+        return 'md5', ()
+    algorithm, *params, _, _ = encoded.split('$')
+    return algorithm, tuple(int(param) for param in params)
+
+
+def check_password(password: str, encoded: str) -> bool:
+    if '$' not in encoded:
+        return hmac.compare_digest(hashlib.md5(password.encode()).hexdigest(), encoded)
+    algorithm, *params, salt, key = encoded.split('$')
+    candidate = make_password(password, algorithm, tuple(int(param) for param in params), bytes.fromhex(salt))
+    return hmac.compare_digest(candidate.rsplit('$', 1)[1], key)
+
+
+class PasswordHasher:
+    """
+    hashes passwords with the algorithm and cost from the application config.
+    with PASSWORD_HASH_WORKERS > 0 the work runs on a process pool so a slow KDF
+    does not keep the request threads waiting on the GIL, at most
+    PASSWORD_HASH_MAX_PENDING passwords are queued on the pool at any time
+    """
+
+    def __init__(self):
+        self.algorithm = PBKDF2_SHA256
+        self.params = (260000,)
+        self.workers = 0
+        self._executor = None
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_ALGORITHM', PBKDF2_SHA256)
+        app.config.setdefault('PASSWORD_PBKDF2_ITERATIONS', 260000)
+        app.config.setdefault('PASSWORD_SCRYPT_N', 2 ** 14)
+        app.config.setdefault('PASSWORD_SCRYPT_R', 8)
+        app.config.setdefault('PASSWORD_SCRYPT_P', 1)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 0)
+        app.config.setdefault('PASSWORD_HASH_MAX_PENDING', 64)
+        self.configure(
+            algorithm=app.config['PASSWORD_HASH_ALGORITHM'],
+            params=self.params_from_config(app.config),
+            workers=app.config['PASSWORD_HASH_WORKERS'],
+            max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+        )
+        app.extensions['password_hasher'] = self
+
+    @staticmethod
+    def params_from_config(config) -> tuple:
+        if config['PASSWORD_HASH_ALGORITHM'] == SCRYPT:
+            return config['PASSWORD_SCRYPT_N'], config['PASSWORD_SCRYPT_R'], config['PASSWORD_SCRYPT_P']
+        return (config['PASSWORD_PBKDF2_ITERATIONS'],)
+
+    def configure(self, algorithm: str, params: tuple, workers: int = 0, max_pending: int = 64):
+        if algorithm not in ALGORITHMS:
+            raise ValueError('Unknown password hashing algorithm {}'.format(algorithm))
+        self.shutdown()
+        self.algorithm = algorithm
+        self.params = tuple(params)
+        self.workers = workers
+        self._pending = threading.BoundedSemaphore(max_pending) if workers else None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # created on first use, the workers are spawned rather than forked
+        # so they never inherit open database connections or locks
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def hash(self, password: str) -> str:
+        if not self.workers:
+            return make_password(password, self.algorithm, self.params)
+        with self._pending:
+            return self.executor.submit(make_password, password, self.algorithm, self.params).result()
+
+    def hash_many(self, passwords: list) -> list:
+        if not self.workers:
+            return [make_password(password, self.algorithm, self.params) for password in passwords]
+        # every password takes its place among the pending ones, a big batch waits for free slots
+        futures = []
+        for password in passwords:
+            self._pending.acquire()
+            try:
+                future = self.executor.submit(make_password, password, self.algorithm, self.params)
+            except BaseException:
+                self._pending.release()
+                raise
+            future.add_done_callback(lambda future: self._pending.release())
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def needs_rehash(self, encoded: str) -> bool:
+        return parse_password(encoded) != (self.algorithm, self.params)
+
+
+password_hasher = app_extension('password_hasher')
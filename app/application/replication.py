@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import threading
+
+from sqlalchemy.engine.url import make_url
+
+
+def sqlite_path(app, uri: str) -> str:
+    """the file of a sqlite uri, relative paths are resolved like flask-sqlalchemy does"""
+    url = make_url(uri)
+    if not url.drivername.startswith('sqlite') or url.database in (None, '', ':memory:'):
+        raise ValueError('{} is not a sqlite database file'.format(uri))
+    return os.path.join(app.root_path, url.database)
+
+
+class SQLiteReplicator:
+    """
+    stand-in for database replication in development and tests: copies the primary
+    sqlite file onto each replica file with the online backup api, so the replicas
+    lag behind the primary by up to one interval like asynchronous replicas do
+    """
+
+    def __init__(self, primary: str, replicas: list):
+        self.primary = primary
+        self.replicas = list(replicas)
+
+    @classmethod
+    def from_app(cls, app):
+        return cls(
+            sqlite_path(app, app.config['SQLALCHEMY_DATABASE_URI']),
+            [sqlite_path(app, uri) for uri in app.config['DATABASE_REPLICA_URIS']],
+        )
+
+    def sync(self):
+        source = sqlite3.connect(self.primary)
+        try:
+            for replica in self.replicas:
+                target = sqlite3.connect(replica)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+        finally:
+            source.close()
+
+    def run(self, interval: float = 1.0, stop: threading.Event = None):
+        """sync every `interval` seconds until `stop` is set"""
+        stop = stop or threading.Event()
+        while True:
+            self.sync()
+            if stop.wait(interval):
+                return
@@ -0,0 +1,75 @@
+import sys
+
+from sqlalchemy import column, literal_column, select, table
+
+# fts5 index of the first names and emails of auth_user. the trigram tokenizer matches
+# any substring of at least MIN_INDEXED_LENGTH characters, case insensitively
+FTS_TABLE = 'auth_user_fts'
+MIN_INDEXED_LENGTH = 3
+
+CREATE_STATEMENTS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS auth_user_fts USING fts5("
+    "first_name, email, content='auth_user', content_rowid='id', tokenize='trigram')",
+    # external content table, the triggers keep it in step with auth_user
+    "CREATE TRIGGER IF NOT EXISTS auth_user_fts_insert AFTER INSERT ON auth_user BEGIN "
+    "INSERT INTO auth_user_fts(rowid, first_name, email) VALUES (new.id, new.first_name, new.email); END",
+    "CREATE TRIGGER IF NOT EXISTS auth_user_fts_delete AFTER DELETE ON auth_user BEGIN "
+    "INSERT INTO auth_user_fts(auth_user_fts, rowid, first_name, email) "
+    "VALUES ('delete', old.id, old.first_name, old.email); END",
+    "CREATE TRIGGER IF NOT EXISTS auth_user_fts_update AFTER UPDATE OF first_name, email ON auth_user BEGIN "
+    "INSERT INTO auth_user_fts(auth_user_fts, rowid, first_name, email) "
+    "VALUES ('delete', old.id, old.first_name, old.email); "
+    "INSERT INTO auth_user_fts(rowid, first_name, email) VALUES (new.id, new.first_name, new.email); END",
+)
+
+fts = table(FTS_TABLE, column('rowid'))
+
+
+def create_search_index(connectable) -> bool:
+    """
+    create the fts table and its triggers where they are missing (sqlite only),
+    a new fts table is filled from auth_user
+    :return: whether the fts table was created
+    """
+    if connectable.dialect.name != 'sqlite':
+        return False
+    exists = connectable.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)).first() is not None
+    for statement in CREATE_STATEMENTS:
+        connectable.execute(statement)
+    if not exists:
+        connectable.execute("INSERT INTO auth_user_fts(auth_user_fts) VALUES ('rebuild')")
+    return not exists
+
+
+def drop_search_index(connectable):
+    if connectable.dialect.name == 'sqlite':
+        connectable.execute('DROP TABLE IF EXISTS {}'.format(FTS_TABLE))
+
+
+def prefix_criterion(column, prefix: str):
+    """column starts with prefix, as a range the index of the column can answer"""
+    # the last character is incremented, those that cannot be (U+10FFFF) are dropped
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return column >= prefix
+    following = ord(stem[-1]) + 1
+    if 0xD800 <= following <= 0xDFFF:
+        # surrogates cannot be encoded
+        following = 0xE000
+    return (column >= prefix) & (column < stem[:-1] + chr(following))
+
+
+def substring_criterion(id_column, columns, text: str, use_index: bool):
+    """
+    one of `columns` contains `text`: looked up in the fts index when it is usable
+    (sqlite, text long enough for a trigram), otherwise a LIKE scan
+    """
+    if use_index and len(text) >= MIN_INDEXED_LENGTH:
+        query = '"{}"'.format(text.replace('"', '""'))
+        return id_column.in_(select([fts.c.rowid]).where(literal_column(FTS_TABLE).op('MATCH')(query)))
+    criterion = None
+    for column in columns:
+        contains = column.contains(text, autoescape=True)
+        criterion = contains if criterion is None else criterion | contains
+    return criterion
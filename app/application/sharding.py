@@ -0,0 +1,277 @@
+import heapq
+from collections import defaultdict
+
+from flask import _app_ctx_stack
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import event, orm, select
+from sqlalchemy.ext.horizontal_shard import ShardedSession, ShardedQuery
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BindParameter, BooleanClauseList, ClauseList, Grouping
+
+from app import db
+from .database import create_missing_indexes
+from .search import create_search_index
+from .utils import app_extension
+
+# shard id of SQLALCHEMY_DATABASE_URI, where the email -> shard lookup table lives
+PRIMARY = 'primary'
+
+
+def shard_bind_key(index: int) -> str:
+    return 'user_shard_{}'.format(index)
+
+
+class UserShardQuery(BaseQuery, ShardedQuery):
+    """
+    a query of every shard it may match, the results of the shards are concatenated.
+    count() adds up the count of each shard
+    """
+
+    def count(self):
+        if self._shard_id is not None:
+            return super().count()
+        return sum(self.set_shard(shard_id).count() for shard_id in self.query_chooser(self))
+
+
+class UserShardSession(ShardedSession):
+    """
+    session storing each user on the shard of its uuid and keeping auth_user_shard,
+    the email -> shard lookup of the primary database, in step with the writes.
+    the lookup also hands out the user ids so they stay unique across shards
+    """
+
+    def __init__(self, shards, **options):
+        super().__init__(
+            shard_chooser=shards.shard_chooser,
+            id_chooser=shards.id_chooser,
+            query_chooser=shards.query_chooser,
+            shards=shards.engines(),
+            query_cls=UserShardQuery,
+            **options
+        )
+        self.shards = shards
+
+    def bulk_insert_mappings(self, mapper, mappings, *args, **kwargs):
+        from .models import User, user_shard as lookup
+
+        if mapper is not User:
+            return super().bulk_insert_mappings(mapper, mappings, *args, **kwargs)
+        if not mappings:
+            return
+        primary = self.connection(shard_id=PRIMARY)
+        primary.execute(lookup.insert(), [
+            {'email': row['email'], 'shard': self.shards.shard_of(row['uuid'])} for row in mappings
+        ])
+        ids = {email: user_id for email, user_id in primary.execute(
+            select([lookup.c.email, lookup.c.id]).where(lookup.c.email.in_([row['email'] for row in mappings])))}
+        rows_by_shard = defaultdict(list)
+        for row in mappings:
+            rows_by_shard[self.shards.shard_of(row['uuid'])].append(dict(row, id=ids[row['email']]))
+        for shard_id, rows in rows_by_shard.items():
+            self.connection(shard_id=shard_id).execute(User.__table__.insert(), rows)
+
+
+def update_lookup(session, flush_context, instances):
+    """before_flush: mirror the inserted, updated and deleted users in auth_user_shard"""
+    from .models import User, user_shard as lookup
+
+    primary = session.connection(shard_id=PRIMARY)
+    for user in session.new:
+        if isinstance(user, User):
+            result = primary.execute(lookup.insert().values(
+                email=user.email, shard=session.shards.shard_of(user.uuid)))
+            user.id = result.inserted_primary_key[0]
+    for user in session.dirty:
+        if isinstance(user, User) and get_history(user, 'email').added:
+            primary.execute(lookup.update().where(lookup.c.id == user.id).values(email=user.email))
+    for user in session.deleted:
+        if isinstance(user, User):
+            primary.execute(lookup.delete().where(lookup.c.id == user.id))
+
+
+event.listen(UserShardSession, 'before_flush', update_lookup)
+
+
+def equality_criteria(query, column) -> list:
+    """
+    the values `column` is compared to with == or IN in the top level AND of the query,
+    None when the query is not restricted on that column
+    """
+    where = query.whereclause
+    if where is None:
+        return None
+    if isinstance(where, BooleanClauseList) and where.operator is operators.and_:
+        clauses = where.clauses
+    else:
+        clauses = [where]
+    for clause in clauses:
+        left = getattr(clause, 'left', None)
+        if left is None or not left.compare(column):
+            continue
+        right = clause.right
+        if clause.operator is operators.eq and isinstance(right, BindParameter):
+            return [right.effective_value]
+        if clause.operator is operators.in_op:
+            if isinstance(right, BindParameter):
+                return list(right.effective_value)
+            if isinstance(right, Grouping) and isinstance(right.element, ClauseList):
+                values = [element.effective_value for element in right.element.clauses
+                          if isinstance(element, BindParameter)]
+                if len(values) == len(right.element.clauses):
+                    return values
+    return None
+
+
+class ShardedQueryProperty:
+    """Model.query using the sharded session when sharding is enabled"""
+
+    def __get__(self, obj, type):
+        if user_shards.enabled:
+            return user_shards.session.query(type)
+        return type.query_class(orm.class_mapper(type), session=db.session())
+
+
+class UserShards:
+    """
+    hash sharding of auth_user over the USER_SHARDS databases: a user lives on shard
+    int(uuid, 16) % len(USER_SHARDS). queries on the uuid or the email go to a single shard,
+    the others are sent to every shard. disabled when USER_SHARDS is empty
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.count = 0
+        self._session = None
+
+    def init_app(self, app):
+        app.config.setdefault('USER_SHARDS', [])
+        shards = app.config['USER_SHARDS']
+        self.enabled = bool(shards)
+        self.count = len(shards)
+        self.app = app
+        self._session = None
+        if shards:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.update((shard_bind_key(index), uri) for index, uri in enumerate(shards))
+            app.config['SQLALCHEMY_BINDS'] = binds
+            self._session = orm.scoped_session(
+                self.create_session({}), scopefunc=_app_ctx_stack.__ident_func__)
+        if 'user_shards' not in app.extensions:
+            app.teardown_appcontext(self.remove_session)
+        app.extensions['user_shards'] = self
+
+    @property
+    def session(self):
+        return self._session
+
+    def create_session(self, options: dict):
+        return orm.sessionmaker(class_=UserShardSession, shards=self, **options)
+
+    def remove_session(self, response_or_exc):
+        if self._session is not None:
+            self._session.remove()
+        return response_or_exc
+
+    def engine(self, shard_id):
+        if shard_id == PRIMARY:
+            return db.get_engine(self.app)
+        return db.get_engine(self.app, bind=shard_bind_key(shard_id))
+
+    def engines(self) -> dict:
+        engines = {shard_id: self.engine(shard_id) for shard_id in range(self.count)}
+        engines[PRIMARY] = self.engine(PRIMARY)
+        return engines
+
+    def shard_of(self, uuid: str) -> int:
+        return int(uuid, 16) % self.count
+
+    def shard_chooser(self, mapper, instance, clause=None):
+        from .models import User
+
+        if isinstance(instance, User):
+            return self.shard_of(instance.uuid)
+        return PRIMARY
+
+    def id_chooser(self, query, ident):
+        return list(range(self.count))
+
+    def query_chooser(self, query):
+        from .models import User, user_shard as lookup
+
+        if query._bind_mapper() is None or query._bind_mapper().class_ is not User:
+            return [PRIMARY]
+        uuids = equality_criteria(query, User.__table__.c.uuid)
+        if uuids is not None:
+            return sorted({self.shard_of(uuid) for uuid in uuids if uuid})
+        emails = equality_criteria(query, User.__table__.c.email)
+        if emails is not None:
+            if not emails:
+                return []
+            rows = query.session.connection(shard_id=PRIMARY).execute(
+                select([lookup.c.shard]).where(lookup.c.email.in_(emails)).distinct())
+            return sorted(shard for shard, in rows)
+        return list(range(self.count))
+
+    def merge(self, query, key, reverse: bool = False):
+        """
+        iterate over a query ordered by `key` (descending with `reverse`), with sharding
+        the ordered results of every shard are merged as they are read
+        """
+        if not self.enabled:
+            return iter(query)
+        return heapq.merge(*(query.set_shard(shard_id) for shard_id in range(self.count)), key=key, reverse=reverse)
+
+    def create_all(self):
+        from .models import User
+
+        for shard_id in range(self.count):
+            User.__table__.create(self.engine(shard_id), checkfirst=True)
+            create_missing_indexes(self.engine(shard_id), [User.__table__])
+            create_search_index(self.engine(shard_id))
+
+    def rebalance(self, from_primary: bool = False, batch_size: int = 1000) -> int:
+        """
+        move every user that is not on the shard of its uuid, after shards were added,
+        and with `from_primary` the users of an unsharded auth_user table.
+        users are copied to their shard and the lookup updated before they are deleted
+        from their old place, so an interrupted run can be repeated. writes must be stopped
+        :return: the number of users moved
+        """
+        from .models import User, user_shard as lookup
+
+        table = User.__table__
+        sources = list(range(self.count)) + ([PRIMARY] if from_primary else [])
+        moved = 0
+        for source_id in sources:
+            source = self.engine(source_id)
+            last_id = 0
+            while True:
+                rows = [dict(row) for row in source.execute(
+                    select([table]).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size))]
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                rows_by_shard = defaultdict(list)
+                for row in rows:
+                    shard_id = self.shard_of(row['uuid'])
+                    if shard_id != source_id:
+                        rows_by_shard[shard_id].append(row)
+                for shard_id, shard_rows in rows_by_shard.items():
+                    ids = [row['id'] for row in shard_rows]
+                    with self.engine(shard_id).begin() as target:
+                        target.execute(table.delete().where(table.c.id.in_(ids)))
+                        target.execute(table.insert(), shard_rows)
+                    with self.engine(PRIMARY).begin() as primary:
+                        primary.execute(lookup.delete().where(lookup.c.id.in_(ids)))
+                        primary.execute(lookup.insert(), [
+                            {'id': row['id'], 'email': row['email'], 'shard': shard_id} for row in shard_rows
+                        ])
+                    with source.begin() as connection:
+                        connection.execute(table.delete().where(table.c.id.in_(ids)))
+                    moved += len(shard_rows)
+        return moved
+
+
+user_shards = app_extension('user_shards')
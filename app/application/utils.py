@@ -1,18 +1,264 @@
+import csv
+import gzip
 import hashlib
+import itertools
 import json
-from flask import Response
+import zlib
+from datetime import datetime, timezone
+from flask import Response, stream_with_context, has_request_context, request, current_app
+from werkzeug.http import http_date, quote_etag
+from werkzeug.local import LocalProxy
 
+from app import db
+from .instrumentation import timed
 
-def json_response(data, status=200, headers={}):
-    serialized = json.dumps(data, indent=2, default=str)
-    headers["Content-Type"] = "application/json"
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
-    for key in headers.keys():
-        value = headers.pop(key)
-        headers[str(key)] = str(value)
+# flush streamed bodies to the client in chunks of roughly this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
 
-    return Response(serialized, status=status, headers=headers)
+# values of ?pretty= that turn on indented output
+PRETTY_VALUES = ('1', 'true', 'yes')
+
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b')
+
+# formats of the streamed exports and their content types
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# zlib window bits of the supported content encodings, in order of preference
+COMPRESSION_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def stdlib_json_encoder(data, pretty: bool = False) -> bytes:
+    if pretty:
+        return json.dumps(data, indent=2, default=str).encode()
+    return json.dumps(data, separators=(',', ':'), default=str).encode()
+
+
+def orjson_encoder(data, pretty: bool = False) -> bytes:
+    return orjson.dumps(data, default=str, option=orjson.OPT_INDENT_2 if pretty else 0)
+
+
+_json_encoder = orjson_encoder if orjson else stdlib_json_encoder
+
+
+def set_json_encoder(encoder):
+    """
+    replace the function used to serialize every json response,
+    the encoder is called as encoder(data, pretty) and must return bytes
+    :return: the previous encoder
+    """
+    global _json_encoder
+    previous, _json_encoder = _json_encoder, encoder
+    return previous
+
+
+def encode_json(data, pretty: bool = False) -> bytes:
+    return _json_encoder(data, pretty)
+
+
+def pretty_requested() -> bool:
+    return has_request_context() and request.args.get('pretty', '').lower() in PRETTY_VALUES
+
+
+@timed('serialization')
+def json_response(data, status=200, headers=None, pretty=None):
+    """
+    serialize data as compact json, pretty printed only when asked for with `pretty`
+    or the ?pretty=1 query parameter.
+    bytes are considered already encoded and sent as they are.
+    """
+    if isinstance(data, bytes):
+        serialized = data
+    else:
+        serialized = encode_json(data, pretty_requested() if pretty is None else pretty)
+
+    response_headers = {str(key): str(value) for key, value in (headers or {}).items()}
+    response_headers["Content-Type"] = "application/json"
+
+    return Response(serialized, status=status, headers=response_headers)
+
+
+def chunked(pieces):
+    """join a stream of byte strings into chunks of about STREAM_CHUNK_SIZE bytes"""
+    chunk = []
+    size = 0
+    for piece in pieces:
+        chunk.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def json_stream_response(items, status=200, headers=None):
+    """
+    stream an iterable as a json array without materializing it,
+    each item is serialized as soon as it is produced and sent in chunks of STREAM_CHUNK_SIZE
+    :param items: iterable of json serializable objects
+    :return: streamed flask response
+    """
+    def generate():
+        yield b'['
+        separator = b''
+        for item in items:
+            yield separator + encode_json(item)
+            separator = b','
+        yield b']'
+
+    return stream_response(chunked(generate()), 'application/json', status, headers)
+
+
+class _CSVLine:
+    """file-like target making csv.writer return the line it formats"""
+
+    def write(self, line):
+        return line
+
+
+def export_stream_response(fieldnames: tuple, rows, export_format: str, headers=None):
+    """
+    stream rows (tuples of the `fieldnames` values) as NDJSON, one json object per line,
+    or as CSV with a header line. like json_stream_response nothing is materialized
+    :param export_format: a key of EXPORT_FORMATS
+    """
+    if export_format == 'csv':
+        writer = csv.writer(_CSVLine())
+        lines = itertools.chain([fieldnames], rows)
+        pieces = (writer.writerow(row).encode() for row in lines)
+    else:
+        pieces = (encode_json(dict(zip(fieldnames, row))) + b'\n' for row in rows)
+    return stream_response(chunked(pieces), EXPORT_FORMATS[export_format], 200, headers)
+
+
+def stream_response(chunks, content_type: str, status=200, headers=None):
+    response_headers = {str(key): str(value) for key, value in (headers or {}).items()}
+    response_headers["Content-Type"] = content_type
+    return Response(stream_with_context(chunks), status=status, headers=response_headers)
+
+
+def validator_headers(etag: str, last_modified=None) -> dict:
+    """ETag and Last-Modified headers of a resource version"""
+    headers = {'ETag': quote_etag(etag)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+def not_modified(etag: str, last_modified=None) -> bool:
+    """
+    whether the client already has this version, from If-None-Match or,
+    when the request has none, If-Modified-Since (which only has seconds)
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status=304, headers=headers)
+
+
+def negotiate_encoding(encodings) -> str:
+    """the supported encoding of COMPRESSION_WBITS the client accepts best, None for identity"""
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = request.accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+@timed('compression')
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(data, level)
+    return zlib.compress(data, level)
+
+
+def compress_stream(chunks, encoding: str, level: int):
+    """compress the chunks of a streamed body one by one, each is flushed to the client as it comes"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, COMPRESSION_WBITS[encoding])
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # releases the request context held by a stream_with_context body
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    """
+    after_request: compress the response with the best encoding of Accept-Encoding.
+    bodies of COMPRESSION_MIMETYPES smaller than COMPRESSION_MIN_SIZE are sent as they are,
+    streamed bodies are always compressed, chunk by chunk
+    """
+    config = current_app.config
+    if (not config['COMPRESSION_ENABLED'] or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in config['COMPRESSION_MIMETYPES']):
+        return response
+    if not response.is_streamed and len(response.get_data()) < config['COMPRESSION_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(COMPRESSION_WBITS)
+    if encoding is None:
+        return response
+    level = config['COMPRESSION_LEVEL']
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress(response.get_data(), encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def parse_datetime(value: str) -> datetime:
+    """
+    an ISO 8601 date or date and time as a naive utc datetime, like the dates stored in the database
+    :raise ValueError: when the value is not ISO 8601
+    """
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
 
 
 def get_md5(data: str = ''):
     return hashlib.md5(data.encode()).hexdigest()
+
+
+def get_hash(data: str = '', algorithm: str = 'md5'):
+    return hashlib.new(algorithm, data.encode()).hexdigest()
+
+
+def hash_stream(stream, algorithm: str = 'md5', chunk_size: int = 64 * 1024):
+    """
+    hash a binary file-like object reading chunk_size bytes at a time,
+    so memory use does not depend on the size of the input
+    """
+    hasher = hashlib.new(algorithm)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def app_extension(name: str) -> LocalProxy:
+    """
+    the extension the current application registered as app.extensions[name],
+    outside of an application context the one of the application the models are bound to (db.app)
+    """
+    return LocalProxy(lambda: db.get_app().extensions[name])
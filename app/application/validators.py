@@ -1,30 +1,131 @@
 import re
 from collections import defaultdict
+from functools import partial
 from typing import List, Dict
 
-from app.application.models import User
+from app.application.email_filter import email_filter
+from app.application.instrumentation import timed
+from app.application.models import User, decode_change_token, SORT_COLUMNS, USER_FIELDS, MAX_INTEGER
+from app.application.utils import HASH_ALGORITHMS, EXPORT_FORMATS, parse_datetime
 
 EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
 
 
 def validate_email_format(email: str) -> (bool, str):
-    if not EMAIL_REGEX.match(email):
+    if not isinstance(email, str) or not EMAIL_REGEX.match(email):
         return False, 'Invalid Email format.'
     return True, ''
 
 
 def validate_email_already_exists(email: str):
+    if not email_filter.might_contain(email):
+        return True, ''
     if User.query.filter_by(email=email).first():
         return False, 'Email already exists.'
+    email_filter.record_false_positives(1)
     return True, ''
 
 
+def find_existing_emails(emails, use_filter: bool = True) -> set:
+    """
+    check many emails against the database with a single IN (...) query,
+    the emails the email filter has never seen are not sent to the database
+    :param use_filter: False sends every email to the database, the filter misses
+        the emails created by other processes since it was built
+    :return: the subset of emails that already exist
+    """
+    candidates = [email for email in emails if not use_filter or email_filter.might_contain(email)]
+    if not candidates:
+        return set()
+    existing = {email for email, in User.query.with_entities(User.email).filter(User.email.in_(candidates))}
+    if use_filter:
+        email_filter.record_false_positives(len(set(candidates) - existing))
+    return existing
+
+
 def validate_field_required(val):
     if val in [None, '']:
         return False, 'This field is required'
     return True, ''
 
 
+def validate_hash_algorithm(val):
+    if val not in HASH_ALGORITHMS:
+        return False, 'Must be one of {}.'.format(', '.join(HASH_ALGORITHMS))
+    return True, ''
+
+
+def validate_optional_export_format(val):
+    if val in [None, ''] or val in EXPORT_FORMATS:
+        return True, ''
+    return False, 'Must be one of {}.'.format(', '.join(EXPORT_FORMATS))
+
+
+def validate_optional_change_token(val):
+    if val in [None, '']:
+        return True, ''
+    try:
+        decode_change_token(val)
+    except ValueError:
+        return False, 'Invalid token.'
+    return True, ''
+
+
+def validate_optional_datetime(val):
+    if val in [None, '']:
+        return True, ''
+    try:
+        parse_datetime(val)
+    except ValueError:
+        return False, 'Must be an ISO 8601 date or date and time.'
+    return True, ''
+
+
+def validate_optional_sort(val):
+    if val in [None, ''] or val.lstrip('-') in SORT_COLUMNS:
+        return True, ''
+    return False, 'Must be one of {}, with a leading - for descending order.'.format(', '.join(SORT_COLUMNS))
+
+
+def validate_optional_fields(val):
+    if val in [None, '']:
+        return True, ''
+    unknown = [name for name in val.split(',') if name not in USER_FIELDS]
+    if unknown:
+        return False, 'Unknown fields {}, must be among {}.'.format(', '.join(unknown), ', '.join(USER_FIELDS))
+    return True, ''
+
+
+def validate_string_or_list_of_strings(val):
+    if isinstance(val, str) or val is None:
+        return True, ''
+    if isinstance(val, list) and all(isinstance(item, str) for item in val):
+        return True, ''
+    return False, 'Must be a string or a list of strings.'
+
+
+def is_ascii_digits(val) -> bool:
+    """only the digits 0-9, str.isdigit also accepts digits int() cannot parse such as superscripts"""
+    val = str(val)
+    return val.isascii() and val.isdecimal()
+
+
+def validate_optional_non_negative_integer(val):
+    if val in [None, '']:
+        return True, ''
+    if not is_ascii_digits(val) or int(val) > MAX_INTEGER:
+        return False, 'Must be a non-negative integer.'
+    return True, ''
+
+
+def validate_optional_positive_integer(val):
+    if val in [None, '']:
+        return True, ''
+    if not is_ascii_digits(val) or not 1 <= int(val) <= MAX_INTEGER:
+        return False, 'Must be a positive integer.'
+    return True, ''
+
+
 def run_validators(validators: List[Dict]) -> (bool, dict):
     """
     get a list of objects, each object should have the keys
@@ -40,3 +141,105 @@ def run_validators(validators: List[Dict]) -> (bool, dict):
             errors[validator_obj['field_name']].append(error_message)
 
     return errors
+
+
+class BatchCheck:
+    """
+    I/O bound check run once for the values of a field across all the validated items,
+    `find_invalid` gets the list of values and returns the set of values that fail
+    """
+
+    def __init__(self, find_invalid, message: str):
+        self.find_invalid = find_invalid
+        self.message = message
+
+
+class Field:
+    """
+    a field of a Schema. checks are validator functions (value) -> (is_valid, error_message)
+    or BatchCheck instances, optional fields are only checked when they have a value
+    """
+
+    def __init__(self, name: str, checks: list = (), required: bool = False, default=None,
+                 unique_in_batch: bool = False):
+        self.name = name
+        self.checks = tuple(checks)
+        self.required = required
+        self.default = default
+        self.unique_in_batch = unique_in_batch
+
+
+class Schema:
+    """
+    validation rules of a route, declared once and compiled into flat tuples when it is created.
+    the cheap checks of a field all run so the error messages are the same as run_validators,
+    the I/O bound checks come last and are skipped for fields that already have an error
+    """
+
+    def __init__(self, *fields: Field):
+        self.names = tuple(field.name for field in fields)
+        self._fields = tuple(
+            (
+                field.name,
+                field.default,
+                field.required,
+                ((validate_field_required,) if field.required else ()) + tuple(
+                    check for check in field.checks if not isinstance(check, BatchCheck)),
+                field.unique_in_batch,
+            )
+            for field in fields
+        )
+        self._batch_checks = tuple(
+            (field.name, field.required, check)
+            for field in fields for check in field.checks if isinstance(check, BatchCheck)
+        )
+
+    def validate(self, data, run_io: bool = True) -> (dict, dict):
+        """
+        :return: the values of the fields and the errors dictionary in the format {field1: [err1, err2]}
+        """
+        return self.validate_many([data], run_io)[0]
+
+    @timed('validation')
+    def validate_many(self, items: list, run_io: bool = True) -> list:
+        """
+        validate many items, each BatchCheck runs once for all of them
+        :return: a list of (values, errors) tuples in the order of the items
+        """
+        results = []
+        seen = {name: set() for name, _, _, _, unique in self._fields if unique}
+        for item in items:
+            item = item if isinstance(item, dict) else {}
+            values = {}
+            errors = {}
+            for name, default, required, checks, unique in self._fields:
+                value = values[name] = item.get(name, default)
+                if not required and value in (None, ''):
+                    continue
+                for check in checks:
+                    is_valid, error_message = check(value)
+                    if not is_valid:
+                        errors.setdefault(name, []).append(error_message)
+                if unique and name not in errors:
+                    if value in seen[name]:
+                        errors[name] = ['Duplicate {} in request.'.format(name)]
+                    seen[name].add(value)
+            results.append((values, errors))
+
+        if run_io:
+            for name, required, check in self._batch_checks:
+                pending = [
+                    (values, errors) for values, errors in results
+                    if name not in errors and (required or values[name] not in (None, ''))
+                ]
+                if not pending:
+                    continue
+                invalid = check.find_invalid([values[name] for values, _ in pending])
+                for values, errors in pending:
+                    if values[name] in invalid:
+                        errors.setdefault(name, []).append(check.message)
+        return results
+
+
+EMAIL_NOT_TAKEN = BatchCheck(find_existing_emails, 'Email already exists.')
+EMAIL_NOT_IN_DATABASE = BatchCheck(partial(find_existing_emails, use_filter=False), 'Email already exists.')
@@ -1,13 +1,103 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
-from flask import render_template, Blueprint, request
+from flask import render_template, Blueprint, request, current_app
 
-from app.application.models import User
-from .utils import json_response, get_md5
-from .validators import validate_email_format, validate_email_already_exists, validate_field_required, run_validators
+from app import db
+from app.application.admission import init_admission_control
+from app.application.cache import user_cache
+from app.application.database import read_bind, reads_own_writes
+from app.application.email_filter import email_filter
+from app.application.instrumentation import init_instrumentation
+from app.application.models import User, EmailAlreadyExists, UserModified, DELETED, USER_FIELDS, \
+    encode_change_token, decode_change_token, encode_cursor, decode_cursor
+from .utils import json_response, json_stream_response, encode_json, get_hash, hash_stream, compress_response, \
+    validator_headers, not_modified, not_modified_response, export_stream_response, EXPORT_FORMATS, parse_datetime, \
+    get_md5
+from .validators import Schema, Field, EMAIL_NOT_TAKEN, EMAIL_NOT_IN_DATABASE, validate_email_format, \
+    validate_hash_algorithm, validate_string_or_list_of_strings, validate_optional_non_negative_integer, \
+    validate_optional_positive_integer, validate_optional_export_format, validate_optional_change_token, \
+    validate_optional_datetime, validate_optional_sort, validate_optional_fields
 
 app_bp = Blueprint('application', __name__)
+# requests shed by admission control skip the instrumentation
+init_admission_control(app_bp)
+init_instrumentation(app_bp)
+# runs before the instrumentation's after_request, which then includes the compression time
+app_bp.after_request(compress_response)
+
+EMAIL_EXISTS_ERRORS = {'email': ['Email already exists.']}
+USER_MODIFIED_ERRORS = {'user': ['The user was modified since it was read.']}
+
+HASH_ALGORITHM_SCHEMA = Schema(
+    Field('algorithm', required=True, default='md5', checks=[validate_hash_algorithm]),
+)
+HASH_DATA_SCHEMA = Schema(
+    Field('data', required=True, checks=[validate_string_or_list_of_strings]),
+)
+CREATE_USER_SCHEMA = Schema(
+    Field('first_name', required=True),
+    Field('email', required=True, default='', checks=[validate_email_format, EMAIL_NOT_TAKEN]),
+    Field('password', required=True),
+)
+UPDATE_USER_SCHEMA = Schema(
+    Field('first_name'),
+    Field('email', default='', checks=[validate_email_format, EMAIL_NOT_TAKEN]),
+    Field('password'),
+)
+BULK_CREATE_USER_SCHEMA = Schema(
+    Field('first_name', required=True),
+    Field('email', required=True, default='', checks=[validate_email_format, EMAIL_NOT_TAKEN], unique_in_batch=True),
+    Field('password', required=True),
+)
+# the email filter did not know an email of the batch, checked against the database only
+BULK_CREATE_USER_RECHECK_SCHEMA = Schema(
+    Field('first_name', required=True),
+    Field('email', required=True, default='',
+          checks=[validate_email_format, EMAIL_NOT_IN_DATABASE], unique_in_batch=True),
+    Field('password', required=True),
+)
+USER_FIELDS_SCHEMA = Schema(
+    Field('fields', checks=[validate_optional_fields]),
+)
+LIST_USERS_SCHEMA = Schema(
+    Field('fields', checks=[validate_optional_fields]),
+    Field('after', checks=[validate_optional_non_negative_integer]),
+    Field('cursor'),
+    Field('limit', checks=[validate_optional_positive_integer]),
+    Field('sort', default='id', checks=[validate_optional_sort]),
+    Field('email'),
+    Field('first_name'),
+    Field('q'),
+    Field('created_after', checks=[validate_optional_datetime]),
+    Field('created_before', checks=[validate_optional_datetime]),
+    Field('modified_after', checks=[validate_optional_datetime]),
+    Field('modified_before', checks=[validate_optional_datetime]),
+)
+INVALID_CURSOR_ERRORS = {'cursor': ['Invalid cursor.']}
+USER_CHANGES_SCHEMA = Schema(
+    Field('since', checks=[validate_optional_change_token]),
+    Field('limit', checks=[validate_optional_positive_integer]),
+)
+EXPORT_USERS_SCHEMA = Schema(
+    Field('format', checks=[validate_optional_export_format]),
+)
+
+# columns of the users export, in order
+EXPORT_COLUMNS = ('first_name', 'email', 'uuid')
+
+
+def page_size(limit) -> int:
+    """the ?limit= of a paginated list, USERS_PAGE_SIZE when missing and at most USERS_MAX_PAGE_SIZE"""
+    return min(int(limit or current_app.config['USERS_PAGE_SIZE']), current_app.config['USERS_MAX_PAGE_SIZE'])
+
+
+def requested_fields(value) -> tuple:
+    """the USER_FIELDS listed in a validated ?fields=, all of them when it is empty"""
+    if not value:
+        return USER_FIELDS
+    names = set(value.split(','))
+    return tuple(name for name in USER_FIELDS if name in names)
 
 
 @app_bp.route("/", methods=["GET"])
@@ -20,74 +110,229 @@ def my_backend_function():
     return payload
 
 
+# the example payload never changes, so it is serialized once at import time
+EXAMPLE_PAYLOAD = encode_json(my_backend_function())
+
+
 @app_bp.route("/api/example", methods=["GET"])
 def api_example_route_get():
-    payload = my_backend_function()
-    return json_response(payload, 200)
+    return json_response(EXAMPLE_PAYLOAD, 200)
 
 
 @app_bp.route("/api/calculate-md5", methods=["POST"])
 def api_calculate_md5():
-    request_data = request.get_json() or {}
-    data = request_data.get('data')
-    errors = run_validators([{'field_name': 'data', 'func': validate_field_required, 'field_val': data}])
+    values, errors = HASH_ALGORITHM_SCHEMA.validate(request.args)
     if errors:
         return json_response(errors, 400)
-    return json_response({'md5': get_md5(data=data)}, 200)
+    algorithm = values['algorithm']
+    if request.mimetype == 'application/octet-stream':
+        # hash the raw body as it is read from the socket, without buffering it
+        digest = hash_stream(request.stream, algorithm, current_app.config['HASH_CHUNK_SIZE'])
+        return json_response({algorithm: digest}, 200)
+
+    values, errors = HASH_DATA_SCHEMA.validate(request.get_json() or {})
+    if errors:
+        return json_response(errors, 400)
+    data = values['data']
+    if isinstance(data, list):
+        return json_response({algorithm: [get_hash(item, algorithm) for item in data]}, 200)
+    return json_response({algorithm: get_hash(data, algorithm)}, 200)
 
 
 @app_bp.route("/api/user", methods=["POST"])
 def api_create_user():
-    request_data = request.get_json() or {}
-    first_name = request_data.get('first_name')
-    email = request_data.get('email', '')
-    password = request_data.get('password')
-    validators = [
-        {'field_name': 'first_name', 'func': validate_field_required, 'field_val': first_name},
-        {'field_name': 'email', 'func': validate_field_required, 'field_val': email},
-        {'field_name': 'password', 'func': validate_field_required, 'field_val': password},
-        {'field_name': 'email', 'func': validate_email_format, 'field_val': email},
-        {'field_name': 'email', 'func': validate_email_already_exists, 'field_val': email},
-    ]
-    errors = run_validators(validators)
+    values, errors = CREATE_USER_SCHEMA.validate(
+        request.get_json() or {}, run_io=current_app.config['USERS_EMAIL_PRECHECK'])
     if errors:
         return json_response(errors, 400)
-    user = User.create_user(first_name, email, password)
+    try:
+        user = User.create_user(values['first_name'], values['email'], values['password'])
+    except EmailAlreadyExists:
+        return json_response(EMAIL_EXISTS_ERRORS, 400)
     return json_response(user.to_dict(), 200)
 
 
 @app_bp.route("/api/user/<uuid>", methods=["GET", "PUT"])
 def api_user_details(uuid):
+    if request.method == 'GET':
+        values, errors = USER_FIELDS_SCHEMA.validate(request.args)
+        if errors:
+            return json_response(errors, 400)
+        fields = requested_fields(values['fields'])
+        # the cache may hold a version older than the client's own writes,
+        # and a lagging replica must not put one back in it after a write
+        cached = None if reads_own_writes() else user_cache.get(uuid)
+        if cached is None:
+            # taken before the read, a write committed after it keeps the row out of the cache
+            generation = user_cache.generation(uuid)
+            # every public field is read to fill the cache, but never the password hash
+            if current_app.config['USERS_LIGHTWEIGHT_READS']:
+                user = User.get_record(uuid)
+            else:
+                user = User.get_by_uuid(uuid)
+            if not user:
+                return json_response({}, 404)
+            cached = (user.to_dict(), user.etag, user.date_modified)
+            if read_bind() is None:
+                user_cache.set(uuid, cached, generation)
+        data, etag, last_modified = cached
+        if fields != USER_FIELDS:
+            # another representation of the same version
+            data = {name: data[name] for name in fields}
+            etag = '{}-{}'.format(etag, ','.join(fields))
+        headers = validator_headers(etag, last_modified)
+        if not_modified(etag, last_modified):
+            return not_modified_response(headers)
+        return json_response(data, 200, headers)
     user = User.query.filter_by(uuid=uuid).first()
     if not user:
         return json_response({}, 404)
-    if request.method == 'GET':
-        return json_response(user.to_dict(), 200)
+    # If-Match: only update the version of the user the client has
+    if request.if_match and not request.if_match.contains(user.etag):
+        return json_response(USER_MODIFIED_ERRORS, 412)
     # update user data
     request_data = request.get_json() or {}
-    first_name = request_data.get('first_name')
-    email = request_data.get('email', '')
-    password = request_data.get('password')
-    if email:
-        validators = [
-            {'field_name': 'email', 'func': validate_email_format, 'field_val': email},
-            {'field_name': 'email', 'func': validate_email_already_exists, 'field_val': email},
-        ]
-        errors = run_validators(validators)
-        if errors:
-            return json_response(errors, 400)
-    user.update_user(first_name, email, password)
-    return json_response(user.to_dict(), 200)
+    values, errors = UPDATE_USER_SCHEMA.validate(
+        request_data,
+        run_io=current_app.config['USERS_EMAIL_PRECHECK'] and request_data.get('email') != user.email,
+    )
+    if errors:
+        return json_response(errors, 400)
+    try:
+        user.update_user(values['first_name'], values['email'], values['password'],
+                         if_modified_at=user.date_modified if request.if_match else None)
+    except EmailAlreadyExists:
+        return json_response(EMAIL_EXISTS_ERRORS, 400)
+    except UserModified:
+        return json_response(USER_MODIFIED_ERRORS, 412)
+    return json_response(user.to_dict(), 200, validator_headers(user.etag, user.date_modified))
 
 
 @app_bp.route("/api/users", methods=["GET"])
 def api_list_users():
-    data = []
-    for user in User.query.all():
-        data.append(user.to_dict())
+    values, errors = LIST_USERS_SCHEMA.validate(request.args)
+    if errors:
+        return json_response(errors, 400)
+    # ?fields= only reads the listed columns
+    fields = requested_fields(values['fields'])
+    if not any(name in request.args for name in LIST_USERS_SCHEMA.names if name != 'fields'):
+        # no pagination, search or sort requested, stream the whole table row by row
+        etag, last_modified = User.list_version()
+        etag = get_md5(data='{}:{}'.format(etag, ','.join(fields)))
+        headers = validator_headers(etag, last_modified)
+        if not_modified(etag, last_modified):
+            return not_modified_response(headers)
+        rows = User.iter_rows(fields, current_app.config['USERS_STREAM_BATCH_SIZE'])
+        return json_stream_response((dict(zip(fields, row)) for row in rows), headers=headers)
+    # sorted by id the next page starts `after` the id, with any other sort it is an opaque `cursor`
+    sort = values['sort'] or 'id'
+    after = int(values['after'] or 0)
+    key = (after,)
+    if sort != 'id':
+        try:
+            key = decode_cursor(values['cursor'], sort) if values['cursor'] else None
+        except ValueError:
+            return json_response(INVALID_CURSOR_ERRORS, 400)
+    limit = page_size(values['limit'])
+    # the page is a function of the users after the cursor and of the query,
+    # any user can be on the page of another sort than the id
+    version, last_modified = User.list_version(after if sort == 'id' else 0)
+    etag = get_md5(data='{}:{}'.format(version, request.query_string.decode()))
+    headers = validator_headers(etag, last_modified)
+    if not_modified(etag, last_modified):
+        return not_modified_response(headers)
+    criteria = User.search_criteria(
+        email=values['email'],
+        first_name=values['first_name'],
+        text=values['q'],
+        **{name: parse_datetime(values[name]) if values[name] else None
+           for name in ('created_after', 'created_before', 'modified_after', 'modified_before')}
+    )
+    users, next_key = User.search(
+        criteria, sort, key, limit, fields, records=current_app.config['USERS_LIGHTWEIGHT_READS'])
+    if next_key is not None:
+        next_key = next_key[0] if sort == 'id' else encode_cursor(next_key)
+    return json_response({'users': [user.to_dict(fields) for user in users], 'next': next_key}, 200, headers)
+
+
+@app_bp.route("/api/users/changes", methods=["GET"])
+def api_user_changes():
+    # the users created, updated or deleted after the `since` checkpoint, pass `next` to get the following ones
+    values, errors = USER_CHANGES_SCHEMA.validate(request.args)
+    if errors:
+        return json_response(errors, 400)
+    since = values['since'] or None
+    limit = page_size(values['limit'])
+    changes, more = User.get_changes(
+        decode_change_token(since) if since else None, limit, current_app.config['USERS_CHANGES_SETTLE_TIME'])
+    return json_response({
+        'changes': [dict(data, deleted=kind == DELETED) for key, kind, data in changes],
+        'next': encode_change_token(changes[-1][0]) if changes else since,
+        'more': more,
+    }, 200)
+
+
+@app_bp.route("/api/users/export", methods=["GET"])
+def api_export_users():
+    # ?format= wins over the Accept header, NDJSON when neither asks for csv
+    values, errors = EXPORT_USERS_SCHEMA.validate(request.args)
+    if errors:
+        return json_response(errors, 400)
+    export_format = values['format']
+    if not export_format:
+        mimetype = request.accept_mimetypes.best_match(list(EXPORT_FORMATS.values()), EXPORT_FORMATS['ndjson'])
+        export_format = next(name for name, value in EXPORT_FORMATS.items() if value == mimetype)
+    batch_size = current_app.config['USERS_STREAM_BATCH_SIZE']
+    rows = User.iter_rows(EXPORT_COLUMNS, batch_size)
+    headers = {'Content-Disposition': 'attachment; filename=users.{}'.format(export_format)}
+    return export_stream_response(EXPORT_COLUMNS, rows, export_format, headers)
+
+
+@app_bp.route("/api/users/bulk", methods=["POST"])
+def api_bulk_create_users():
+    request_data = request.get_json()
+    if not isinstance(request_data, list):
+        return json_response({'users': ['Expected a list of users.']}, 400)
+    max_items = current_app.config['USERS_BULK_MAX_ITEMS']
+    if len(request_data) > max_items:
+        return json_response({'users': ['At most {} users can be created at once.'.format(max_items)]}, 400)
+
+    # the emails of the whole batch are checked with one IN (...) query, the validation
+    # is repeated once, without the email filter, if one of them was inserted before our insert
+    for attempt, schema in enumerate((BULK_CREATE_USER_SCHEMA, BULK_CREATE_USER_RECHECK_SCHEMA)):
+        results = schema.validate_many(request_data)
+        try:
+            created = iter(User.bulk_create_users([values for values, errors in results if not errors]))
+            break
+        except EmailAlreadyExists:
+            if attempt:
+                raise
+    data = [
+        {'status': 400, 'errors': errors} if errors else {'status': 200, 'user': next(created)}
+        for values, errors in results
+    ]
     return json_response(data, 200)
 
 
+@app_bp.route("/readyz", methods=["GET"])
+def readiness():
+    # the process is up and every database answers
+    errors = db.check_connections()
+    if errors:
+        return json_response({'status': 'unavailable', 'errors': errors}, 503)
+    return json_response({'status': 'ready'}, 200)
+
+
+@app_bp.route("/api/cache/stats", methods=["GET"])
+def api_cache_stats():
+    return json_response(user_cache.stats(), 200)
+
+
+@app_bp.route("/api/email-filter/stats", methods=["GET"])
+def api_email_filter_stats():
+    return json_response(email_filter.stats(), 200)
+
+
 @app_bp.route("/api/user/<email>", methods=["DELETE"])
 def api_user_delete_by_email(email):
     is_deleted, data = User.delete_by_email(email)
@@ -0,0 +1,15 @@
+import config
+
+
+class BenchmarkConfig:
+    """the settings of config.py for the sqlite database at `path`, no metrics, overridden by the keyword arguments"""
+
+    def __init__(self, path, **settings):
+        for name in dir(config):
+            if name.isupper():
+                setattr(self, name, getattr(config, name))
+        self.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        self.SQLALCHEMY_TRACK_MODIFICATIONS = False
+        self.METRICS_ENABLED = False
+        for name, value in settings.items():
+            setattr(self, name, value)
@@ -0,0 +1,67 @@
+"""
+concurrent create-user throughput with and without group commit
+
+    python -m benchmarks.bench_group_commit [requests] [threads]
+
+POSTs to /api/user from concurrent threads against a fresh temporary database, with
+cheap password hashing so the commits dominate. each journal setting is measured with
+every request committing on its own and with the writes grouped by the writer thread
+"""
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from app import create_app, db
+from benchmarks import BenchmarkConfig
+
+JOURNALS = [
+    ('wal, synchronous=normal', dict(config.SQLITE_PRAGMAS)),
+    ('wal, synchronous=full', dict(config.SQLITE_PRAGMAS, synchronous='FULL')),
+    ('rollback journal', {'busy_timeout': 5000}),
+]
+
+
+def run(pragmas, group_commit, requests, threads):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(BenchmarkConfig(
+            os.path.join(directory, 'bench.db'), SQLITE_PRAGMAS=pragmas, THREADS_PER_PAGE=threads,
+            PASSWORD_PBKDF2_ITERATIONS=1000, PASSWORD_HASH_WORKERS=0, GROUP_COMMIT_ENABLED=group_commit))
+        with app.app_context():
+            db.create_all()
+            db.session.remove()
+        client = app.test_client()
+
+        def create_user(i):
+            response = client.post('/api/user', json={
+                'first_name': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i), 'password': 'secret',
+            })
+            return response.status_code == 200
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(create_user, range(requests)))
+        elapsed = time.perf_counter() - start
+        group_committer = app.extensions['group_commit']
+        average_batch = group_committer.stats()['average_batch']
+        group_committer.shutdown()
+        with app.app_context():
+            db.session.remove()
+            db.get_engine(app).dispose()
+    return requests / elapsed, results.count(False), average_batch
+
+
+def main(requests=2000, threads=16):
+    print('{} creates from {} threads'.format(requests, threads))
+    print('{:<26} {:>14} {:>14} {:>10} {:>8}'.format('journal', 'commit/s', 'grouped/s', 'batch', 'errors'))
+    for name, pragmas in JOURNALS:
+        single, single_errors, _ = run(pragmas, False, requests, threads)
+        grouped, grouped_errors, batch = run(pragmas, True, requests, threads)
+        print('{:<26} {:>14.1f} {:>14.1f} {:>10.1f} {:>8}'.format(
+            name, single, grouped, batch, single_errors + grouped_errors))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
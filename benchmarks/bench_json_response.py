@@ -0,0 +1,54 @@
+"""
+micro-benchmark of the json response layer on a users list payload
+
+    python -m benchmarks.bench_json_response [number_of_users]
+
+compares the old pretty printed serialization with the compact stdlib encoder
+and the encoder json_response picked (orjson when it is installed)
+"""
+import json
+import sys
+import timeit
+
+from app import create_app
+from app.application import utils
+from app.application.utils import json_response, stdlib_json_encoder
+
+
+def build_users(count):
+    return [
+        {
+            'first_name': 'user{}'.format(i),
+            'email': 'user{}@example.com'.format(i),
+            'uuid': '{:032x}'.format(i),
+        }
+        for i in range(count)
+    ]
+
+
+def old_json_response(data):
+    return json.dumps(data, indent=2, default=str).encode()
+
+
+def measure(name, func, repeat=5, number=10):
+    size = len(func())
+    best = min(timeit.repeat(func, repeat=repeat, number=number)) / number
+    print('{:<28} {:>10} bytes {:>9.2f} ms {:>10.1f} MB/s {:>10.0f} responses/s'.format(
+        name, size, best * 1000, size / best / 1e6, 1 / best))
+    return best
+
+
+def main(count=10000):
+    app = create_app()
+    users = build_users(count)
+    print('serializing {} users'.format(count))
+    with app.test_request_context('/api/users'):
+        baseline = measure('indent=2 (old)', lambda: old_json_response(users))
+        compact = measure('json_response, stdlib', lambda: stdlib_json_encoder(users))
+        current = measure('json_response', lambda: json_response(users).get_data())
+    print('json_response is using {}'.format(utils._json_encoder.__name__))
+    print('speedup compact stdlib: {:.2f}x, json_response: {:.2f}x'.format(baseline / compact, baseline / current))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""
+create-user throughput at several password hashing costs
+
+    python -m benchmarks.bench_password_hashing [requests] [threads]
+
+POSTs to /api/user from concurrent threads against the testing database, hashing
+inside the request threads (workers=0) and on the process pool (workers=cpu count)
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import create_app, db
+from app.application.passwords import PBKDF2_SHA256, SCRYPT
+
+COSTS = [
+    (PBKDF2_SHA256, (1000,)),
+    (PBKDF2_SHA256, (100000,)),
+    (PBKDF2_SHA256, (260000,)),
+    (SCRYPT, (2 ** 14, 8, 1)),
+]
+
+
+app = create_app('config_testing')
+password_hasher = app.extensions['password_hasher']
+
+
+def run(algorithm, params, workers, requests, threads):
+    password_hasher.configure(algorithm, params, workers=workers)
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+    client = app.test_client()
+
+    def create_user(i):
+        response = client.post('/api/user', json={
+            'first_name': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i), 'password': 'secret',
+        })
+        assert response.status_code == 200, response.data
+
+    if workers:
+        # start the pool before timing
+        password_hasher.hash('warm up')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(create_user, range(requests)))
+    elapsed = time.perf_counter() - start
+    password_hasher.shutdown()
+    return requests / elapsed
+
+
+def main(requests=64, threads=8):
+    workers = os.cpu_count()
+    print('{} creates from {} threads, pool of {} workers'.format(requests, threads, workers))
+    print('{:<16} {:<20} {:>14} {:>14}'.format('algorithm', 'cost', 'inline/s', 'pool/s'))
+    for algorithm, params in COSTS:
+        inline = run(algorithm, params, 0, requests, threads)
+        pooled = run(algorithm, params, workers, requests, threads)
+        print('{:<16} {:<20} {:>14.1f} {:>14.1f}'.format(algorithm, str(params), inline, pooled))
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,94 @@
+"""
+rows/sec and memory per row of User.query.all() against the lightweight read path
+(core select mapped to UserRecord objects with __slots__)
+
+    python -m benchmarks.bench_reads [users] [repeat]
+
+a temporary database is seeded with `users` users, each read is timed `repeat` times (best kept)
+and the memory still held by the loaded rows (and the session for the ORM) is measured with tracemalloc
+"""
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import select
+
+from app import create_app, db
+from app.application.models import User, USER_FIELDS, select_records
+from benchmarks import BenchmarkConfig
+
+
+def orm_all():
+    return User.query.all()
+
+
+def records_all():
+    return list(select_records(select([User.__table__])))
+
+
+def records_public_fields():
+    columns = User.__table__.c
+    return list(select_records(select([columns.id, columns.date_modified] + [columns[name] for name in USER_FIELDS])))
+
+
+READS = [
+    ('User.query.all()', orm_all),
+    ('UserRecord', records_all),
+    ('UserRecord, to_dict fields', records_public_fields),
+]
+
+
+def seed(count):
+    rows = [
+        {'first_name': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+         'password': 'pbkdf2_sha256$260000$' + 'f' * 96, 'uuid': '{:032x}'.format(i)}
+        for i in range(count)
+    ]
+    db.session.bulk_insert_mappings(User, rows)
+    db.session.commit()
+
+
+def rows_per_second(read, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        rows = read()
+        best = min(best, time.perf_counter() - start)
+    db.session.remove()
+    return len(rows) / best
+
+
+def bytes_per_row(read):
+    db.session.remove()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    rows = read()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    count = len(rows)
+    del rows
+    db.session.remove()
+    return held / count
+
+
+def main(users=50000, repeat=3):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(BenchmarkConfig(os.path.join(directory, 'bench.db')))
+        with app.app_context():
+            db.create_all()
+            seed(users)
+            print('{} users, best of {}'.format(users, repeat))
+            print('{:<28} {:>12} {:>12}'.format('read', 'rows/s', 'bytes/row'))
+            for name, read in READS:
+                print('{:<28} {:>12.0f} {:>12.0f}'.format(name, rows_per_second(read, repeat), bytes_per_row(read)))
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
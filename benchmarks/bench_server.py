@@ -0,0 +1,96 @@
+"""
+requests/sec of the development server (run.py) against the production server (gunicorn.conf.py)
+
+    python -m benchmarks.bench_server [seconds] [clients]
+
+each server is started on a free local port and waited for on /readyz, then `clients`
+processes send GET /api/example and GET /api/users?limit=20 in a loop for `seconds`
+"""
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+PATHS = ['/api/example', '/api/users?limit=20']
+
+DEV_SERVER = '''
+import sys
+from run import app
+app.run(host="127.0.0.1", port=int(sys.argv[1]), debug=True, use_reloader=False)
+'''
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def servers(port):
+    return [
+        ('dev server', [sys.executable, '-c', DEV_SERVER, str(port)]),
+        ('gunicorn', [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                      '--bind', '127.0.0.1:{}'.format(port), 'wsgi:application']),
+    ]
+
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/readyz')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('server on port {} not ready after {}s'.format(port, timeout))
+
+
+def client(port, seconds):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    requests = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            connection.request('GET', PATHS[requests % len(PATHS)])
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+        requests += 1
+    return requests, errors
+
+
+def run(command, port, seconds, clients):
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        wait_until_ready(port)
+        with ProcessPoolExecutor(clients) as executor:
+            results = list(executor.map(client, [port] * clients, [seconds] * clients))
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+    requests = sum(requests for requests, errors in results)
+    return requests / seconds, sum(errors for requests, errors in results)
+
+
+def main(seconds=10, clients=8):
+    print('{} clients for {}s, {} cpus'.format(clients, seconds, os.cpu_count()))
+    print('{:<12} {:>12} {:>8}'.format('server', 'requests/s', 'errors'))
+    port = free_port()
+    for name, command in servers(port):
+        throughput, errors = run(command, port, seconds, clients)
+        print('{:<12} {:>12.1f} {:>8}'.format(name, throughput, errors))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
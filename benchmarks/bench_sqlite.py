@@ -0,0 +1,74 @@
+"""
+mixed read/write throughput of the sqlite defaults against the tuned settings of config.py
+
+    python -m benchmarks.bench_sqlite [requests] [threads] [write_percent]
+
+each setup gets a fresh temporary database seeded with users, then the threads send
+GET /api/user/<uuid> and PUT /api/user/<uuid> (write_percent of the requests) with the
+user cache off. requests failing with "database is locked" are counted as errors
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from app import create_app, db
+from app.application.models import User
+from benchmarks import BenchmarkConfig
+
+SETUPS = [
+    ('defaults', {'DATABASE_POOL_SIZE': 0, 'SQLITE_PRAGMAS': {}}),
+    ('wal', {'DATABASE_POOL_SIZE': 0, 'SQLITE_PRAGMAS': {'journal_mode': 'WAL', 'busy_timeout': 5000}}),
+    ('config.py', {'DATABASE_POOL_SIZE': config.DATABASE_POOL_SIZE, 'SQLITE_PRAGMAS': config.SQLITE_PRAGMAS}),
+]
+
+USERS = 200
+
+
+def run(settings, requests, threads, write_percent):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(BenchmarkConfig(
+            os.path.join(directory, 'bench.db'), USER_CACHE_ENABLED=False, PASSWORD_PBKDF2_ITERATIONS=1000,
+            PASSWORD_HASH_WORKERS=0, THREADS_PER_PAGE=threads, **settings))
+        with app.app_context():
+            db.create_all()
+            uuids = [
+                User.create_user('user{}'.format(i), 'user{}@example.com'.format(i), 'secret').uuid
+                for i in range(USERS)
+            ]
+            db.session.remove()
+        client = app.test_client()
+        rng = random.Random(0)
+        plan = [(rng.choice(uuids), rng.randrange(100) < write_percent) for _ in range(requests)]
+
+        def send(step):
+            uuid, write = step
+            if write:
+                response = client.put('/api/user/{}'.format(uuid), json={'first_name': 'renamed'})
+            else:
+                response = client.get('/api/user/{}'.format(uuid))
+            return response.status_code == 200
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(send, plan))
+        elapsed = time.perf_counter() - start
+        with app.app_context():
+            db.session.remove()
+            db.get_engine(app).dispose()
+    return requests / elapsed, results.count(False)
+
+
+def main(requests=2000, threads=8, write_percent=20):
+    print('{} requests from {} threads, {}% writes'.format(requests, threads, write_percent))
+    print('{:<12} {:>12} {:>8}'.format('setup', 'requests/s', 'errors'))
+    for name, settings in SETUPS:
+        throughput, errors = run(settings, requests, threads, write_percent)
+        print('{:<12} {:>12.1f} {:>8}'.format(name, throughput, errors))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
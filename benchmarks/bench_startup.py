@@ -0,0 +1,39 @@
+"""
+cold start: time from a fresh interpreter importing the application to its first response
+
+    python -m benchmarks.bench_startup [runs]
+
+every run is a new python process, the import of the package, create_app()
+and the first GET /api/example are timed separately
+"""
+import statistics
+import subprocess
+import sys
+
+SCRIPT = '''
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+response = application.test_client().get("/api/example")
+assert response.status_code == 200
+done = time.perf_counter()
+print(imported - start, created - imported, done - created, done - start)
+'''
+
+
+def main(runs=10):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT], stderr=subprocess.DEVNULL)
+        timings.append([float(value) for value in output.split()])
+    print('{} cold starts, median (min) in ms'.format(runs))
+    for index, name in enumerate(['import', 'create_app', 'first response', 'total']):
+        values = [timing[index] * 1000 for timing in timings]
+        print('{:<16} {:>8.1f} ({:.1f})'.format(name, statistics.median(values), min(values)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -8,7 +8,165 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # Define the database - we are working with
 # SQLite for this example
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'app.db')
+
+# Database connections. DATABASE_CONNECT_OPTIONS are passed to the driver's
+# connect(). Each worker process keeps up to DATABASE_POOL_SIZE sqlite
+# connections open (THREADS_PER_PAGE when None, 0 opens a new connection for
+# every checkout) plus DATABASE_POOL_MAX_OVERFLOW more under load, waiting
+# DATABASE_POOL_TIMEOUT seconds for a free one.
+# SQLITE_PRAGMAS run on every new connection: in WAL mode readers do not
+# block behind a writer, synchronous=NORMAL only syncs at checkpoints, and
+# busy_timeout (ms) makes a writer wait for the lock instead of failing with
+# "database is locked". cache_size is negative KiB, mmap_size bytes
 DATABASE_CONNECT_OPTIONS = {}
+DATABASE_POOL_SIZE = None
+DATABASE_POOL_MAX_OVERFLOW = 10
+DATABASE_POOL_TIMEOUT = 30
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+
+# Read replicas. GET, HEAD and OPTIONS requests read from one of the
+# DATABASE_REPLICA_URIS picked at random, writes go to SQLALCHEMY_DATABASE_URI.
+# A client that wrote reads from the primary for the next
+# DATABASE_READ_YOUR_WRITES_WINDOW seconds (tracked with a cookie) so it sees
+# its own changes. With sqlite files `flask replicate` stands in for
+# replication, copying the primary onto the replicas every second.
+# The user cache is only filled from the primary, and bypassed by the clients
+# in their read your writes window
+DATABASE_REPLICA_URIS = []
+DATABASE_READ_YOUR_WRITES_WINDOW = 5
+
+# Pagination of the users list: page size used when only a cursor is given,
+# the hard upper limit for ?limit=N and how many rows are fetched per batch
+# when the whole list is streamed (also by the /api/users/export NDJSON and CSV).
+# The search and date filters of the list are answered by indexes and, for
+# ?q=, an sqlite fts5 table kept in step by triggers: run `flask init-db` to
+# add them to an existing database
+USERS_PAGE_SIZE = 100
+USERS_MAX_PAGE_SIZE = 1000
+USERS_STREAM_BATCH_SIZE = 1000
+
+# Change feed of the users on /api/users/changes?since=<token>. Writes take
+# their date_modified before waiting for the database lock, so a write can
+# commit after one dated later: changes younger than USERS_CHANGES_SETTLE_TIME
+# seconds are held back until no earlier write can still commit. Keep it above
+# the sqlite busy_timeout. Run `flask init-db` to add the date_modified index
+# and the tombstones table to an existing database
+USERS_CHANGES_SETTLE_TIME = 10
+
+# Lightweight reads. With USERS_LIGHTWEIGHT_READS, GET /api/user/<uuid> and
+# the pages of GET /api/users run core selects and map the rows to plain
+# records with __slots__ (UserRecord) instead of going through the ORM
+# session, its identity map and attribute instrumentation. The responses are
+# the same. benchmarks/bench_reads.py measures the difference
+USERS_LIGHTWEIGHT_READS = False
+
+# Check for an existing email with a SELECT before creating or updating a user.
+# By default writes go straight to the database and a violation of the unique
+# constraint on the email is reported as "Email already exists."
+USERS_EMAIL_PRECHECK = False
+
+# Read-through cache of GET /api/user/<uuid>, invalidated on every write.
+# USER_CACHE_BACKEND is the import path of a CacheBackend implementation,
+# the default keeps up to USER_CACHE_MAX_ENTRIES users in process memory for
+# USER_CACHE_TTL seconds. Usage counters are served on /api/cache/stats.
+# An in-process cache is only invalidated by the writes of its own process:
+# gunicorn.conf.py turns it off when it runs several workers, set a shared
+# backend to keep caching there
+USER_CACHE_ENABLED = True
+USER_CACHE_BACKEND = 'app.application.cache.LRUCache'
+USER_CACHE_MAX_ENTRIES = 10000
+USER_CACHE_TTL = 60
+
+# Password hashing. PASSWORD_HASH_ALGORITHM is pbkdf2_sha256 or scrypt and
+# the cost comes from the matching settings below. Stored hashes record the
+# algorithm and cost they were made with, so changing them (or upgrading the
+# legacy md5 hashes) takes effect the next time a password is written.
+# With PASSWORD_HASH_WORKERS > 0 hashing runs on that many worker processes,
+# 0 hashes inside the request thread
+PASSWORD_HASH_ALGORITHM = 'pbkdf2_sha256'
+PASSWORD_PBKDF2_ITERATIONS = 260000
+PASSWORD_SCRYPT_N = 2 ** 14
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_MAX_PENDING = 64
+
+# Size of the chunks read from raw (application/octet-stream) bodies
+# posted to /api/calculate-md5
+HASH_CHUNK_SIZE = 64 * 1024
+
+# Compression of the responses, negotiated with Accept-Encoding (gzip or
+# deflate). Bodies of COMPRESSION_MIMETYPES of at least COMPRESSION_MIN_SIZE
+# bytes are compressed at COMPRESSION_LEVEL (1 fastest - 9 smallest), smaller
+# ones are not worth the CPU. Streamed bodies (the full users list) are
+# compressed and flushed chunk by chunk
+COMPRESSION_ENABLED = True
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/html', 'text/plain')
+
+# Per-request instrumentation: counts the sql statements and time spent in
+# the database, validation and serialization of every request and reports
+# them in a Server-Timing header and a json log line. The debug mode also logs
+# statements repeated REQUEST_N_PLUS_ONE_THRESHOLD times (likely N+1 queries)
+# and requests issuing more than REQUEST_QUERY_BUDGET statements
+REQUEST_INSTRUMENTATION = False
+REQUEST_INSTRUMENTATION_DEBUG = False
+REQUEST_QUERY_BUDGET = 10
+REQUEST_N_PLUS_ONE_THRESHOLD = 3
+
+# Prometheus metrics served on /metrics. When the app runs in several worker
+# processes point METRICS_MULTIPROC_DIR to a directory shared by all of them,
+# each process writes its metrics there at most every METRICS_FLUSH_INTERVAL
+# seconds and /metrics reports the sum. The directory should be emptied
+# before the workers are started
+METRICS_ENABLED = True
+METRICS_MULTIPROC_DIR = None
+METRICS_FLUSH_INTERVAL = 1.0
+
+# In-memory bloom filter of the emails in auth_user, an email it has never
+# seen skips the duplicate email query. Sized for EMAIL_FILTER_CAPACITY emails
+# (or twice the table when it is bigger) at EMAIL_FILTER_ERROR_RATE false
+# positives. It is built from the table in the background when the app starts
+# (the emails are checked in the database until then) and rebuilt every
+# EMAIL_FILTER_REBUILD_INTERVAL seconds. Its size and false positive rates are
+# served on /api/email-filter/stats
+EMAIL_FILTER_ENABLED = False
+EMAIL_FILTER_CAPACITY = 100000
+EMAIL_FILTER_ERROR_RATE = 0.01
+EMAIL_FILTER_REBUILD_INTERVAL = 300
+
+# Sharding of auth_user. With USER_SHARDS set each user is stored on the
+# database int(uuid, 16) % len(USER_SHARDS) (the uuid is an md5 digest, so the
+# users spread evenly) and auth_user_shard on SQLALCHEMY_DATABASE_URI maps
+# every email to its shard and hands out the user ids, unique across shards.
+# Lookups by uuid or email read a single shard, lists read all of them and
+# merge the results by id. After adding shards run `flask init-db` then
+# `flask rebalance-users` with the writes stopped, `--from-primary` moves an
+# unsharded auth_user table onto the shards. Not combined with
+# DATABASE_REPLICA_URIS
+USER_SHARDS = []
+
+# Group commit. With GROUP_COMMIT_ENABLED the user writes (create, update,
+# delete and bulk create) of concurrent requests are handed to one writer
+# thread that commits up to GROUP_COMMIT_MAX_BATCH of them in a single
+# transaction, waiting at most GROUP_COMMIT_MAX_WAIT seconds for the batch to
+# fill. Every request still gets its own result or error, a failed write is
+# rolled back alone and the rest of its batch committed without it
+GROUP_COMMIT_ENABLED = False
+GROUP_COMMIT_MAX_BATCH = 64
+GROUP_COMMIT_MAX_WAIT = 0.002
+
+# Maximum number of users accepted by one POST /api/users/bulk request,
+# the emails are checked with a single IN (...) query so keep it below
+# the sqlite limit on bound parameters
+USERS_BULK_MAX_ITEMS = 500
 
 # Application threads. A common general assumption is
 # using 2 per available processor cores - to handle
@@ -16,6 +174,52 @@ DATABASE_CONNECT_OPTIONS = {}
 # operations using the other.
 THREADS_PER_PAGE = 2
 
+# Production server (gunicorn.conf.py, `make serve`): SERVER_WORKERS
+# processes of SERVER_THREADS threads each, None uses the number of CPUs and
+# THREADS_PER_PAGE. A worker is replaced after SERVER_MAX_REQUESTS requests
+# (plus up to SERVER_MAX_REQUESTS_JITTER, so they do not all restart at once)
+# to bound memory growth, 0 keeps them forever. Workers silent for
+# SERVER_TIMEOUT seconds are restarted, on a reload or shutdown in-flight
+# requests get SERVER_GRACEFUL_TIMEOUT seconds to finish. With several
+# workers gunicorn.conf.py disables the in-process user cache and defaults
+# METRICS_MULTIPROC_DIR to a temporary directory, set DATABASE_POOL_SIZE to
+# the threads
+SERVER_BIND = '0.0.0.0:8080'
+SERVER_WORKERS = None
+SERVER_THREADS = None
+SERVER_MAX_REQUESTS = 10000
+SERVER_MAX_REQUESTS_JITTER = 1000
+SERVER_TIMEOUT = 30
+SERVER_GRACEFUL_TIMEOUT = 30
+
+# Admission control. With ADMISSION_CONTROL_ENABLED each endpoint of
+# ADMISSION_LIMITS runs at most `concurrency` requests at once and queues up to
+# `queue` more, waiting ADMISSION_QUEUE_TIMEOUT seconds at most for a slot.
+# Requests beyond that get an immediate 503 with a Retry-After of
+# ADMISSION_RETRY_AFTER seconds instead of piling up behind the sqlite writer
+# lock. With ADMISSION_READ_LANE the GET requests of an endpoint get lanes of
+# the same size of their own, so reads keep working while writes are saturated.
+# The limits apply to each process, where every request of a lane (running
+# or queued) holds one of the worker's threads: by default a lane runs half
+# of the threads of a server worker and queues so that at least one thread is
+# left for the other lanes (with a single thread no lane can leave one). Shed
+# requests and queue times are exported on /metrics
+ADMISSION_CONTROL_ENABLED = False
+ADMISSION_WORKER_THREADS = SERVER_THREADS or THREADS_PER_PAGE
+_lane_concurrency = max(1, ADMISSION_WORKER_THREADS // 2)
+_lane_queue = max(0, ADMISSION_WORKER_THREADS - _lane_concurrency - 1)
+ADMISSION_LIMITS = {
+    # endpoint: (concurrency, queue)
+    'application.api_create_user': (_lane_concurrency, _lane_queue),
+    'application.api_user_details': (_lane_concurrency, _lane_queue),
+    'application.api_list_users': (_lane_concurrency, _lane_queue),
+    'application.api_bulk_create_users': (1, _lane_queue),
+    'application.api_user_delete_by_email': (_lane_concurrency, _lane_queue),
+}
+ADMISSION_READ_LANE = True
+ADMISSION_QUEUE_TIMEOUT = 1.0
+ADMISSION_RETRY_AFTER = 1
+
 # Enable protection agains *Cross-site Request Forgery (CSRF)*
 CSRF_ENABLED     = True
 
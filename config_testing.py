@@ -1,2 +1,9 @@
 from config import *
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'app_testing.db')
\ No newline at end of file
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'app_testing.db')
+
+# cheap password hashing, inside the test process
+PASSWORD_PBKDF2_ITERATIONS = 1000
+PASSWORD_HASH_WORKERS = 0
+
+# the writes of the tests are never concurrent
+USERS_CHANGES_SETTLE_TIME = 0
@@ -0,0 +1,61 @@
+"""
+settings of the production server, a preforking gunicorn master with
+SERVER_WORKERS processes of SERVER_THREADS threads each (see config.py)
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+kill -HUP <master pid> starts workers with the new code and config and stops the old ones
+once their in-flight requests are done, kill -TERM shuts down gracefully
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# `config` is itself a gunicorn setting, the module must not be bound to that name
+import config as settings
+
+bind = settings.SERVER_BIND
+workers = settings.SERVER_WORKERS or multiprocessing.cpu_count()
+threads = settings.SERVER_THREADS or settings.THREADS_PER_PAGE
+worker_class = 'gthread'
+
+# the master imports config.py before it forks the workers, the settings changed here are the
+# ones create_app reads in every worker. the workers share no memory: with several of them
+# the user cache must be a shared backend, otherwise a write would only invalidate the cache
+# of the worker serving it, and /metrics must add up the files of every worker
+IN_PROCESS_CACHE_BACKENDS = ('app.application.cache.LRUCache',)
+if workers > 1:
+    if settings.USER_CACHE_BACKEND in IN_PROCESS_CACHE_BACKENDS:
+        settings.USER_CACHE_ENABLED = False
+    if not settings.METRICS_MULTIPROC_DIR:
+        # named after the master, which keeps its pid across reloads
+        settings.METRICS_MULTIPROC_DIR = os.path.join(tempfile.gettempdir(), 'gunicorn-metrics-{}'.format(os.getpid()))
+
+# recycle the workers to bound memory growth, the jitter keeps them from restarting together
+max_requests = settings.SERVER_MAX_REQUESTS
+max_requests_jitter = settings.SERVER_MAX_REQUESTS_JITTER
+
+timeout = settings.SERVER_TIMEOUT
+graceful_timeout = settings.SERVER_GRACEFUL_TIMEOUT
+keepalive = 5
+
+# every worker imports the application itself, so a reload picks up code changes
+preload_app = False
+
+
+def on_starting(server):
+    # metrics files left by the workers of a previous run would be added to the new ones
+    directory = settings.METRICS_MULTIPROC_DIR
+    if directory and os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+
+def on_exit(server):
+    directory = settings.METRICS_MULTIPROC_DIR
+    if directory and os.path.isdir(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def when_ready(server):
+    server.log.info('Serving on %s with %d workers x %d threads', bind, workers, threads)
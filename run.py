@@ -1,2 +1,6 @@
-from app import app
-app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+from app import create_app
+
+app = create_app()
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=8080, debug=True)
@@ -1,20 +1,41 @@
-from app import app, db
+import config_testing
+from app import create_app, db, dispose_engines
 from sure import scenario
 
 
+class TemporaryDatabaseConfig:
+    """the settings of config_testing for the sqlite database at `path`, overridden by the keyword arguments"""
+
+    def __init__(self, path, **settings):
+        for name in dir(config_testing):
+            if name.isupper():
+                setattr(self, name, getattr(config_testing, name))
+        self.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        self.SQLALCHEMY_TRACK_MODIFICATIONS = False
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+app = create_app('config_testing')
+# let the tests use the models outside of a request
+db.app = app
+
+
 def before_each_test(context):
-    app.config.from_object('config_testing')
-    db.session.close()
+    # an application of its own, the extensions a test reconfigures are not left to the next one
+    context.web = create_app('config_testing')
+    db.app = context.web
+    db.session.remove()
     db.drop_all()
     db.create_all()
-    context.web = app
     context.http = context.web.test_client()
 
 
 def after_each_test(context):
     # I would clean up the database here, if I had one
-    db.session.close()
+    db.session.remove()
     db.drop_all()
+    dispose_engines(context.web)
+    db.app = app
 
 
 web_test = scenario(before_each_test, after_each_test)
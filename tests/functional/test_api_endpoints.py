@@ -1,6 +1,13 @@
+import gzip
 import hashlib
 import json
+import logging
+from datetime import datetime
 
+from app import db
+from app.application.admission import admission_control
+from app.application.cache import user_cache
+from app.application.email_filter import email_filter
 from app.application.models import User
 from .helpers import web_test
 
@@ -102,6 +109,21 @@ def test_api_create_user_email_exists(context):
     data.should.have.key("email").being.equal(['Email already exists.'])
 
 
+@web_test
+def test_api_create_user_email_exists_precheck(context):
+    ("POST on /api/user email already exists with USERS_EMAIL_PRECHECK enabled")
+    context.web.config['USERS_EMAIL_PRECHECK'] = True
+    User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    response = context.http.post(
+        "/api/user",
+        data=json.dumps({'first_name': 'ramadan', 'email': 'ramadan@thebest.com', 'password': 'pass1234'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(400)
+    data = json.loads(response.data)
+    data.should.equal({"email": ['Email already exists.']})
+
+
 @web_test
 def test_api_create_user_valid(context):
     ("POST on /api/user valid data")
@@ -232,6 +254,19 @@ def test_api_update_user_email_already_exists(context):
     data.should.have.key("email").being.equal(['Email already exists.'])
 
 
+@web_test
+def test_api_update_user_same_email(context):
+    ("PUT on /api/user/<uuid> with the email the user already has")
+    user = User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    response = context.http.put(
+        "/api/user/{}".format(user.uuid),
+        data=json.dumps({'first_name': 'ramadan3', 'email': 'ramadan@thebest.com'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(200)
+    json.loads(response.data).should.have.key("first_name").being.equal('ramadan3')
+
+
 @web_test
 def test_api_list_users(context):
     ("GET on /api/users list all users")
@@ -274,4 +309,589 @@ def test_api_delete_user_valid_email(context):
     data.should.have.key("uuid").being.equal(
         user.uuid
     )
-    User.query.filter_by(email='ramadan@thebest.com').first().should.equal(None)
\ No newline at end of file
+    User.query.filter_by(email='ramadan@thebest.com').first().should.equal(None)
+
+@web_test
+def test_api_list_users_paginated(context):
+    ("GET on /api/users?after=<id>&limit=N returns a page of users and the next cursor")
+    first = User.create_user('ramadan1', 'ramadan1@thebest.com', 'pass12344')
+    second = User.create_user('ramadan2', 'ramadan2@thebest.com', 'pass12344')
+    third = User.create_user('ramadan3', 'ramadan3@thebest.com', 'pass12344')
+    response = context.http.get("/api/users?limit=2")
+    response.status_code.should.equal(200)
+    data = json.loads(response.data)
+    data.should.equal({'users': [first.to_dict(), second.to_dict()], 'next': second.id})
+
+    response = context.http.get("/api/users?after={}&limit=2".format(data['next']))
+    response.status_code.should.equal(200)
+    data = json.loads(response.data)
+    data.should.equal({'users': [third.to_dict()], 'next': None})
+
+
+@web_test
+def test_api_list_users_paginated_invalid(context):
+    ("GET on /api/users with invalid pagination parameters")
+    response = context.http.get("/api/users?after=-1&limit=0")
+    response.status_code.should.equal(400)
+    data = json.loads(response.data)
+    data.should.equal({'after': ['Must be a non-negative integer.'], 'limit': ['Must be a positive integer.']})
+    response = context.http.get("/api/users?after=99999999999999999999")
+    response.status_code.should.equal(400)
+    json.loads(response.data).should.equal({'after': ['Must be a non-negative integer.']})
+
+
+@web_test
+def test_api_bulk_create_users(context):
+    ("POST on /api/users/bulk creates the valid users and reports errors per item")
+    User.create_user('ramadan', 'ramadan@thebest.com', 'pass12344')
+    response = context.http.post(
+        "/api/users/bulk",
+        data=json.dumps([
+            {'first_name': 'ramadan1', 'email': 'ramadan1@thebest.com', 'password': 'pass1234'},
+            {'first_name': 'ramadan', 'email': 'ramadan@thebest.com', 'password': 'pass1234'},
+            {'first_name': 'ramadan2', 'email': 'ramadan1@thebest.com', 'password': 'pass1234'},
+            {'first_name': 'ramadan3', 'email': 'ramadan3', 'password': 'pass1234'},
+            {'first_name': 'ramadan4', 'email': 'ramadan4@thebest.com', 'password': 'pass1234'},
+        ]),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(200)
+    data = json.loads(response.data)
+    data.should.equal([
+        {'status': 200, 'user': {
+            'first_name': 'ramadan1', 'email': 'ramadan1@thebest.com',
+            'uuid': hashlib.md5("ramadan1:ramadan1@thebest.com".encode()).hexdigest()}},
+        {'status': 400, 'errors': {'email': ['Email already exists.']}},
+        {'status': 400, 'errors': {'email': ['Duplicate email in request.']}},
+        {'status': 400, 'errors': {'email': ['Invalid Email format.']}},
+        {'status': 200, 'user': {
+            'first_name': 'ramadan4', 'email': 'ramadan4@thebest.com',
+            'uuid': hashlib.md5("ramadan4:ramadan4@thebest.com".encode()).hexdigest()}},
+    ])
+    User.query.count().should.equal(3)
+    User.query.filter_by(email='ramadan4@thebest.com').first().first_name.should.equal('ramadan4')
+
+
+@web_test
+def test_api_bulk_create_users_outdated_email_filter(context):
+    ("POST on /api/users/bulk rechecks the database when the email filter missed an email of another process")
+    context.web.config['EMAIL_FILTER_ENABLED'] = True
+    email_filter.init_app(context.web)
+    email_filter.build()
+    # created by another process, this one's filter does not know it
+    db.session.execute(User.__table__.insert().values(
+        first_name='ramadan', email='ramadan@thebest.com', password='x', uuid='f' * 32))
+    db.session.commit()
+    response = context.http.post(
+        "/api/users/bulk",
+        data=json.dumps([
+            {'first_name': 'ramadan', 'email': 'ramadan@thebest.com', 'password': 'pass1234'},
+            {'first_name': 'ramadan1', 'email': 'ramadan1@thebest.com', 'password': 'pass1234'},
+        ]),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(200)
+    [item['status'] for item in json.loads(response.data)].should.equal([400, 200])
+    User.query.count().should.equal(2)
+
+
+@web_test
+def test_api_bulk_create_users_invalid(context):
+    ("POST on /api/users/bulk without a list of users")
+    response = context.http.post(
+        "/api/users/bulk",
+        data=json.dumps({'first_name': 'ramadan1'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(400)
+    json.loads(response.data).should.equal({'users': ['Expected a list of users.']})
+
+
+@web_test
+def test_api_retrieve_user_cached(context):
+    ("GET on /api/user/<uuid> is served from the cache and invalidated by writes")
+    user = User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    before = json.loads(context.http.get("/api/cache/stats").data)
+    context.http.get("/api/user/{}".format(user.uuid)).status_code.should.equal(200)
+    context.http.get("/api/user/{}".format(user.uuid)).status_code.should.equal(200)
+    after = json.loads(context.http.get("/api/cache/stats").data)
+    (after['hits'] - before['hits']).should.equal(1)
+    (after['misses'] - before['misses']).should.equal(1)
+
+    user.update_user('ramadan3', None, None)
+    data = json.loads(context.http.get("/api/user/{}".format(user.uuid)).data)
+    data.should.have.key("first_name").being.equal('ramadan3')
+
+    User.delete_by_email('ramadan@thebest.com')
+    context.http.get("/api/user/{}".format(user.uuid)).status_code.should.equal(404)
+
+
+@web_test
+def test_api_calculate_md5_algorithm(context):
+    ("POST on /api/calculate-md5?algorithm=sha256 with valid data")
+    response = context.http.post(
+        "/api/calculate-md5?algorithm=sha256",
+        data=json.dumps({'data': 'email@OK.com'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(200)
+    data = json.loads(response.data)
+    data.should.equal({'sha256': hashlib.sha256(b'email@OK.com').hexdigest()})
+
+
+@web_test
+def test_api_calculate_md5_invalid_algorithm(context):
+    ("POST on /api/calculate-md5 with an unsupported algorithm")
+    response = context.http.post(
+        "/api/calculate-md5?algorithm=md4",
+        data=json.dumps({'data': 'email@OK.com'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(400)
+    data = json.loads(response.data)
+    data.should.equal({'algorithm': ['Must be one of md5, sha1, sha256, blake2b.']})
+
+
+@web_test
+def test_api_calculate_md5_list(context):
+    ("POST on /api/calculate-md5 with a list of strings")
+    response = context.http.post(
+        "/api/calculate-md5",
+        data=json.dumps({'data': ['email@OK.com', 'user@ddd.com']}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(200)
+    data = json.loads(response.data)
+    data.should.equal({'md5': ['4a311b40964e7f6372a253081f8c61f2', hashlib.md5(b'user@ddd.com').hexdigest()]})
+
+
+@web_test
+def test_api_calculate_md5_invalid_list(context):
+    ("POST on /api/calculate-md5 with a list containing something else than strings")
+    response = context.http.post(
+        "/api/calculate-md5",
+        data=json.dumps({'data': ['email@OK.com', 1]}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(400)
+    data = json.loads(response.data)
+    data.should.equal({'data': ['Must be a string or a list of strings.']})
+
+
+@web_test
+def test_api_calculate_md5_raw_body(context):
+    ("POST on /api/calculate-md5 with an application/octet-stream body")
+    payload = b'x' * (1024 * 1024 + 7)
+    response = context.http.post(
+        "/api/calculate-md5?algorithm=blake2b",
+        data=payload,
+        content_type='application/octet-stream',
+    )
+    response.status_code.should.equal(200)
+    data = json.loads(response.data)
+    data.should.equal({'blake2b': hashlib.blake2b(payload).hexdigest()})
+
+
+@web_test
+def test_api_server_timing(context):
+    ("requests report their sql statements and timings when REQUEST_INSTRUMENTATION is on")
+    user = User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    response = context.http.get("/api/user/{}".format(user.uuid))
+    response.headers.shouldnot.have.key("Server-Timing")
+
+    context.web.config['REQUEST_INSTRUMENTATION'] = True
+    context.web.config['REQUEST_INSTRUMENTATION_DEBUG'] = True
+    response = context.http.put(
+        "/api/user/{}".format(user.uuid),
+        data=json.dumps({'email': 'ramadan3@thebest.com'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(200)
+    server_timing = response.headers["Server-Timing"]
+    server_timing.should.match(r'^db;dur=[0-9.]+;desc="[1-9][0-9]* queries", serialization;dur=[0-9.]+, '
+                               r'validation;dur=[0-9.]+, total;dur=[0-9.]+$')
+
+
+@web_test
+def test_api_server_timing_streamed(context):
+    ("streamed responses log the queries run while their body is sent, once the response is closed")
+    User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    context.web.config['REQUEST_INSTRUMENTATION'] = True
+    lines = []
+    handler = logging.Handler()
+    handler.emit = lambda record: lines.append(record.getMessage())
+    logger = logging.getLogger('app.application.instrumentation')
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    try:
+        response = context.http.get("/api/users")
+        response.headers["Server-Timing"].should.match(r'total;dur=[0-9.]+;desc="until the first byte"$')
+        len(json.loads(response.data)).should.equal(1)
+        response.close()
+    finally:
+        logger.removeHandler(handler)
+    line = json.loads(lines[-1])
+    line['streamed'].should.be.true
+    line['queries'].should.be.greater_than(1)
+
+
+@web_test
+def test_metrics(context):
+    ("GET on /metrics reports the requests in the prometheus text format")
+    context.http.get("/api/example").status_code.should.equal(200)
+    response = context.http.get("/metrics")
+    response.status_code.should.equal(200)
+    response.headers["Content-Type"].should.equal('text/plain; version=0.0.4; charset=utf-8')
+    body = response.data.decode()
+    body.should.match(r'http_requests_total\{endpoint="application.api_example_route_get",method="GET",status="200"\} \d+')
+    body.should.match(r'http_request_duration_seconds_count\{endpoint="application.api_example_route_get"\} \d+')
+    body.should.match(r'\nhttp_requests_in_flight 1\n')
+    body.should.match(r'db_pool_checkout_wait_seconds_count \d+')
+
+
+@web_test
+def test_api_email_filter_stats(context):
+    ("GET on /api/email-filter/stats reports the size and false positive rate of the email filter")
+    context.web.config['EMAIL_FILTER_ENABLED'] = True
+    context.web.config['USERS_EMAIL_PRECHECK'] = True
+    email_filter.init_app(context.web)
+    email_filter.build()
+    User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    response = context.http.post(
+        "/api/user",
+        data=json.dumps({'first_name': 'ramadan', 'email': 'ramadan@thebest.com', 'password': 'pass1234'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(400)
+    json.loads(response.data).should.equal({"email": ['Email already exists.']})
+    response = context.http.post(
+        "/api/user",
+        data=json.dumps({'first_name': 'ramadan', 'email': 'ramadan3@thebest.com', 'password': 'pass1234'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(200)
+
+    data = json.loads(context.http.get("/api/email-filter/stats").data)
+    data.should.have.key("enabled").being.equal(True)
+    data.should.have.key("items").being.equal(2)
+    data.should.have.key("negatives").being.equal(1)
+    data.should.have.key("positives").being.equal(1)
+    data.should.have.key("memory_bytes").being.greater_than(0)
+    data.should.have.key("estimated_false_positive_rate")
+
+
+@web_test
+def test_readiness(context):
+    ("GET on /readyz should report ready when the database answers")
+    response = context.http.get("/readyz")
+    response.status_code.should.equal(200)
+    json.loads(response.data).should.equal({'status': 'ready'})
+
+
+@web_test
+def test_admission_control_sheds_load(context):
+    ("requests over the limits of ADMISSION_LIMITS get a 503 with Retry-After, reads have their own lane")
+    context.web.config['ADMISSION_CONTROL_ENABLED'] = True
+    context.web.config['ADMISSION_LIMITS'] = {'application.api_user_details': (1, 0)}
+    admission_control.init_app(context.web)
+    user = User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    # a write holding the only slot
+    admission_control._lanes['application.api_user_details', 'write'].acquire(0)
+    response = context.http.put(
+        "/api/user/{}".format(user.uuid),
+        data=json.dumps({'first_name': 'ramadan3'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(503)
+    response.headers['Retry-After'].should.equal('1')
+    json.loads(response.data).should.equal({'errors': ['The server is overloaded, retry later.']})
+    context.http.get("/api/user/{}".format(user.uuid)).status_code.should.equal(200)
+    context.http.get("/api/user/{}".format(user.uuid)).status_code.should.equal(200)
+
+    body = context.http.get("/metrics").data.decode()
+    body.should.match(r'http_requests_shed_total\{endpoint="application.api_user_details",lane="write"\} 1')
+    body.should.match(r'http_request_queue_seconds_count\{endpoint="application.api_user_details",lane="read"\} \d+')
+
+
+@web_test
+def test_admission_control_default_limits(context):
+    ("the shipped lanes leave a thread of the worker to the other endpoints while one is saturated")
+    context.web.config['ADMISSION_CONTROL_ENABLED'] = True
+    context.web.config['ADMISSION_QUEUE_TIMEOUT'] = 0
+    admission_control.init_app(context.web)
+    threads = context.web.config['ADMISSION_WORKER_THREADS']
+    for (endpoint, kind), lane in admission_control._lanes.items():
+        (lane.concurrency + lane.queue).should.be.lower_than(max(threads, 2))
+    user = User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    lane = admission_control._lanes['application.api_create_user', 'write']
+    for _ in range(lane.concurrency):
+        lane.acquire(0)
+    response = context.http.post(
+        "/api/user",
+        data=json.dumps({'first_name': 'ramadan', 'email': 'ramadan3@thebest.com', 'password': 'pass1234'}),
+        content_type='application/json',
+    )
+    response.status_code.should.equal(503)
+    context.http.get("/api/user/{}".format(user.uuid)).status_code.should.equal(200)
+
+
+@web_test
+def test_api_users_compressed(context):
+    ("GET on /api/users should be gzip compressed when the client accepts it, /api/example is too small")
+    for i in range(20):
+        User.create_user('user{}'.format(i), 'user{}@test.io'.format(i), 'pass1234')
+    response = context.http.get("/api/users", headers={'Accept-Encoding': 'gzip'})
+    response.status_code.should.equal(200)
+    response.headers["Content-Encoding"].should.equal("gzip")
+    users = json.loads(gzip.decompress(response.data))
+    len(users).should.equal(20)
+    response = context.http.get("/api/users?limit=20", headers={'Accept-Encoding': 'gzip'})
+    response.headers["Content-Encoding"].should.equal("gzip")
+    len(json.loads(gzip.decompress(response.data))['users']).should.equal(20)
+
+    response = context.http.get("/api/example", headers={'Accept-Encoding': 'gzip'})
+    response.headers.shouldnot.have.key("Content-Encoding")
+    json.loads(response.data).should.equal({"hello": "world"})
+
+
+@web_test
+def test_api_user_conditional_get(context):
+    ("GET on /api/user/<uuid> should answer 304 when the client has the current version")
+    user = User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    response = context.http.get("/api/user/{}".format(user.uuid))
+    response.status_code.should.equal(200)
+    etag = response.headers["ETag"]
+    etag.should.equal('"{}"'.format(user.etag))
+    last_modified = response.headers["Last-Modified"]
+
+    response = context.http.get("/api/user/{}".format(user.uuid), headers={'If-None-Match': etag})
+    response.status_code.should.equal(304)
+    response.data.should.equal(b'')
+    response.headers["ETag"].should.equal(etag)
+    response = context.http.get("/api/user/{}".format(user.uuid), headers={'If-Modified-Since': last_modified})
+    response.status_code.should.equal(304)
+
+    user.update_user('ramadan3', None, None)
+    response = context.http.get("/api/user/{}".format(user.uuid), headers={'If-None-Match': etag})
+    response.status_code.should.equal(200)
+    response.headers["ETag"].shouldnot.equal(etag)
+
+
+@web_test
+def test_api_user_put_if_match(context):
+    ("PUT on /api/user/<uuid> with If-Match should only update the version the client has")
+    user = User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    etag = context.http.get("/api/user/{}".format(user.uuid)).headers["ETag"]
+    response = context.http.put(
+        "/api/user/{}".format(user.uuid),
+        data=json.dumps({'first_name': 'ramadan3'}),
+        content_type='application/json',
+        headers={'If-Match': etag},
+    )
+    response.status_code.should.equal(200)
+    response.headers["ETag"].shouldnot.equal(etag)
+
+    response = context.http.put(
+        "/api/user/{}".format(user.uuid),
+        data=json.dumps({'first_name': 'ramadan4'}),
+        content_type='application/json',
+        headers={'If-Match': etag},
+    )
+    response.status_code.should.equal(412)
+    json.loads(response.data).should.equal({'user': ['The user was modified since it was read.']})
+    json.loads(context.http.get("/api/user/{}".format(user.uuid)).data)['first_name'].should.equal('ramadan3')
+
+
+@web_test
+def test_api_users_conditional_get(context):
+    ("GET on /api/users should answer 304 until a user is created, updated or deleted")
+    user = User.create_user('ramadan2', 'ramadan@thebest.com', 'pass12344')
+    for url in ("/api/users", "/api/users?limit=10"):
+        etag = context.http.get(url).headers["ETag"]
+        context.http.get(url, headers={'If-None-Match': etag}).status_code.should.equal(304)
+    page_etag = context.http.get("/api/users?limit=10").headers["ETag"]
+    context.http.get("/api/users?limit=5").headers["ETag"].shouldnot.equal(page_etag)
+    # `after` only pages the id order, a new user with a lower email is on this page
+    url = "/api/users?sort=email&after=100"
+    etag = context.http.get(url).headers["ETag"]
+    User.create_user('ramadan', 'aaa@thebest.com', 'pass12344')
+    context.http.get(url, headers={'If-None-Match': etag}).status_code.should.equal(200)
+
+    etag = context.http.get("/api/users").headers["ETag"]
+    user.update_user('ramadan3', None, None)
+    context.http.get("/api/users", headers={'If-None-Match': etag}).status_code.should.equal(200)
+    etag = context.http.get("/api/users").headers["ETag"]
+    User.delete_by_email('ramadan@thebest.com')
+    context.http.get("/api/users", headers={'If-None-Match': etag}).status_code.should.equal(200)
+
+
+
+@web_test
+def test_api_users_modified_since_a_delete(context):
+    ("GET on /api/users with If-Modified-Since should see that a user was deleted")
+    User.create_user('ramadan', 'ramadan@thebest.com', 'pass12344')
+    User.create_user('ramadan2', 'ramadan2@thebest.com', 'pass12344')
+    # modified long before the delete, Last-Modified only has seconds
+    db.session.execute(User.__table__.update().values(date_modified=datetime(2000, 1, 1)))
+    db.session.commit()
+    urls = ("/api/users", "/api/users?limit=10")
+    last_modified = {url: context.http.get(url).headers["Last-Modified"] for url in urls}
+    User.delete_by_email('ramadan2@thebest.com')
+    for url, date in last_modified.items():
+        response = context.http.get(url, headers={'If-Modified-Since': date})
+        response.status_code.should.equal(200)
+        response.headers["Last-Modified"].shouldnot.equal(date)
+
+
+@web_test
+def test_api_users_export(context):
+    ("GET on /api/users/export should stream the users as NDJSON or CSV")
+    users = [User.create_user('user{}'.format(i), 'user{}@test.io'.format(i), 'pass1234').to_dict()
+             for i in range(3)]
+    response = context.http.get("/api/users/export")
+    response.status_code.should.equal(200)
+    response.headers["Content-Type"].should.equal("application/x-ndjson")
+    response.headers["Content-Disposition"].should.equal("attachment; filename=users.ndjson")
+    [json.loads(line) for line in response.data.splitlines()].should.equal(users)
+
+    response = context.http.get("/api/users/export", headers={'Accept': 'text/csv'})
+    response.headers["Content-Type"].should.equal("text/csv")
+    response.data.decode().splitlines().should.equal(
+        ['first_name,email,uuid'] + ['{first_name},{email},{uuid}'.format(**user) for user in users])
+    context.http.get("/api/users/export?format=ndjson", headers={'Accept': 'text/csv'}) \
+        .headers["Content-Type"].should.equal("application/x-ndjson")
+
+    response = context.http.get("/api/users/export?format=xml")
+    response.status_code.should.equal(400)
+    json.loads(response.data).should.equal({'format': ['Must be one of ndjson, csv.']})
+
+
+@web_test
+def test_api_user_changes(context):
+    ("GET on /api/users/changes should return the users changed after the token, deletions included")
+    first = User.create_user('ramadan', 'ramadan@thebest.com', 'pass12344').to_dict()
+    second = User.create_user('ramadan2', 'ramadan2@thebest.com', 'pass12344').to_dict()
+    data = json.loads(context.http.get("/api/users/changes").data)
+    data['changes'].should.equal([dict(first, deleted=False), dict(second, deleted=False)])
+    data['more'].should.equal(False)
+    token = data['next']
+
+    json.loads(context.http.get("/api/users/changes?since={}".format(token)).data).should.equal(
+        {'changes': [], 'next': token, 'more': False})
+    context.http.put(
+        "/api/user/{}".format(first['uuid']),
+        data=json.dumps({'first_name': 'ramadan3'}),
+        content_type='application/json',
+    ).status_code.should.equal(200)
+    context.http.delete("/api/user/ramadan2@thebest.com").status_code.should.equal(200)
+
+    data = json.loads(context.http.get("/api/users/changes?since={}&limit=1".format(token)).data)
+    data['changes'].should.equal([dict(first, first_name='ramadan3', deleted=False)])
+    data['more'].should.equal(True)
+    data = json.loads(context.http.get("/api/users/changes?since={}".format(data['next'])).data)
+    data['changes'].should.equal([{'email': 'ramadan2@thebest.com', 'uuid': second['uuid'], 'deleted': True}])
+    data['more'].should.equal(False)
+
+    response = context.http.get("/api/users/changes?since=garbage")
+    response.status_code.should.equal(400)
+    json.loads(response.data).should.equal({'since': ['Invalid token.']})
+
+
+@web_test
+def test_api_users_search(context):
+    ("GET on /api/users should filter by email and first name prefix, substring and dates")
+    names = ['alice', 'alfred', 'bob', 'robert', 'roberta']
+    created = {name: User.create_user(name, '{}@{}.io'.format(name, 'test' if name < 'c' else 'other'),
+                                      'pass1234').date_created.isoformat() for name in names}
+
+    def search(query):
+        response = context.http.get("/api/users?" + query)
+        response.status_code.should.equal(200)
+        return [user['first_name'] for user in json.loads(response.data)['users']]
+
+    search("email=al").should.equal(['alice', 'alfred'])
+    search("first_name=rob").should.equal(['robert', 'roberta'])
+    search("q=BERT").should.equal(['robert', 'roberta'])
+    search("q=other.io").should.equal(['robert', 'roberta'])
+    search("q=ob").should.equal(['bob', 'robert', 'roberta'])
+    search("q=100%25").should.equal([])
+    search("first_name=rob&q=ta").should.equal(['roberta'])
+    search("created_after={}".format(created['bob'])).should.equal(['robert', 'roberta'])
+    search("created_before={}".format(created['bob'])).should.equal(['alice', 'alfred'])
+    search("modified_after=2000-01-01T00:00:00Z&modified_before=2000-01-02").should.equal([])
+
+
+@web_test
+def test_api_users_sort(context):
+    ("GET on /api/users?sort= should page through the users in the order of a column")
+    for name in ['carol', 'alice', 'bob', 'dave', 'erin']:
+        User.create_user(name, '{}@test.io'.format(name), 'pass1234')
+    data = json.loads(context.http.get("/api/users?sort=-first_name&limit=2").data)
+    [user['first_name'] for user in data['users']].should.equal(['erin', 'dave'])
+    data = json.loads(context.http.get("/api/users?sort=-first_name&limit=2&cursor={}".format(data['next'])).data)
+    [user['first_name'] for user in data['users']].should.equal(['carol', 'bob'])
+    data = json.loads(context.http.get("/api/users?sort=-first_name&limit=2&cursor={}".format(data['next'])).data)
+    [user['first_name'] for user in data['users']].should.equal(['alice'])
+    data['next'].should.be.none
+    data = json.loads(context.http.get("/api/users?sort=date_created&limit=3").data)
+    [user['first_name'] for user in data['users']].should.equal(['carol', 'alice', 'bob'])
+    data = json.loads(context.http.get("/api/users?sort=date_created&cursor={}".format(data['next'])).data)
+    [user['first_name'] for user in data['users']].should.equal(['dave', 'erin'])
+    data = json.loads(context.http.get("/api/users?sort=-id&limit=3").data)
+    [user['first_name'] for user in data['users']].should.equal(['erin', 'dave', 'bob'])
+    data = json.loads(context.http.get("/api/users?sort=-id&limit=3&cursor={}".format(data['next'])).data)
+    [user['first_name'] for user in data['users']].should.equal(['alice', 'carol'])
+    data['next'].should.be.none
+
+    response = context.http.get("/api/users?sort=password")
+    response.status_code.should.equal(400)
+    json.loads(response.data).should.equal({'sort': [
+        'Must be one of id, email, first_name, date_created, date_modified, with a leading - for descending order.']})
+    response = context.http.get("/api/users?sort=email&cursor=garbage")
+    response.status_code.should.equal(400)
+    json.loads(response.data).should.equal({'cursor': ['Invalid cursor.']})
+
+
+@web_test
+def test_api_users_fields(context):
+    ("?fields= should restrict the users returned by the read endpoints to the listed fields")
+    user = User.create_user('ramadan', 'ramadan@thebest.com', 'pass12344').to_dict()
+    response = context.http.get("/api/user/{}?fields=uuid,email".format(user['uuid']))
+    response.status_code.should.equal(200)
+    json.loads(response.data).should.equal({'email': user['email'], 'uuid': user['uuid']})
+    etag = response.headers['ETag']
+    etag.shouldnot.equal(context.http.get("/api/user/{}".format(user['uuid'])).headers['ETag'])
+    context.http.get("/api/user/{}?fields=uuid,email".format(user['uuid']), headers={'If-None-Match': etag}) \
+        .status_code.should.equal(304)
+
+    json.loads(context.http.get("/api/users?fields=uuid").data).should.equal([{'uuid': user['uuid']}])
+    json.loads(context.http.get("/api/users?fields=first_name&limit=5").data).should.equal(
+        {'users': [{'first_name': 'ramadan'}], 'next': None})
+    json.loads(context.http.get("/api/users?fields=email&sort=-email").data)['users'].should.equal(
+        [{'email': user['email']}])
+
+    response = context.http.get("/api/users?fields=uuid,password")
+    response.status_code.should.equal(400)
+    json.loads(response.data).should.equal(
+        {'fields': ['Unknown fields password, must be among first_name, email, uuid.']})
+    context.http.get("/api/user/{}?fields=id".format(user['uuid'])).status_code.should.equal(400)
+
+
+@web_test
+def test_api_users_lightweight_reads(context):
+    ("USERS_LIGHTWEIGHT_READS should not change the responses of the read endpoints")
+    for i in range(5):
+        User.create_user('user{}'.format(i), 'user{}@test.io'.format(i), 'pass1234')
+    uuid = User.query.first().uuid
+    urls = [
+        "/api/user/{}".format(uuid),
+        "/api/user/{}?fields=email".format(uuid),
+        "/api/users?limit=2",
+        "/api/users?limit=2&after=2",
+        "/api/users?sort=-email&limit=3&fields=uuid",
+        "/api/users?q=user&created_after=2000-01-01",
+    ]
+    expected = [(context.http.get(url).data, context.http.get(url).headers['ETag']) for url in urls]
+    context.web.config['USERS_LIGHTWEIGHT_READS'] = True
+    user_cache.clear()
+    [(context.http.get(url).data, context.http.get(url).headers['ETag']) for url in urls].should.equal(expected)
@@ -1 +1,4 @@
 import sure  # noqa
+
+# create the testing application before any test module imports the models
+from tests.functional.helpers import app  # noqa
@@ -0,0 +1,36 @@
+import threading
+
+from app.application.admission import Lane
+
+
+def test_lane_admits_up_to_its_concurrency():
+    lane = Lane(concurrency=2, queue=0)
+    lane.acquire(0).should.equal(0.0)
+    lane.acquire(0).should.equal(0.0)
+    lane.acquire(1).should.be.none
+    lane.release()
+    lane.acquire(0).should.equal(0.0)
+
+
+def test_lane_queued_request_gets_the_released_slot():
+    lane = Lane(concurrency=1, queue=1)
+    lane.acquire(0)
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(lane.acquire(5)))
+    waiter.start()
+    while not lane._waiting:
+        pass
+    # the queue is full, the next request is turned away without waiting
+    lane.acquire(5).should.be.none
+    lane.release()
+    waiter.join()
+    results[0].should.be.greater_than(0)
+    lane.active.should.equal(1)
+
+
+def test_lane_queue_timeout():
+    lane = Lane(concurrency=1, queue=1)
+    lane.acquire(0)
+    lane.acquire(0.01).should.be.none
+    lane._waiting.should.equal([])
+    lane.active.should.equal(1)
@@ -0,0 +1,75 @@
+import os
+import tempfile
+
+import app as app_package
+from app import create_app, db
+from app.application.cache import LRUCache, NullCache, user_cache
+from tests.functional.helpers import TemporaryDatabaseConfig
+
+
+def test_create_app_does_not_touch_the_database():
+    ("create_app() should not connect to the database until it is needed")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'app.db')
+        app = create_app(TemporaryDatabaseConfig(path))
+        os.path.exists(path).should.equal(False)
+        app.url_map.bind('').match('/api/users').should.equal(('application.api_list_users', {}))
+
+
+def test_applications_have_their_own_extensions():
+    ("an application created later should not reconfigure the extensions of the others")
+    with tempfile.TemporaryDirectory() as directory:
+        first = create_app(TemporaryDatabaseConfig(os.path.join(directory, 'first.db'), USER_CACHE_ENABLED=False))
+        second = create_app(TemporaryDatabaseConfig(os.path.join(directory, 'second.db')))
+        (first.extensions['user_cache'] is second.extensions['user_cache']).should.be.false
+        with first.app_context():
+            user_cache.backend.should.be.a(NullCache)
+        with second.app_context():
+            user_cache.backend.should.be.a(LRUCache)
+
+
+def test_init_db_command():
+    ("flask init-db should create the tables")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'app.db')
+        app = create_app(TemporaryDatabaseConfig(path))
+        result = app.test_cli_runner().invoke(args=['init-db'])
+        result.output.should.equal('Initialized the database.\n')
+        with app.app_context():
+            db.engine.table_names().should.contain('auth_user')
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+
+def test_init_db_command_adds_missing_indexes():
+    ("flask init-db should add the indexes declared since the tables were created")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'app.db')
+        app = create_app(TemporaryDatabaseConfig(path))
+        with app.app_context():
+            db.create_all()
+            db.engine.execute('DROP INDEX ix_auth_user_date_modified')
+            db.engine.execute('DROP TABLE auth_user_fts')
+        app.test_cli_runner().invoke(args=['init-db']).exit_code.should.equal(0)
+        with app.app_context():
+            indexes = sorted(index['name'] for index in db.inspect(db.engine).get_indexes('auth_user'))
+            indexes.should.equal(
+                ['ix_auth_user_date_created', 'ix_auth_user_date_modified', 'ix_auth_user_first_name'])
+            db.engine.table_names().should.contain('auth_user_fts')
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+
+def test_forked_children_drop_the_pooled_connections():
+    ("a child process should not reuse the connections its parent opened")
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(TemporaryDatabaseConfig(os.path.join(directory, 'app.db')))
+        with app.app_context():
+            db.engine.execute('SELECT 1')
+            db.engine.pool.checkedin().should.equal(1)
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0 if db.engine.pool.checkedin() == 0 else 1)
+            os.waitpid(pid, 0)[1].should.equal(0)
+            db.engine.dispose()
+        (app in app_package._apps).should.be.true
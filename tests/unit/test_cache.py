@@ -0,0 +1,100 @@
+from app.application.cache import LRUCache, NullCache, UserCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache_get_set():
+    cache = LRUCache(max_entries=2, ttl=10)
+    cache.get('a').should.equal(None)
+    cache.set('a', {'uuid': 'a'})
+    cache.get('a').should.equal({'uuid': 'a'})
+    cache.stats().should.equal({
+        'size': 1, 'max_entries': 2, 'ttl': 10, 'hits': 1, 'misses': 1, 'evictions': 0, 'expirations': 0,
+    })
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    cache.get('b').should.equal(None)
+    cache.get('a').should.equal(1)
+    cache.get('c').should.equal(3)
+    cache.stats()['evictions'].should.equal(1)
+
+
+def test_lru_cache_ttl():
+    clock = FakeClock()
+    cache = LRUCache(max_entries=2, ttl=10, clock=clock)
+    cache.set('a', 1)
+    clock.now = 9
+    cache.get('a').should.equal(1)
+    clock.now = 10
+    cache.get('a').should.equal(None)
+    cache.stats()['expirations'].should.equal(1)
+    cache.stats()['size'].should.equal(0)
+
+
+def test_lru_cache_delete_and_clear():
+    cache = LRUCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.delete('a')
+    cache.delete('missing')
+    cache.get('a').should.equal(None)
+    cache.clear()
+    cache.get('b').should.equal(None)
+
+
+def test_null_cache():
+    cache = NullCache(max_entries=2, ttl=10)
+    cache.set('a', 1)
+    cache.get('a').should.equal(None)
+    cache.stats().should.equal({})
+
+
+class FakeApp:
+    def __init__(self, config):
+        self.config = config
+        self.extensions = {}
+
+
+def test_user_cache_init_app():
+    user_cache = UserCache()
+    app = FakeApp({
+        'USER_CACHE_ENABLED': True,
+        'USER_CACHE_BACKEND': 'app.application.cache.LRUCache',
+        'USER_CACHE_MAX_ENTRIES': 5,
+        'USER_CACHE_TTL': 30,
+    })
+    user_cache.init_app(app)
+    app.extensions['user_cache'].should.equal(user_cache)
+    user_cache.backend.should.be.a(LRUCache)
+    user_cache.backend.max_entries.should.equal(5)
+    user_cache.set('uuid', {'uuid': 'uuid'})
+    user_cache.get('uuid').should.equal({'uuid': 'uuid'})
+    user_cache.invalidate('uuid')
+    user_cache.get('uuid').should.equal(None)
+
+    user_cache.init_app(FakeApp({'USER_CACHE_ENABLED': False}))
+    user_cache.backend.should.be.a(NullCache)
+
+
+def test_user_cache_skips_fills_older_than_an_invalidation():
+    user_cache = UserCache()
+    user_cache.init_app(FakeApp({'USER_CACHE_ENABLED': True}))
+    generation = user_cache.generation('uuid')
+    # a write commits and invalidates while the reader is reading the old row
+    user_cache.invalidate('uuid')
+    user_cache.set('uuid', {'first_name': 'old'}, generation)
+    user_cache.get('uuid').should.equal(None)
+    user_cache.set('uuid', {'first_name': 'new'}, user_cache.generation('uuid'))
+    user_cache.get('uuid').should.equal({'first_name': 'new'})
@@ -0,0 +1,84 @@
+import os
+import tempfile
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+from app import create_app, db
+from tests.functional.helpers import TemporaryDatabaseConfig
+
+
+def pragma(name):
+    return db.session.execute('PRAGMA {}'.format(name)).scalar()
+
+
+def test_sqlite_pragmas_are_set_on_connect():
+    ("every new sqlite connection should run the SQLITE_PRAGMAS")
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(TemporaryDatabaseConfig(
+            os.path.join(directory, 'app.db'),
+            SQLITE_PRAGMAS={'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 1234},
+        ))
+        with app.app_context():
+            pragma('journal_mode').should.equal('wal')
+            pragma('synchronous').should.equal(1)
+            pragma('busy_timeout').should.equal(1234)
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+
+def test_sqlite_without_pragmas_keeps_the_defaults():
+    ("an empty SQLITE_PRAGMAS should leave the sqlite defaults alone")
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(TemporaryDatabaseConfig(os.path.join(directory, 'app.db'), SQLITE_PRAGMAS={}))
+        with app.app_context():
+            pragma('journal_mode').should.equal('delete')
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+
+def test_sqlite_pool_size_defaults_to_threads_per_page():
+    ("file databases should be pooled, THREADS_PER_PAGE connections when DATABASE_POOL_SIZE is None")
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(TemporaryDatabaseConfig(
+            os.path.join(directory, 'app.db'),
+            THREADS_PER_PAGE=2, DATABASE_POOL_MAX_OVERFLOW=3, DATABASE_POOL_TIMEOUT=7,
+        ))
+        with app.app_context():
+            pool = db.get_engine(app).pool
+            pool.should.be.a(QueuePool)
+            pool.size().should.equal(2)
+            pool._max_overflow.should.equal(3)
+            pool._timeout.should.equal(7)
+
+
+def test_sqlite_pool_size_zero_disables_pooling():
+    ("DATABASE_POOL_SIZE = 0 should open a new connection for every checkout")
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(TemporaryDatabaseConfig(os.path.join(directory, 'app.db'), DATABASE_POOL_SIZE=0))
+        with app.app_context():
+            db.get_engine(app).pool.should.be.a(NullPool)
+
+
+def test_database_connect_options_are_passed_to_the_driver():
+    ("DATABASE_CONNECT_OPTIONS should end up in the connect_args of the engine")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'app.db')
+        app = create_app(TemporaryDatabaseConfig(path, DATABASE_CONNECT_OPTIONS={'timeout': 1}))
+        options = {}
+        db.apply_driver_hacks(app, make_url('sqlite:///' + path), options)
+        options['connect_args'].should.equal({'timeout': 1, 'check_same_thread': False})
+
+
+def test_check_connections_reports_the_failing_databases():
+    ("check_connections should report the error of every database that cannot be reached")
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(TemporaryDatabaseConfig(
+            os.path.join(directory, 'app.db'),
+            DATABASE_REPLICA_URIS=['sqlite:///' + os.path.join(directory, 'missing', 'replica.db')],
+        ))
+        with app.app_context():
+            errors = db.check_connections(app)
+            list(errors).should.equal(['replica_0'])
+            errors['replica_0'].should.match(r'unable to open database file')
+            db.get_engine(app).dispose()
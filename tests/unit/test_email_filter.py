@@ -0,0 +1,90 @@
+import threading
+
+from app.application.email_filter import BloomFilter, EmailFilter, email_filter
+from app.application.models import User
+from app.application.validators import find_existing_emails, validate_email_already_exists
+from tests.functional.helpers import web_test
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    emails = ['user{}@test.io'.format(i) for i in range(1000)]
+    for email in emails:
+        bloom.add(email)
+    all(email in bloom for email in emails).should.equal(True)
+    false_positives = sum('other{}@test.io'.format(i) in bloom for i in range(10000))
+    (false_positives / 10000).should.be.lower_than(0.02)
+    bloom.count.should.equal(1000)
+    bloom.hashes.should.equal(7)
+    bloom.memory_bytes.should.equal(1199)
+    bloom.estimated_false_positive_rate().should.be.lower_than(0.011)
+
+
+def test_email_filter_disabled():
+    disabled = EmailFilter()
+    disabled.might_contain('test@test.io').should.equal(True)
+    disabled.stats().should.equal({'enabled': False})
+
+
+@web_test
+def test_email_filter(context):
+    User.create_user('test', 'test@test.io', 'test')
+    context.web.config['EMAIL_FILTER_ENABLED'] = True
+    email_filter.init_app(context.web)
+    email_filter.build()
+
+    email_filter.might_contain('test@test.io').should.equal(True)
+    email_filter.might_contain('test1@test.io').should.equal(False)
+    User.create_user('test1', 'test1@test.io', 'test')
+    email_filter.might_contain('test1@test.io').should.equal(True)
+
+    validate_email_already_exists('test1@test.io').should.equal((False, 'Email already exists.'))
+    validate_email_already_exists('test2@test.io').should.equal((True, ''))
+    find_existing_emails(['test@test.io', 'test2@test.io']).should.equal({'test@test.io'})
+
+    stats = email_filter.stats()
+    stats['built'].should.equal(True)
+    stats['items'].should.equal(2)
+    stats['memory_bytes'].should.be.greater_than(0)
+    stats['negatives'].should.equal(3)
+    stats['false_positives'].should.equal(0)
+
+
+@web_test
+def test_email_filter_rebuild(context):
+    context.web.config['EMAIL_FILTER_ENABLED'] = True
+    email_filter.init_app(context.web)
+    email_filter.build()
+    email_filter.might_contain('test@test.io').should.equal(False)
+    # written by another process
+    User.query.session.execute(User.__table__.insert(), [
+        {'first_name': 'test', 'email': 'test@test.io', 'password': 'test', 'uuid': 'test'}])
+    User.query.session.commit()
+    email_filter.might_contain('test@test.io').should.equal(False)
+    email_filter.build()
+    email_filter.might_contain('test@test.io').should.equal(True)
+
+
+@web_test
+def test_email_filter_concurrent_builds(context):
+    User.create_user('test', 'test@test.io', 'test')
+    context.web.config['EMAIL_FILTER_ENABLED'] = True
+    email_filter.enabled = True
+    # every email goes to the database until the filter is built
+    email_filter.might_contain('other@test.io').should.equal(True)
+    errors = []
+
+    def build():
+        try:
+            email_filter.build()
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=build) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    errors.should.equal([])
+    email_filter.might_contain('test@test.io').should.equal(True)
+    email_filter.might_contain('other@test.io').should.equal(False)
@@ -0,0 +1,81 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.application.group_commit import group_committer
+from app.application.models import User, EmailAlreadyExists
+from tests.functional.helpers import web_test
+
+
+def enable_group_commit(context, max_wait=0.05):
+    context.web.config['GROUP_COMMIT_ENABLED'] = True
+    context.web.config['GROUP_COMMIT_MAX_WAIT'] = max_wait
+    group_committer.init_app(context.web)
+
+
+def run_concurrently(context, functions):
+    barrier = threading.Barrier(len(functions))
+
+    def run(function):
+        with context.web.app_context():
+            barrier.wait()
+            try:
+                return function()
+            except Exception as exc:
+                return exc
+
+    with ThreadPoolExecutor(len(functions)) as executor:
+        return list(executor.map(run, functions))
+
+
+@web_test
+def test_concurrent_writes_are_committed_together(context):
+    enable_group_commit(context)
+    users = run_concurrently(context, [
+        lambda i=i: User.create_user('user{}'.format(i), 'user{}@test.io'.format(i), 'pass1234') for i in range(8)
+    ])
+    sorted(user.email for user in users).should.equal(sorted('user{}@test.io'.format(i) for i in range(8)))
+    User.query.count().should.equal(8)
+    group_committer.writes.should.equal(8)
+    group_committer.batches.should.be.lower_than(8)
+    group_committer.shutdown()
+
+
+@web_test
+def test_a_failed_write_does_not_fail_its_batch(context):
+    enable_group_commit(context)
+    User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    results = run_concurrently(context, [
+        lambda: User.create_user('ramadan', 'ramadan@test.io', 'pass1234'),
+        lambda: User.create_user('other', 'other@test.io', 'pass1234'),
+        lambda: User.delete_by_email('nobody@test.io'),
+    ])
+    results[0].should.be.a(EmailAlreadyExists)
+    results[1].email.should.equal('other@test.io')
+    results[2].should.equal((False, {}))
+    User.query.count().should.equal(2)
+    group_committer.shutdown()
+
+
+@web_test
+def test_group_commit_updates_and_deletes(context):
+    enable_group_commit(context, max_wait=0)
+    user = User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    user.update_user('ramadan1', 'ramadan1@test.io', None)
+    user.first_name.should.equal('ramadan1')
+    User.query.filter_by(email='ramadan1@test.io').first().first_name.should.equal('ramadan1')
+    User.delete_by_email('ramadan1@test.io').should.equal((True, user.to_dict()))
+    User.query.count().should.equal(0)
+    group_committer.shutdown()
+
+
+@web_test
+def test_group_commit_through_the_api(context):
+    enable_group_commit(context, max_wait=0)
+    response = context.http.post('/api/user', json={
+        'first_name': 'ramadan', 'email': 'ramadan@test.io', 'password': 'pass1234'})
+    response.status_code.should.equal(200)
+    response = context.http.post('/api/user', json={
+        'first_name': 'ramadan', 'email': 'ramadan@test.io', 'password': 'pass1234'})
+    response.status_code.should.equal(400)
+    response.json.should.equal({'email': ['Email already exists.']})
+    group_committer.shutdown()
@@ -0,0 +1,49 @@
+from flask import g
+
+from tests.functional.helpers import app
+from app.application.instrumentation import RequestStats, timed, current_stats
+from app.application.validators import Schema, Field
+
+
+def test_request_stats():
+    stats = RequestStats()
+    stats.add_query('SELECT 1', 0.001)
+    stats.add_query('SELECT 1', 0.002)
+    stats.add_time('validation', 0.0005)
+    stats.queries.should.equal(2)
+    stats.server_timing(0.01).should.equal('db;dur=3.00;desc="2 queries", validation;dur=0.50, total;dur=10.00')
+
+
+def test_request_stats_warnings():
+    stats = RequestStats()
+    for _ in range(3):
+        stats.add_query('SELECT * FROM auth_user WHERE id = ?', 0)
+    stats.add_query('SELECT 1', 0)
+    stats.warnings(query_budget=10, n_plus_one_threshold=3).should.equal([
+        'N+1: 3 executions of SELECT * FROM auth_user WHERE id = ?',
+    ])
+    stats.warnings(query_budget=3, n_plus_one_threshold=4).should.equal([
+        'Query budget exceeded: 4 queries, budget 3',
+    ])
+
+
+def test_timed():
+    @timed('work')
+    def work():
+        return 'done'
+
+    work().should.equal('done')
+    with app.test_request_context():
+        current_stats().should.equal(None)
+        g.request_stats = RequestStats()
+        work().should.equal('done')
+        current_stats().timings.should.have.key('work')
+
+
+def test_schema_validation_timed_once():
+    with app.test_request_context():
+        stats = g.request_stats = RequestStats()
+        phases = []
+        stats.add_time = lambda name, duration: phases.append(name)
+        Schema(Field('email', required=True)).validate({'email': 'a@b.c'})
+        phases.should.equal(['validation'])
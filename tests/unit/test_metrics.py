@@ -0,0 +1,81 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from app.application.metrics import Registry, Counter, Gauge, Histogram, FileStore, format_labels
+
+
+def build_registry():
+    registry = Registry()
+    requests = registry.register(Counter('requests_total', 'Requests.', ('endpoint', 'status')))
+    in_flight = registry.register(Gauge('in_flight', 'In flight.'))
+    latency = registry.register(Histogram('latency_seconds', 'Latency.', ('endpoint',), buckets=(0.1, 1)))
+    return registry, requests, in_flight, latency
+
+
+def test_format_labels():
+    format_labels((), []).should.equal('')
+    format_labels(('a', 'b'), ['x', 'say "hi"']).should.equal('{a="x",b="say \\"hi\\""}')
+
+
+def test_registry_render():
+    registry, requests, in_flight, latency = build_registry()
+    requests.inc('users', '200')
+    requests.inc('users', '200')
+    requests.inc('users', '404')
+    in_flight.inc()
+    latency.observe(0.05, 'users')
+    latency.observe(0.1, 'users')
+    latency.observe(5, 'users')
+    registry.render(registry.snapshot()).should.equal('\n'.join([
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{endpoint="users",status="200"} 2',
+        'requests_total{endpoint="users",status="404"} 1',
+        '# HELP in_flight In flight.',
+        '# TYPE in_flight gauge',
+        'in_flight 1',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{endpoint="users",le="0.1"} 2',
+        'latency_seconds_bucket{endpoint="users",le="1.0"} 2',
+        'latency_seconds_bucket{endpoint="users",le="+Inf"} 3',
+        'latency_seconds_sum{endpoint="users"} 5.15',
+        'latency_seconds_count{endpoint="users"} 3',
+    ]) + '\n')
+
+
+def test_registry_merge():
+    registry, requests, in_flight, latency = build_registry()
+    requests.inc('users', '200')
+    latency.observe(0.05, 'users')
+    snapshot = registry.snapshot()
+    merged = registry.merge([snapshot, snapshot, {'unknown': [[[], 1]]}])
+    dict((tuple(labels), value) for labels, value in merged['requests_total']).should.equal({('users', '200'): 2})
+    merged['latency_seconds'].should.equal([[['users'], [2, 0, 0, 0.1]]])
+
+
+def test_file_store():
+    registry, requests, in_flight, latency = build_registry()
+    requests.inc('users', '200')
+    in_flight.set(3)
+    with tempfile.TemporaryDirectory() as directory:
+        store = FileStore(directory)
+        store.write(registry.snapshot())
+        # a process that is gone: its gauges are dropped
+        with open(os.path.join(directory, 'metrics-999999999.json'), 'w') as output:
+            output.write('{"requests_total": [[["users", "200"], 5]], "in_flight": [[[], 7]]}')
+        merged = registry.merge(store.read_all(registry))
+    merged['requests_total'].should.equal([[['users', '200'], 6]])
+    merged['in_flight'].should.equal([[[], 3]])
+
+
+def test_file_store_concurrent_writes():
+    registry, requests, in_flight, latency = build_registry()
+    requests.inc('users', '200')
+    with tempfile.TemporaryDirectory() as directory:
+        store = FileStore(directory)
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda _: store.write(registry.snapshot()), range(200)))
+        os.listdir(directory).should.equal(['metrics-{}.json'.format(os.getpid())])
+        registry.merge(store.read_all(registry))['requests_total'].should.equal([[['users', '200'], 1]])
@@ -1,4 +1,8 @@
-from app.application.models import User
+from datetime import datetime
+
+from app import db
+from app.application.models import User, UserRecord, EmailAlreadyExists, UserModified, CHANGED, DELETED, \
+    encode_change_token, decode_change_token, encode_cursor, decode_cursor
 from app.application.utils import get_md5
 from tests.functional.helpers import web_test
 
@@ -16,7 +20,64 @@ def test_update_user(context):
     User.query.filter_by(email='ramadan@test.io').first().should.equal(None)
     updated_user = User.query.filter_by(email='ramadan1@test.io').first()
     updated_user.first_name.should.equal('ramadan1')
-    updated_user.password.should.equal(get_md5('pass11234'))
+    updated_user.check_password('pass11234').should.equal(True)
+
+
+@web_test
+def test_update_user_if_modified_at(context):
+    user = User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    etag, date_modified = user.etag, user.date_modified
+    user.update_user('ramadan1', None, None, if_modified_at=date_modified)
+    user.date_modified.should.be.greater_than(date_modified)
+    user.etag.shouldnot.equal(etag)
+    User.update_user.when.called_with(user, 'ramadan2', None, None, if_modified_at=date_modified).should.throw(
+        UserModified)
+    User.query.filter_by(uuid=user.uuid).one().first_name.should.equal('ramadan1')
+
+
+@web_test
+def test_reads_skip_the_unused_columns(context):
+    user = User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    db.session.expunge_all()
+    loaded = User.get_by_uuid(user.uuid)
+    loaded.__dict__.should.have.key('date_modified')
+    loaded.__dict__.shouldnot.have.key('password')
+    loaded.__dict__.shouldnot.have.key('date_created')
+    db.session.expunge_all()
+    users, next_key = User.search(sort='email', fields=('uuid',))
+    users[0].__dict__.should.have.key('uuid')
+    users[0].__dict__.should.have.key('email')
+    users[0].__dict__.shouldnot.have.key('first_name')
+    users[0].__dict__.shouldnot.have.key('password')
+    list(User.iter_rows(('uuid',))).should.equal([(user.uuid,)])
+
+
+@web_test
+def test_records_match_the_users(context):
+    user = User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    record = User.get_record(user.uuid)
+    record.should.be.a(UserRecord)
+    record.to_dict().should.equal(user.to_dict())
+    record.etag.should.equal(user.etag)
+    record.date_modified.should.equal(user.date_modified)
+    User.get_record(user.uuid, ('uuid',)).to_dict(('uuid',)).should.equal({'uuid': user.uuid})
+    User.get_record('unknown').should.be.none
+    records, next_key = User.search(sort='-email', records=True)
+    [record.to_dict() for record in records].should.equal([user.to_dict()])
+    records[0].password.should.equal(user.password)
+
+
+@web_test
+def test_list_version(context):
+    etag, last_modified = User.list_version()
+    last_modified.should.be.none
+    user = User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    created_etag, last_modified = User.list_version()
+    created_etag.shouldnot.equal(etag)
+    last_modified.should.equal(user.date_modified)
+    User.list_version(after=user.id)[0].should.equal(User.list_version(after=user.id)[0])
+    user.update_user('ramadan1', None, None)
+    User.list_version()[0].shouldnot.equal(created_etag)
 
 
 @web_test
@@ -34,7 +95,8 @@ def test_create_user(context):
     user = User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
     user.first_name.should.equal('ramadan')
     user.email.should.equal('ramadan@test.io')
-    user.password.should.equal(get_md5('pass1234'))
+    user.password.should.match(r'^pbkdf2_sha256\$1000\$')
+    user.check_password('pass1234').should.equal(True)
     User.query.filter_by(email='ramadan@test.io').first().shouldnot.equal(None)
 
 
@@ -47,4 +109,112 @@ def test_delete_by_email(context):
         'email': 'ramadan@test.io',
         'uuid': user.uuid,
     }))
-    User.query.filter_by(email='ramadan@test.io').first().should.equal(None)
\ No newline at end of file
+    User.query.filter_by(email='ramadan@test.io').first().should.equal(None)
+
+
+@web_test
+def test_bulk_create_users(context):
+    User.bulk_create_users([]).should.equal([])
+    created = User.bulk_create_users([
+        {'first_name': 'ramadan', 'email': 'ramadan@test.io', 'password': 'pass1234'},
+        {'first_name': 'ramadan1', 'email': 'ramadan1@test.io', 'password': 'pass1234'},
+    ])
+    created.should.equal([
+        {'first_name': 'ramadan', 'email': 'ramadan@test.io', 'uuid': get_md5('ramadan:ramadan@test.io')},
+        {'first_name': 'ramadan1', 'email': 'ramadan1@test.io', 'uuid': get_md5('ramadan1:ramadan1@test.io')},
+    ])
+    [user.to_dict() for user in User.query.order_by(User.id)].should.equal(created)
+    User.query.filter_by(email='ramadan@test.io').first().check_password('pass1234').should.equal(True)
+
+
+@web_test
+def test_create_user_email_already_exists(context):
+    User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    User.create_user.when.called_with('ramadan1', 'ramadan@test.io', 'pass1234').should.throw(EmailAlreadyExists)
+    User.query.count().should.equal(1)
+
+
+@web_test
+def test_update_user_email_already_exists(context):
+    User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    user = User.create_user('ramadan1', 'ramadan1@test.io', 'pass1234')
+    user.update_user.when.called_with('ramadan2', 'ramadan@test.io', None).should.throw(EmailAlreadyExists)
+    User.query.filter_by(email='ramadan1@test.io').first().first_name.should.equal('ramadan1')
+
+
+@web_test
+def test_check_password_upgrades_legacy_md5(context):
+    user = User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    user.password = get_md5('pass1234')
+    user.check_password('wrong').should.equal(False)
+    user.password.should.equal(get_md5('pass1234'))
+    user.check_password('pass1234').should.equal(True)
+    User.query.filter_by(email='ramadan@test.io').first().password.should.match(r'^pbkdf2_sha256\$1000\$')
+
+
+def test_change_token():
+    key = (datetime(2020, 1, 2, 3, 4, 5, 6), DELETED, 42)
+    decode_change_token(encode_change_token(key)).should.equal(key)
+    decode_change_token.when.called_with('not a token').should.throw(ValueError)
+    decode_change_token.when.called_with(encode_change_token(key[:2] + (10 ** 30,))).should.throw(ValueError)
+
+
+def test_cursor():
+    decode_cursor(encode_cursor(('a@test.io', 42)), 'email').should.equal(('a@test.io', 42))
+    decode_cursor(encode_cursor((42,)), '-id').should.equal((42,))
+    decode_cursor.when.called_with(encode_cursor((10 ** 30,)), '-id').should.throw(ValueError)
+    decode_cursor.when.called_with(encode_cursor(('a@test.io', 10 ** 30)), 'email').should.throw(ValueError)
+    decode_cursor.when.called_with(encode_cursor((10 ** 30, 1)), 'email').should.throw(ValueError)
+
+
+@web_test
+def test_get_changes(context):
+    first = User.create_user('ramadan', 'ramadan@test.io', 'pass1234')
+    second = User.create_user('ramadan1', 'ramadan1@test.io', 'pass1234')
+    changes, more = User.get_changes()
+    [(kind, data['email']) for key, kind, data in changes].should.equal(
+        [(CHANGED, 'ramadan@test.io'), (CHANGED, 'ramadan1@test.io')])
+    more.should.equal(False)
+    since = changes[-1][0]
+
+    first.update_user('renamed', None, None)
+    User.delete_by_email('ramadan1@test.io')
+    changes, more = User.get_changes(since)
+    [(kind, data['uuid']) for key, kind, data in changes].should.equal([(CHANGED, first.uuid), (DELETED, second.uuid)])
+    changes, more = User.get_changes(since, limit=1)
+    len(changes).should.equal(1)
+    more.should.equal(True)
+    User.get_changes(User.get_changes(since)[0][-1][0]).should.equal(([], False))
+    # too recent to be reported
+    User.get_changes(since, settle_time=60).should.equal(([], False))
+
+
+@web_test
+def test_search_prefixes_of_the_last_characters(context):
+    for email in ['a\U0010ffff@test.io', 'a\ud7ff@test.io', 'b@test.io']:
+        User.create_user('ramadan', email, 'pass1234')
+
+    def emails(prefix):
+        return [user.email for user in User.search(User.search_criteria(email=prefix), sort='email')[0]]
+
+    emails('a\U0010ffff').should.equal(['a\U0010ffff@test.io'])
+    emails('\U0010ffff').should.equal([])
+    emails('a\ud7ff').should.equal(['a\ud7ff@test.io'])
+
+
+@web_test
+def test_search_uses_the_indexes(context):
+    def plan(criteria):
+        query = User.query.filter(*criteria).statement.compile(db.engine)
+        params = [query.params[name] for name in query.positiontup]
+        rows = db.session.connection().execute('EXPLAIN QUERY PLAN {}'.format(query), *params)
+        return ' '.join(row[-1] for row in rows)
+
+    plan(User.search_criteria(email='ram')).should.match(
+        r'USING INDEX sqlite_autoindex_auth_user_\d \(email>\? AND email<\?\)')
+    plan(User.search_criteria(first_name='ram')).should.match(r'USING INDEX ix_auth_user_first_name')
+    plan(User.search_criteria(text='madan')).should.match(r'VIRTUAL TABLE INDEX')
+    plan(User.search_criteria(created_after=datetime(2020, 1, 1))).should.match(
+        r'USING INDEX ix_auth_user_date_created')
+    plan(User.search_criteria(modified_before=datetime(2020, 1, 1))).should.match(
+        r'USING INDEX ix_auth_user_date_modified')
@@ -0,0 +1,60 @@
+from app.application.passwords import make_password, parse_password, check_password, PasswordHasher, \
+    PBKDF2_SHA256, SCRYPT
+
+
+def test_make_password_pbkdf2_sha256():
+    encoded = make_password('secret', PBKDF2_SHA256, (1000,), salt=b'salt')
+    encoded.should.equal('pbkdf2_sha256$1000$73616c74$' + __import__('hashlib').pbkdf2_hmac(
+        'sha256', b'secret', b'salt', 1000, 32).hex())
+    parse_password(encoded).should.equal((PBKDF2_SHA256, (1000,)))
+    check_password('secret', encoded).should.equal(True)
+    check_password('wrong', encoded).should.equal(False)
+
+
+def test_make_password_scrypt():
+    encoded = make_password('secret', SCRYPT, (16, 8, 1))
+    encoded.should.match(r'^scrypt\$16\$8\$1\$[0-9a-f]{32}\$[0-9a-f]{64}$')
+    parse_password(encoded).should.equal((SCRYPT, (16, 8, 1)))
+    check_password('secret', encoded).should.equal(True)
+    check_password('wrong', encoded).should.equal(False)
+
+
+def test_make_password_uses_random_salt():
+    make_password('secret', PBKDF2_SHA256, (1,)).shouldnot.equal(make_password('secret', PBKDF2_SHA256, (1,)))
+
+
+def test_make_password_unknown_algorithm():
+    make_password.when.called_with('secret', 'md4', (1,)).should.throw(ValueError)
+
+
+def test_legacy_md5_password():
+    encoded = '5ebe2294ecd0e0f08eab7690d2a6ee69'
+    parse_password(encoded).should.equal(('md5', ()))
+    check_password('secret', encoded).should.equal(True)
+    check_password('wrong', encoded).should.equal(False)
+
+
+def test_password_hasher():
+    hasher = PasswordHasher()
+    hasher.configure(PBKDF2_SHA256, (10,))
+    encoded = hasher.hash('secret')
+    check_password('secret', encoded).should.equal(True)
+    hasher.needs_rehash(encoded).should.equal(False)
+    hasher.needs_rehash('5ebe2294ecd0e0f08eab7690d2a6ee69').should.equal(True)
+    [check_password('secret', item) for item in hasher.hash_many(['secret', 'secret'])].should.equal([True, True])
+
+    hasher.configure(SCRYPT, (16, 8, 1))
+    hasher.needs_rehash(encoded).should.equal(True)
+    hasher.configure.when.called_with('md4', (1,)).should.throw(ValueError)
+
+
+def test_password_hasher_process_pool():
+    hasher = PasswordHasher()
+    hasher.configure(PBKDF2_SHA256, (10,), workers=1, max_pending=2)
+    try:
+        check_password('secret', hasher.hash('secret')).should.equal(True)
+        [check_password('secret', item) for item in hasher.hash_many(['secret', 'secret'])].should.equal([True, True])
+        # more passwords than max_pending: they wait for the slots freed by the first ones
+        [check_password('secret', item) for item in hasher.hash_many(['secret'] * 5)].should.equal([True] * 5)
+    finally:
+        hasher.shutdown()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+
+from app import create_app, db
+from app.application.replication import SQLiteReplicator
+from tests.functional.helpers import TemporaryDatabaseConfig
+
+
+def replicated_app(directory):
+    app = create_app(TemporaryDatabaseConfig(
+        os.path.join(directory, 'primary.db'),
+        DATABASE_REPLICA_URIS=['sqlite:///' + os.path.join(directory, 'replica.db')],
+        USER_CACHE_ENABLED=False,
+    ))
+    with app.app_context():
+        db.create_all()
+    SQLiteReplicator.from_app(app).sync()
+    return app
+
+
+def close(app):
+    with app.app_context():
+        db.session.remove()
+        for bind in (None, 'replica_0'):
+            db.get_engine(app, bind=bind).dispose()
+
+
+def test_reads_go_to_the_replica():
+    ("GET requests should read from the replica, which only sees the writes once replicated")
+    with tempfile.TemporaryDirectory() as directory:
+        app = replicated_app(directory)
+        response = app.test_client().post('/api/user', json={
+            'first_name': 'ramadan', 'email': 'ramadan@test.io', 'password': 'pass1234'})
+        response.status_code.should.equal(200)
+        url = '/api/user/{}'.format(response.json['uuid'])
+
+        app.test_client().get(url).status_code.should.equal(404)
+        SQLiteReplicator.from_app(app).sync()
+        app.test_client().get(url).status_code.should.equal(200)
+        close(app)
+
+
+def test_clients_read_their_own_writes():
+    ("a client that just wrote should read from the primary until the window is over")
+    with tempfile.TemporaryDirectory() as directory:
+        app = replicated_app(directory)
+        client = app.test_client()
+        response = client.post('/api/user', json={
+            'first_name': 'ramadan', 'email': 'ramadan@test.io', 'password': 'pass1234'})
+        response.headers['Set-Cookie'].should.match(r'^read_primary_until=')
+        url = '/api/user/{}'.format(response.json['uuid'])
+
+        client.get(url).status_code.should.equal(200)
+        app.config['DATABASE_READ_YOUR_WRITES_WINDOW'] = -1
+        client.put(url, json={'first_name': 'ramadan2'}).status_code.should.equal(200)
+        client.get(url).status_code.should.equal(404)
+        close(app)
+
+
+def test_failed_writes_do_not_stick_to_the_primary():
+    ("a write answered with an error should not send the reads of the client to the primary")
+    with tempfile.TemporaryDirectory() as directory:
+        app = replicated_app(directory)
+        response = app.test_client().post('/api/user', json={'first_name': 'ramadan'})
+        response.status_code.should.equal(400)
+        response.headers.shouldnt.have.key('Set-Cookie')
+        close(app)
+
+
+def test_replicator_copies_the_primary():
+    ("sync should make every replica a copy of the primary")
+    with tempfile.TemporaryDirectory() as directory:
+        app = replicated_app(directory)
+        with app.app_context():
+            db.session.execute("INSERT INTO auth_user (first_name, email, password) VALUES ('a', 'a@b.c', 'x')")
+            db.session.commit()
+            SQLiteReplicator.from_app(app).sync()
+            db.get_engine(app, bind='replica_0').execute('SELECT email FROM auth_user').scalar().should.equal('a@b.c')
+        close(app)
+
+
+def test_replica_reads_do_not_fill_the_user_cache():
+    ("a lagging replica should not cache a user older than the writes of the client")
+    with tempfile.TemporaryDirectory() as directory:
+        app = replicated_app(directory)
+        app.config['USER_CACHE_ENABLED'] = True
+        user_cache = app.extensions['user_cache']
+        user_cache.init_app(app)
+        writer, reader = app.test_client(), app.test_client()
+        response = writer.post('/api/user', json={
+            'first_name': 'ramadan', 'email': 'ramadan@test.io', 'password': 'pass1234'})
+        url = '/api/user/{}'.format(response.json['uuid'])
+        SQLiteReplicator.from_app(app).sync()
+        reader.get(url).json['first_name'].should.equal('ramadan')
+
+        writer.put(url, json={'first_name': 'ramadan2'}).status_code.should.equal(200)
+        reader.get(url).json['first_name'].should.equal('ramadan')
+        writer.get(url).json['first_name'].should.equal('ramadan2')
+        user_cache.stats()['size'].should.equal(1)
+        close(app)
@@ -0,0 +1,174 @@
+import os
+import tempfile
+
+from app import create_app, db
+from app.application.models import User
+from app.application.sharding import user_shards, PRIMARY
+from tests.functional.helpers import TemporaryDatabaseConfig
+
+
+def sharded_config(directory, shards):
+    return TemporaryDatabaseConfig(
+        os.path.join(directory, 'primary.db'),
+        USER_SHARDS=['sqlite:///' + os.path.join(directory, 'shard{}.db'.format(i)) for i in range(shards)],
+        USER_CACHE_ENABLED=False,
+    )
+
+
+def sharded_app(directory, shards=3):
+    app = create_app(sharded_config(directory, shards))
+    app.test_cli_runner().invoke(args=['init-db']).exit_code.should.equal(0)
+    return app
+
+
+def create_users(client, count):
+    return [
+        client.post('/api/user', json={
+            'first_name': 'user{}'.format(i), 'email': 'user{}@test.io'.format(i), 'password': 'pass1234'}).json
+        for i in range(count)
+    ]
+
+
+def stored_uuids(app, shard_id):
+    with app.app_context():
+        return {uuid for uuid, in user_shards.engine(shard_id).execute('SELECT uuid FROM auth_user')}
+
+
+def close(app):
+    with app.app_context():
+        user_shards.session.remove()
+        db.session.remove()
+        for engine in user_shards.engines().values():
+            engine.dispose()
+
+
+def test_users_are_stored_on_the_shard_of_their_uuid():
+    ("each user should be written to shard int(uuid, 16) % len(USER_SHARDS) only")
+    with tempfile.TemporaryDirectory() as directory:
+        app = sharded_app(directory)
+        users = create_users(app.test_client(), 12)
+        for shard_id in range(3):
+            stored_uuids(app, shard_id).should.equal(
+                {user['uuid'] for user in users if int(user['uuid'], 16) % 3 == shard_id})
+        stored_uuids(app, PRIMARY).should.equal(set())
+        close(app)
+
+
+def test_sharded_reads_and_writes():
+    ("lookups by uuid and email, updates and deletes should find the shard of the user")
+    with tempfile.TemporaryDirectory() as directory:
+        app = sharded_app(directory)
+        client = app.test_client()
+        users = create_users(client, 6)
+        for user in users:
+            client.get('/api/user/{}'.format(user['uuid'])).json.should.equal(user)
+
+        response = client.post('/api/user', json={
+            'first_name': 'again', 'email': 'user3@test.io', 'password': 'pass1234'})
+        response.status_code.should.equal(400)
+        response.json.should.equal({'email': ['Email already exists.']})
+
+        response = client.put('/api/user/{}'.format(users[0]['uuid']), json={'email': 'renamed@test.io'})
+        response.status_code.should.equal(200)
+        response = client.put('/api/user/{}'.format(users[1]['uuid']), json={'email': 'renamed@test.io'})
+        response.status_code.should.equal(400)
+
+        client.delete('/api/user/renamed@test.io').json['uuid'].should.equal(users[0]['uuid'])
+        changes = client.get('/api/users/changes').json['changes']
+        [change['uuid'] for change in changes if not change['deleted']].should.equal(
+            [user['uuid'] for user in users[1:]])
+        [change['uuid'] for change in changes if change['deleted']].should.equal([users[0]['uuid']])
+        client.get('/api/user/{}'.format(users[0]['uuid'])).status_code.should.equal(404)
+        response = client.post('/api/user', json={
+            'first_name': 'user0', 'email': 'renamed@test.io', 'password': 'pass1234'})
+        response.status_code.should.equal(200)
+        close(app)
+
+
+def test_sharded_lists_are_merged_by_id():
+    ("the users list should gather every shard, in id order, paginated or streamed")
+    with tempfile.TemporaryDirectory() as directory:
+        app = sharded_app(directory)
+        client = app.test_client()
+        users = create_users(client, 10)
+        emails = [user['email'] for user in users]
+
+        [user['email'] for user in client.get('/api/users').json].should.equal(emails)
+        export = client.get('/api/users/export?format=csv').data.decode().splitlines()
+        [line.split(',')[1] for line in export[1:]].should.equal(emails)
+        page = client.get('/api/users?limit=4').json
+        [user['email'] for user in page['users']].should.equal(emails[:4])
+        page = client.get('/api/users?limit=4&after={}'.format(page['next'])).json
+        [user['email'] for user in page['users']].should.equal(emails[4:8])
+        page = client.get('/api/users?sort=-email&limit=4').json
+        [user['email'] for user in page['users']].should.equal(sorted(emails, reverse=True)[:4])
+        page = client.get('/api/users?sort=-email&cursor={}'.format(page['next'])).json
+        [user['email'] for user in page['users']].should.equal(sorted(emails, reverse=True)[4:])
+        [user['email'] for user in client.get('/api/users?q=user1').json['users']].should.equal(['user1@test.io'])
+        app.config['USERS_LIGHTWEIGHT_READS'] = True
+        page = client.get('/api/users?sort=-email&limit=4').json
+        [user['email'] for user in page['users']].should.equal(sorted(emails, reverse=True)[:4])
+        client.get('/api/user/{}'.format(users[3]['uuid'])).json.should.equal(users[3])
+        with app.app_context():
+            User.query.count().should.equal(10)
+        etag = client.get('/api/users').headers['ETag']
+        client.get('/api/users', headers={'If-None-Match': etag}).status_code.should.equal(304)
+        close(app)
+
+
+def test_sharded_bulk_create():
+    ("bulk creates should be split by shard and report the duplicate emails")
+    with tempfile.TemporaryDirectory() as directory:
+        app = sharded_app(directory)
+        client = app.test_client()
+        create_users(client, 1)
+        response = client.post('/api/users/bulk', json=[
+            {'first_name': 'user{}'.format(i), 'email': 'user{}@test.io'.format(i), 'password': 'pass1234'}
+            for i in range(5)
+        ])
+        [item['status'] for item in response.json].should.equal([400, 200, 200, 200, 200])
+        [user['email'] for user in client.get('/api/users').json].should.equal(
+            ['user{}@test.io'.format(i) for i in range(5)])
+        close(app)
+
+
+def test_rebalance_after_adding_a_shard():
+    ("rebalance-users should move the users to their shard once a shard is added")
+    with tempfile.TemporaryDirectory() as directory:
+        app = sharded_app(directory, shards=2)
+        users = create_users(app.test_client(), 12)
+        close(app)
+
+        app = sharded_app(directory, shards=3)
+        result = app.test_cli_runner().invoke(args=['rebalance-users'])
+        moved = sum(1 for user in users if int(user['uuid'], 16) % 3 != int(user['uuid'], 16) % 2)
+        result.output.should.equal('Moved {} users.\n'.format(moved))
+        for shard_id in range(3):
+            stored_uuids(app, shard_id).should.equal(
+                {user['uuid'] for user in users if int(user['uuid'], 16) % 3 == shard_id})
+        client = app.test_client()
+        for user in users:
+            client.get('/api/user/{}'.format(user['uuid'])).json.should.equal(user)
+        client.delete('/api/user/{}'.format(users[0]['email'])).status_code.should.equal(200)
+        close(app)
+
+
+def test_rebalance_from_an_unsharded_table():
+    ("rebalance-users --from-primary should move an unsharded auth_user table onto the shards")
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(sharded_config(directory, 0))
+        app.test_cli_runner().invoke(args=['init-db'])
+        users = create_users(app.test_client(), 6)
+        with app.app_context():
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+        app = sharded_app(directory, shards=2)
+        result = app.test_cli_runner().invoke(args=['rebalance-users', '--from-primary'])
+        result.output.should.equal('Moved 6 users.\n')
+        stored_uuids(app, PRIMARY).should.equal(set())
+        client = app.test_client()
+        for user in users:
+            client.get('/api/user/{}'.format(user['uuid'])).json.should.equal(user)
+        [user['email'] for user in client.get('/api/users').json].should.equal([user['email'] for user in users])
+        close(app)
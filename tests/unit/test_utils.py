@@ -1,5 +1,12 @@
+import gzip
+import hashlib
+import io
+import zlib
+
 from flask import Response
-from app.application.utils import json_response, get_md5
+from tests.functional.helpers import app
+from app.application.utils import json_response, json_stream_response, get_md5, get_hash, hash_stream, set_json_encoder, \
+    stdlib_json_encoder, compress_response, export_stream_response
 
 
 def test_json_response_returns_flask_response():
@@ -21,8 +28,123 @@ def test_json_response_returns_flask_response():
     response.headers["Content-Type"].should.equal("application/json")
 
     # And the data should be serialized as json
-    response.data.should.equal(b'{\n  "foo": "bar"\n}')
+    response.data.should.equal(b'{"foo":"bar"}')
 
 
 def test_get_md5():
     get_md5('test').should.equal('098f6bcd4621d373cade4e832627b4f6')
+
+
+def test_json_response_pretty():
+    ("json_response() should indent the output only when asked for")
+    json_response({"foo": "bar"}, pretty=True).data.should.equal(b'{\n  "foo": "bar"\n}')
+    with app.test_request_context('/?pretty=1'):
+        json_response({"foo": "bar"}).data.should.equal(b'{\n  "foo": "bar"\n}')
+
+
+def test_json_response_pre_encoded():
+    ("json_response() should send bytes as they are")
+    json_response(b'{"foo":"bar"}').data.should.equal(b'{"foo":"bar"}')
+
+
+def test_json_response_headers_are_not_shared():
+    ("json_response() should not modify the headers it was given")
+    headers = {"X-Foo": 1}
+    response = json_response({}, headers=headers)
+    response.headers["X-Foo"].should.equal("1")
+    headers.should.equal({"X-Foo": 1})
+    json_response({}).headers.shouldnot.have.key("X-Foo")
+
+
+def test_set_json_encoder():
+    ("set_json_encoder() should replace the encoder used by json_response")
+    previous = set_json_encoder(lambda data, pretty: b'encoded')
+    try:
+        json_response({"foo": "bar"}).data.should.equal(b'encoded')
+    finally:
+        set_json_encoder(previous)
+    stdlib_json_encoder({"foo": ["bar", 1]}).should.equal(b'{"foo":["bar",1]}')
+
+
+def test_json_stream_response():
+    ("json_stream_response() should stream an iterable as a json array")
+    with app.test_request_context():
+        response = json_stream_response(iter([{"foo":"bar"},{"foo":"baz"}]))
+        response.should.be.a(Response)
+        response.is_streamed.should.equal(True)
+        response.headers["Content-Type"].should.equal("application/json")
+        response.get_data().should.equal(b'[{"foo":"bar"},{"foo":"baz"}]')
+
+
+def test_json_stream_response_empty():
+    with app.test_request_context():
+        response = json_stream_response(iter([]))
+        response.get_data().should.equal(b'[]')
+
+
+def test_export_stream_response():
+    ("export_stream_response() should stream rows as NDJSON or CSV")
+    rows = [('ramadan', 'ramadan@test.io'), ('comma, "quoted"', 'other@test.io')]
+    with app.test_request_context():
+        response = export_stream_response(('name', 'email'), iter(rows), 'ndjson')
+        response.is_streamed.should.equal(True)
+        response.headers["Content-Type"].should.equal("application/x-ndjson")
+        response.get_data().should.equal(
+            b'{"name":"ramadan","email":"ramadan@test.io"}\n'
+            b'{"name":"comma, \\"quoted\\"","email":"other@test.io"}\n')
+        response = export_stream_response(('name', 'email'), iter(rows), 'csv')
+        response.headers["Content-Type"].should.equal("text/csv")
+        response.get_data().should.equal(
+            b'name,email\r\nramadan,ramadan@test.io\r\n"comma, ""quoted""",other@test.io\r\n')
+
+
+def test_get_hash():
+    get_hash('test').should.equal('098f6bcd4621d373cade4e832627b4f6')
+    get_hash('test', 'sha1').should.equal(hashlib.sha1(b'test').hexdigest())
+
+
+def test_hash_stream():
+    ("hash_stream() should hash a file-like object chunk by chunk")
+    data = b'0123456789' * 1000
+    hash_stream(io.BytesIO(data), 'sha256', chunk_size=7).should.equal(hashlib.sha256(data).hexdigest())
+    hash_stream(io.BytesIO(b'')).should.equal(hashlib.md5(b'').hexdigest())
+
+
+def test_compress_response():
+    ("compress_response() should compress large bodies with the encoding the client prefers")
+    data = [{"email": "user{}@test.io".format(i)} for i in range(200)]
+    with app.test_request_context(headers={'Accept-Encoding': 'deflate;q=0.5, gzip'}):
+        response = compress_response(json_response(data))
+        response.headers["Content-Encoding"].should.equal("gzip")
+        response.headers["Vary"].should.equal("Accept-Encoding")
+        int(response.headers["Content-Length"]).should.equal(len(response.data))
+        gzip.decompress(response.data).should.equal(json_response(data).data)
+    with app.test_request_context(headers={'Accept-Encoding': 'deflate'}):
+        response = compress_response(json_response(data))
+        response.headers["Content-Encoding"].should.equal("deflate")
+        zlib.decompress(response.data).should.equal(json_response(data).data)
+
+
+def test_compress_response_skipped():
+    ("compress_response() should leave small bodies and clients without Accept-Encoding alone")
+    data = [{"email": "user{}@test.io".format(i)} for i in range(200)]
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = compress_response(json_response({"foo": "bar"}))
+        response.headers.shouldnot.have.key("Content-Encoding")
+        response.data.should.equal(b'{"foo":"bar"}')
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip;q=0, identity'}):
+        response = compress_response(json_response(data))
+        response.headers.shouldnot.have.key("Content-Encoding")
+        response.headers["Vary"].should.equal("Accept-Encoding")
+
+
+def test_compress_response_stream():
+    ("compress_response() should compress streamed bodies chunk by chunk")
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = compress_response(json_stream_response(iter([{"foo": "bar"}, {"foo": "baz"}])))
+        response.is_streamed.should.equal(True)
+        response.headers["Content-Encoding"].should.equal("gzip")
+        response.headers.shouldnot.have.key("Content-Length")
+        chunks = list(response.response)
+        len(chunks).should.be.greater_than(1)
+        gzip.decompress(b''.join(chunks)).should.equal(b'[{"foo":"bar"},{"foo":"baz"}]')
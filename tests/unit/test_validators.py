@@ -1,6 +1,8 @@
 from app.application.models import User
 from app.application.validators import validate_email_format, validate_email_already_exists, validate_field_required, \
-    run_validators
+    find_existing_emails, validate_hash_algorithm, validate_string_or_list_of_strings, \
+    validate_optional_non_negative_integer, validate_optional_positive_integer, run_validators, Schema, Field, \
+    BatchCheck, EMAIL_NOT_TAKEN, validate_optional_export_format
 from tests.functional.helpers import web_test
 
 
@@ -17,6 +19,10 @@ def test_validate_email_format():
     is_valid.should.equal(False)
     err_msg.should.equal('Invalid Email format.')
 
+    is_valid, err_msg = validate_email_format(None)
+    is_valid.should.equal(False)
+    err_msg.should.equal('Invalid Email format.')
+
 
 @web_test
 def test_validate_email_already_exists(context):
@@ -30,6 +36,13 @@ def test_validate_email_already_exists(context):
     err_msg.should.equal('')
 
 
+@web_test
+def test_find_existing_emails(context):
+    User.create_user('test', 'test@test.io', 'test')
+    find_existing_emails([]).should.equal(set())
+    find_existing_emails(['test@test.io', 'test1@test.io']).should.equal({'test@test.io'})
+
+
 def test_validate_field_required():
     is_valid, err_msg = validate_field_required('')
     is_valid.should.equal(False)
@@ -44,6 +57,45 @@ def test_validate_field_required():
     err_msg.should.equal('This field is required')
 
 
+def test_validate_hash_algorithm():
+    validate_hash_algorithm('sha256').should.equal((True, ''))
+    validate_hash_algorithm('md4').should.equal((False, 'Must be one of md5, sha1, sha256, blake2b.'))
+
+
+def test_validate_optional_export_format():
+    validate_optional_export_format(None).should.equal((True, ''))
+    validate_optional_export_format('csv').should.equal((True, ''))
+    validate_optional_export_format('xml').should.equal((False, 'Must be one of ndjson, csv.'))
+
+
+def test_validate_string_or_list_of_strings():
+    validate_string_or_list_of_strings('test').should.equal((True, ''))
+    validate_string_or_list_of_strings(['test', 'test1']).should.equal((True, ''))
+    validate_string_or_list_of_strings(1).should.equal((False, 'Must be a string or a list of strings.'))
+    validate_string_or_list_of_strings(['test', 1]).should.equal((False, 'Must be a string or a list of strings.'))
+
+
+def test_validate_optional_non_negative_integer():
+    validate_optional_non_negative_integer(None).should.equal((True, ''))
+    validate_optional_non_negative_integer('0').should.equal((True, ''))
+    validate_optional_non_negative_integer('12').should.equal((True, ''))
+    validate_optional_non_negative_integer('-1').should.equal((False, 'Must be a non-negative integer.'))
+    validate_optional_non_negative_integer('abc').should.equal((False, 'Must be a non-negative integer.'))
+    validate_optional_non_negative_integer('\u00b2').should.equal((False, 'Must be a non-negative integer.'))
+    validate_optional_non_negative_integer('\u0663').should.equal((False, 'Must be a non-negative integer.'))
+    validate_optional_non_negative_integer(str(2 ** 63 - 1)).should.equal((True, ''))
+    validate_optional_non_negative_integer(str(2 ** 63)).should.equal((False, 'Must be a non-negative integer.'))
+
+
+def test_validate_optional_positive_integer():
+    validate_optional_positive_integer(None).should.equal((True, ''))
+    validate_optional_positive_integer('1').should.equal((True, ''))
+    validate_optional_positive_integer('0').should.equal((False, 'Must be a positive integer.'))
+    validate_optional_positive_integer('1.5').should.equal((False, 'Must be a positive integer.'))
+    validate_optional_positive_integer('\u00b2').should.equal((False, 'Must be a positive integer.'))
+    validate_optional_positive_integer('99999999999999999999').should.equal((False, 'Must be a positive integer.'))
+
+
 @web_test
 def test_run_validators(context):
     test_data = [
@@ -83,3 +135,74 @@ def test_run_validators(context):
     for item in test_data:
         errors = run_validators(item['validators'])
         errors.should.equal(item['errors'])
+
+
+
+class FindInvalid:
+    def __init__(self, invalid):
+        self.invalid = invalid
+        self.calls = []
+
+    def __call__(self, values):
+        self.calls.append(values)
+        return {value for value in values if value in self.invalid}
+
+
+def test_schema_validate():
+    find_invalid = FindInvalid({'taken@test.io'})
+    schema = Schema(
+        Field('name', required=True),
+        Field('email', required=True, default='', checks=[validate_email_format, BatchCheck(find_invalid, 'Taken.')]),
+        Field('nickname', checks=[validate_email_format]),
+    )
+    schema.validate({'name': 'test', 'email': 'test@test.io'}).should.equal(
+        ({'name': 'test', 'email': 'test@test.io', 'nickname': None}, {}))
+    schema.validate({'name': 'test', 'email': 'taken@test.io'})[1].should.equal({'email': ['Taken.']})
+    find_invalid.calls.should.equal([['test@test.io'], ['taken@test.io']])
+
+
+def test_schema_validate_short_circuits_io_checks():
+    ("the I/O bound checks should not run for fields that already failed a cheap check")
+    find_invalid = FindInvalid(set())
+    schema = Schema(
+        Field('name', required=True),
+        Field('email', required=True, default='', checks=[BatchCheck(find_invalid, 'Taken.'), validate_email_format]),
+    )
+    schema.validate({}).should.equal(({'name': None, 'email': ''}, {
+        'name': ['This field is required'],
+        'email': ['This field is required', 'Invalid Email format.'],
+    }))
+    schema.validate({'name': 'test', 'email': 'test@test.io'}, run_io=False)[1].should.equal({})
+    find_invalid.calls.should.equal([])
+
+
+def test_schema_validate_many():
+    ("validate_many should run each batch check once and catch duplicates within the batch")
+    find_invalid = FindInvalid({'taken@test.io'})
+    schema = Schema(
+        Field('email', required=True, checks=[validate_email_format, BatchCheck(find_invalid, 'Taken.')],
+              unique_in_batch=True),
+    )
+    results = schema.validate_many([
+        {'email': 'test@test.io'},
+        {'email': 'taken@test.io'},
+        {'email': 'test@test.io'},
+        {'email': 'test'},
+        'not a dict',
+    ])
+    [errors for values, errors in results].should.equal([
+        {},
+        {'email': ['Taken.']},
+        {'email': ['Duplicate email in request.']},
+        {'email': ['Invalid Email format.']},
+        {'email': ['This field is required', 'Invalid Email format.']},
+    ])
+    find_invalid.calls.should.equal([['test@test.io', 'taken@test.io']])
+
+
+@web_test
+def test_email_not_taken(context):
+    User.create_user('test', 'test@test.io', 'test')
+    schema = Schema(Field('email', checks=[EMAIL_NOT_TAKEN]))
+    schema.validate({'email': 'test@test.io'})[1].should.equal({'email': ['Email already exists.']})
+    schema.validate({'email': 'test1@test.io'})[1].should.equal({})
@@ -0,0 +1,4 @@
+from app import create_app
+
+# entry point of the production server, see gunicorn.conf.py
+application = create_app()